@@ -0,0 +1,33 @@
+-- Supports the incremental loading of ratings by the local ratings cache of the Estimator:
+-- an index over the write timestamp of ratings, and a log of deleted ratings that is populated by a trigger.
+
+create index if not exists recommendation_ratings_ts_idx
+  on recommendation_ratings (ts);
+
+
+create table if not exists recommendation_ratings_deletions
+(
+  id bigserial not null primary key,
+  user_id integer not null,
+  movie_id integer not null,
+  deleted_at timestamp with time zone not null default now()
+);
+
+alter table recommendation_ratings_deletions owner to postgres;
+
+create index if not exists recommendation_ratings_deletions_deleted_at_idx
+  on recommendation_ratings_deletions (deleted_at);
+
+
+create or replace function log_recommendation_ratings_deletion() returns trigger as $$
+begin
+  insert into recommendation_ratings_deletions (user_id, movie_id) values (old.user_id, old.movie_id);
+  return old;
+end;
+$$ language plpgsql;
+
+drop trigger if exists recommendation_ratings_deletion_log on recommendation_ratings;
+
+create trigger recommendation_ratings_deletion_log
+  after delete on recommendation_ratings
+  for each row execute procedure log_recommendation_ratings_deletion();
@@ -0,0 +1,8 @@
+-- Supports the keyset pagination of the rating history of a user (latest and top ratings): each page seeks to
+-- the cursor of the previous page and reads the next rows in index order, thus its cost does not depend on its depth.
+
+create index if not exists recommendation_ratings_user_ts_idx
+  on recommendation_ratings (user_id, ts desc, movie_id desc);
+
+create index if not exists recommendation_ratings_user_rating_idx
+  on recommendation_ratings (user_id, rating desc, ts desc, movie_id desc);
@@ -0,0 +1,15 @@
+-- Supports the per-movie aggregations over the ratings (popularity rankings, reconciliation of the movie
+-- statistics and the top movies): an index that leads with movie_id and covers all columns of these queries, thus
+-- they are answered by index-only scans in movie_id order (i.e., with a streaming group aggregate, instead of a
+-- sequential scan and a hash aggregate). PostgreSQL 10 has no 'INCLUDE' columns, therefore the covered columns
+-- are key columns; user_id is covered since the queries count it.
+--
+-- Index-only scans skip the heap only for the pages that are all-visible, which autovacuum maintains; after
+-- creating the index on a freshly loaded table, run 'vacuum analyze recommendation_ratings'.
+--
+-- The ratings are not partitioned by ts: in PostgreSQL 10 a partitioned table cannot have the primary key
+-- (user_id, movie_id), nor be the target of 'INSERT ... ON CONFLICT' (which the upserts of ratings use), and
+-- updating the ts of a rating cannot move it to another partition.
+
+create index if not exists recommendation_ratings_movie_idx
+  on recommendation_ratings (movie_id, is_implicit, rating, user_id);
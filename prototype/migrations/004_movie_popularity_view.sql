@@ -0,0 +1,40 @@
+-- A materialized summary of the popularity of the movies: the votes and the average rating of each movie, for each
+-- half-star rating limit in (0.5, 5.0) (i.e., POPULARITY_THRESHOLDS of the application). It is computed with a
+-- single aggregation over the ratings (covered by recommendation_ratings_movie_idx) and it is refreshed by the
+-- statistics job with 'refresh materialized view concurrently', which requires the unique index below and does
+-- not block readers. The ranking index gives the top movies of a rating limit with a single index scan.
+
+create materialized view if not exists recommendation_movie_popularity as
+  select p.threshold, s.movie_id, p.votes, p.avg_rating
+  from (
+    select movie_id,
+           array[count(user_id) filter (where rating >= 1.0),
+                 count(user_id) filter (where rating >= 1.5),
+                 count(user_id) filter (where rating >= 2.0),
+                 count(user_id) filter (where rating >= 2.5),
+                 count(user_id) filter (where rating >= 3.0),
+                 count(user_id) filter (where rating >= 3.5),
+                 count(user_id) filter (where rating >= 4.0),
+                 count(user_id) filter (where rating >= 4.5)] as votes,
+           array[avg(rating) filter (where rating >= 1.0),
+                 avg(rating) filter (where rating >= 1.5),
+                 avg(rating) filter (where rating >= 2.0),
+                 avg(rating) filter (where rating >= 2.5),
+                 avg(rating) filter (where rating >= 3.0),
+                 avg(rating) filter (where rating >= 3.5),
+                 avg(rating) filter (where rating >= 4.0),
+                 avg(rating) filter (where rating >= 4.5)] as avg_ratings
+    from recommendation_ratings
+    group by movie_id
+  ) s,
+  unnest(array[1.0, 1.5, 2.0, 2.5, 3.0, 3.5, 4.0, 4.5]::double precision[], s.votes, s.avg_ratings)
+    as p(threshold, votes, avg_rating)
+  where p.votes > 0;
+
+alter materialized view recommendation_movie_popularity owner to postgres;
+
+create unique index if not exists recommendation_movie_popularity_pkey
+  on recommendation_movie_popularity (threshold, movie_id);
+
+create index if not exists recommendation_movie_popularity_rank_idx
+  on recommendation_movie_popularity (threshold, votes desc, avg_rating desc, movie_id);
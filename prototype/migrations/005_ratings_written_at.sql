@@ -0,0 +1,29 @@
+-- Supports the incremental loading of ratings by the local ratings cache of the Estimator: the ratings are fetched
+-- by the time that they have been written to the database, instead of their ts, which is the time of the rating
+-- event. A queued rating event (see WRITE_BEHIND) is written with its original ts, which may be older than the
+-- watermark of the cache by more than the overlap of RATINGS_CACHE_OVERLAP_SECONDS.
+--
+-- The default sets written_at on inserts (including COPY), while the trigger sets it on updates (including the
+-- 'INSERT ... ON CONFLICT DO UPDATE' upserts of ratings). The index over ts is replaced by one over written_at.
+
+alter table recommendation_ratings
+  add column if not exists written_at timestamp with time zone not null default now();
+
+create index if not exists recommendation_ratings_written_at_idx
+  on recommendation_ratings (written_at);
+
+drop index if exists recommendation_ratings_ts_idx;
+
+
+create or replace function touch_recommendation_ratings_written_at() returns trigger as $$
+begin
+  new.written_at := now();
+  return new;
+end;
+$$ language plpgsql;
+
+drop trigger if exists recommendation_ratings_written_at on recommendation_ratings;
+
+create trigger recommendation_ratings_written_at
+  before update on recommendation_ratings
+  for each row execute procedure touch_recommendation_ratings_written_at();
@@ -0,0 +1,17 @@
+-- The keyset pagination of the rating history of a user compares the cursor of the previous page with row values
+-- (see 002_ratings_history_indexes.sql), which never match a NULL, thus the rows having NULL ts or rating were
+-- skipped by the next pages.
+--
+-- The ratings without ts get the time that they have been written to the database, and ts becomes mandatory. The
+-- watched movies have no rating by design, thus the top ratings are ordered by coalesce(rating, 0), i.e., the watched
+-- movies come after the rated ones (the lowest rating is 0.5), and the index follows that expression.
+
+update recommendation_ratings set ts = written_at where ts is null;
+
+alter table recommendation_ratings
+  alter column ts set not null;
+
+create index if not exists recommendation_ratings_user_top_idx
+  on recommendation_ratings (user_id, coalesce(rating, 0) desc, ts desc, movie_id desc);
+
+drop index if exists recommendation_ratings_user_rating_idx;
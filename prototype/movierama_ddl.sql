@@ -14,7 +14,8 @@ create table if not exists recommendation_ratings
   movie_id integer not null,
   rating double precision,
   is_implicit boolean not null default false,
-  ts timestamp with time zone default now(),
+  ts timestamp with time zone not null default now(),
+  written_at timestamp with time zone not null default now(),
   constraint recommendation_ratings_pkey
   primary key (user_id, movie_id)
 );
@@ -31,4 +32,94 @@ create table if not exists recommendation_movies
   genres text
 );
 
-alter table recommendation_movies owner to postgres;
\ No newline at end of file
+alter table recommendation_movies owner to postgres;
+
+create index if not exists recommendation_ratings_written_at_idx
+  on recommendation_ratings (written_at);
+
+create index if not exists recommendation_ratings_user_ts_idx
+  on recommendation_ratings (user_id, ts desc, movie_id desc);
+
+create index if not exists recommendation_ratings_user_top_idx
+  on recommendation_ratings (user_id, coalesce(rating, 0) desc, ts desc, movie_id desc);
+
+create index if not exists recommendation_ratings_movie_idx
+  on recommendation_ratings (movie_id, is_implicit, rating, user_id);
+
+
+create materialized view if not exists recommendation_movie_popularity as
+  select p.threshold, s.movie_id, p.votes, p.avg_rating
+  from (
+    select movie_id,
+           array[count(user_id) filter (where rating >= 1.0),
+                 count(user_id) filter (where rating >= 1.5),
+                 count(user_id) filter (where rating >= 2.0),
+                 count(user_id) filter (where rating >= 2.5),
+                 count(user_id) filter (where rating >= 3.0),
+                 count(user_id) filter (where rating >= 3.5),
+                 count(user_id) filter (where rating >= 4.0),
+                 count(user_id) filter (where rating >= 4.5)] as votes,
+           array[avg(rating) filter (where rating >= 1.0),
+                 avg(rating) filter (where rating >= 1.5),
+                 avg(rating) filter (where rating >= 2.0),
+                 avg(rating) filter (where rating >= 2.5),
+                 avg(rating) filter (where rating >= 3.0),
+                 avg(rating) filter (where rating >= 3.5),
+                 avg(rating) filter (where rating >= 4.0),
+                 avg(rating) filter (where rating >= 4.5)] as avg_ratings
+    from recommendation_ratings
+    group by movie_id
+  ) s,
+  unnest(array[1.0, 1.5, 2.0, 2.5, 3.0, 3.5, 4.0, 4.5]::double precision[], s.votes, s.avg_ratings)
+    as p(threshold, votes, avg_rating)
+  where p.votes > 0;
+
+alter materialized view recommendation_movie_popularity owner to postgres;
+
+create unique index if not exists recommendation_movie_popularity_pkey
+  on recommendation_movie_popularity (threshold, movie_id);
+
+create index if not exists recommendation_movie_popularity_rank_idx
+  on recommendation_movie_popularity (threshold, votes desc, avg_rating desc, movie_id);
+
+
+create table if not exists recommendation_ratings_deletions
+(
+  id bigserial not null primary key,
+  user_id integer not null,
+  movie_id integer not null,
+  deleted_at timestamp with time zone not null default now()
+);
+
+alter table recommendation_ratings_deletions owner to postgres;
+
+create index if not exists recommendation_ratings_deletions_deleted_at_idx
+  on recommendation_ratings_deletions (deleted_at);
+
+
+create or replace function log_recommendation_ratings_deletion() returns trigger as $$
+begin
+  insert into recommendation_ratings_deletions (user_id, movie_id) values (old.user_id, old.movie_id);
+  return old;
+end;
+$$ language plpgsql;
+
+drop trigger if exists recommendation_ratings_deletion_log on recommendation_ratings;
+
+create trigger recommendation_ratings_deletion_log
+  after delete on recommendation_ratings
+  for each row execute procedure log_recommendation_ratings_deletion();
+
+
+create or replace function touch_recommendation_ratings_written_at() returns trigger as $$
+begin
+  new.written_at := now();
+  return new;
+end;
+$$ language plpgsql;
+
+drop trigger if exists recommendation_ratings_written_at on recommendation_ratings;
+
+create trigger recommendation_ratings_written_at
+  before update on recommendation_ratings
+  for each row execute procedure touch_recommendation_ratings_written_at();
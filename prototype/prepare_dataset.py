@@ -15,9 +15,13 @@
 import csv
 from dateutil.parser import parse
 import sqlalchemy
+import redis
 
 log = logging.getLogger("dataset_loader")
 
+# the version of the movie catalog, which the MovieRec workers check in order to clear their in-process movie caches
+MOVIES_VERSION_KEY = 'movies:version'
+
 
 @backoff.on_exception(backoff.expo,
                       requests.exceptions.RequestException,
@@ -167,20 +171,127 @@ def create_enriched_movies_csv(links_df, movies_enriched_filepath, api_key):
     return movies_df
 
 
-def write_to_db(db_engine, users_df, ratings_df, movies_df):
-    start_time = time.time()
+# Constraints and indexes that are dropped before a bulk load and re-created after it,
+# since building them once over the loaded rows is much faster than maintaining them for every row
+DEFERRED_CONSTRAINTS = {
+    'recommendation_users': [('recommendation_users_pkey', 'PRIMARY KEY (user_id)')],
+    'recommendation_ratings': [('recommendation_ratings_pkey', 'PRIMARY KEY (user_id, movie_id)')],
+    'recommendation_movies': [('recommendation_movies_pkey', 'PRIMARY KEY (movie_id)')]
+}
+
+DEFERRED_INDEXES = {
+    'recommendation_ratings': [('recommendation_ratings_written_at_idx', '(written_at)'),
+                               ('recommendation_ratings_user_ts_idx', '(user_id, ts DESC, movie_id DESC)'),
+                               ('recommendation_ratings_user_rating_idx',
+                                '(user_id, rating DESC, ts DESC, movie_id DESC)'),
+                               ('recommendation_ratings_movie_idx', '(movie_id, is_implicit, rating, user_id)')]
+}
+
+
+def copy_df(cursor, table_name, df, chunk_size=100000):
+    """
+    Streams the rows of a DataFrame to a table, using 'COPY ... FROM STDIN' with in-memory CSV buffers
+    of (at most) chunk_size rows each
+    """
+    columns = ", ".join(df.columns)
+
+    for chunk_start in range(0, len(df.index), chunk_size):
+        buffer = io.StringIO()
+        df.iloc[chunk_start:chunk_start + chunk_size].to_csv(buffer, index=False, header=False)
+        buffer.seek(0)
+
+        cursor.copy_expert(f"COPY {table_name} ({columns}) FROM STDIN WITH (FORMAT csv)", buffer)
+
+
+def bulk_copy_to_db(db_engine, tables):
+    """
+    Loads the given (table name, DataFrame) pairs using COPY, by deferring the creation of primary keys and indexes
+    until all rows have been loaded. All tables are loaded in a single transaction.
+    """
+    connection = db_engine.raw_connection()
+
+    try:
+        cursor = connection.cursor()
+
+        for table_name, _ in tables:
+            for index_name, _ in DEFERRED_INDEXES.get(table_name, []):
+                cursor.execute(f"DROP INDEX IF EXISTS {index_name}")
+            for constraint_name, _ in DEFERRED_CONSTRAINTS.get(table_name, []):
+                cursor.execute(f"ALTER TABLE {table_name} DROP CONSTRAINT IF EXISTS {constraint_name}")
+
+        for table_name, df in tables:
+            log.info(f"Copying to table '{table_name}'")
+
+            start_time = time.time()
+            copy_df(cursor, table_name, df)
+            end_time = time.time()
+
+            log.info(f"Copied {len(df.index)} rows to table '{table_name}' in {end_time - start_time} seconds "
+                     f"({len(df.index) / max(end_time - start_time, 1e-9):.0f} rows/sec)")
+
+        for table_name, _ in tables:
+            start_time = time.time()
+
+            for constraint_name, definition in DEFERRED_CONSTRAINTS.get(table_name, []):
+                cursor.execute(f"ALTER TABLE {table_name} ADD CONSTRAINT {constraint_name} {definition}")
+            for index_name, definition in DEFERRED_INDEXES.get(table_name, []):
+                cursor.execute(f"CREATE INDEX {index_name} ON {table_name} {definition}")
+
+            end_time = time.time()
+            log.info(f"Created constraints and indexes of table '{table_name}' in {end_time - start_time} seconds")
+
+        connection.commit()
+    except Exception:
+        connection.rollback()
+        raise
+    finally:
+        connection.close()
+
+
+def vacuum_analyze(db_engine, tables):
+    """
+    Sets the visibility map of the given tables (for index-only scans) and their planner statistics. VACUUM cannot
+    run inside a transaction block, thus it runs on a connection in autocommit mode.
+    """
+    with db_engine.connect().execution_options(isolation_level='AUTOCOMMIT') as connection:
+        for table_name, _ in tables:
+            start_time = time.time()
+            connection.execute(f"VACUUM ANALYZE {table_name}")
+            end_time = time.time()
+
+            log.info(f"Vacuumed and analyzed table '{table_name}' in {end_time - start_time} seconds")
+
+
+def insert_to_db(db_engine, tables):
+    """
+    Loads the given (table name, DataFrame) pairs using parameterized INSERTs
+    """
+    for table_name, df in tables:
+        log.info(f"Writing to table '{table_name}'")
+
+        start_time = time.time()
+        df.to_sql(table_name, con=db_engine.connect(), if_exists='append', index=False, chunksize=4096)
+        end_time = time.time()
+
+        log.info(f"Wrote {len(df.index)} rows to table '{table_name}' in {end_time - start_time} seconds "
+                 f"({len(df.index) / max(end_time - start_time, 1e-9):.0f} rows/sec)")
+
 
-    log.info("Writing to table 'recommendation_users'")
-    users_df \
-        .to_sql('recommendation_users', con=db_engine.connect(), if_exists='append', index=False, chunksize=4096)
+def write_to_db(db_engine, users_df, ratings_df, movies_df, mode='copy'):
+    start_time = time.time()
 
-    log.info("Writing to table 'recommendation_ratings'")
-    ratings_df \
-        .to_sql('recommendation_ratings', con=db_engine.connect(), if_exists='append', index=False, chunksize=4096)
+    tables = [
+        ('recommendation_users', users_df),
+        ('recommendation_ratings', ratings_df),
+        ('recommendation_movies', movies_df)
+    ]
 
-    log.info("Writing to table 'recommendation_movies'")
-    movies_df \
-        .to_sql('recommendation_movies', con=db_engine.connect(), if_exists='append', index=False, chunksize=4096)
+    if mode == 'copy':
+        bulk_copy_to_db(db_engine, tables)
+    elif mode == 'insert':
+        insert_to_db(db_engine, tables)
+    else:
+        raise ValueError(f"Unknown loading mode '{mode}', should be either 'copy' or 'insert'")
 
     db_engine.connect().execute(
         "SELECT setval(pg_get_serial_sequence('recommendation_users', 'user_id'), coalesce(max(user_id)+1,1), false) "
@@ -192,10 +303,26 @@ def write_to_db(db_engine, users_df, ratings_df, movies_df):
         "FROM recommendation_movies"
     )
 
+    vacuum_analyze(db_engine, tables)
+
     end_time = time.time()
     log.info(f"Loading time: {end_time-start_time}")
 
 
+def bump_movies_version(redis_client):
+    """
+    Increments the version of the movie catalog, such that the running MovieRec workers clear their cached movies
+    (see MovieCatalogCache of the web application). A missing redis is only logged, since there is no running
+    worker to notify.
+    """
+    try:
+        version = redis_client.incr(MOVIES_VERSION_KEY)
+        log.info(f"Movie catalog version is now {version}")
+    except redis.exceptions.ConnectionError as e:
+        log.warning(f"Failed to increment the movie catalog version '{MOVIES_VERSION_KEY}', the running MovieRec "
+                    f"workers may serve stale movies until they are restarted: {e}")
+
+
 def main():
     logging.basicConfig(format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
                         level=logging.DEBUG,
@@ -215,16 +342,24 @@ def main():
     db_pass = os.getenv("DB_PASS", "movierec")
     db_port = os.getenv("DB_PORT", "5432")
 
+    # either 'copy' (bulk load using COPY) or 'insert' (parameterized INSERTs)
+    load_mode = os.getenv("LOAD_MODE", "copy")
+
     postgres_url = f"postgresql://postgres:{db_pass}@{db_host}:{db_port}/{db_name}"
 
     db_engine = sqlalchemy.create_engine(postgres_url)
 
+    redis_client = redis.Redis(host=os.getenv("REDIS_HOST", "localhost"),
+                               port=int(os.getenv("REDIS_PORT", "6379")),
+                               db=int(os.getenv("REDIS_DB", "0")))
+
     # Download original data set to a system's temporary directory and extract its contents
     dataset_path = fetch_dataset()
     ratings_df, users_df = load_ratings_users_df(dataset_path)
     movies_df = load_movies_df(dataset_path, api_key)
 
-    write_to_db(db_engine, users_df, ratings_df, movies_df)
+    write_to_db(db_engine, users_df, ratings_df, movies_df, mode=load_mode)
+    bump_movies_version(redis_client)
 
 
 if __name__ == '__main__':
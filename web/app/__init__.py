@@ -4,8 +4,6 @@
 from flask_sqlalchemy import SQLAlchemy
 from flask_marshmallow import Marshmallow
 from config import Config
-from apscheduler.schedulers.background import BackgroundScheduler
-from datetime import datetime
 
 app = Flask(__name__)
 app.config.from_object(Config)
@@ -21,34 +19,80 @@
 from app import models, controller
 from app.recommender.estimator import Estimator
 from app.recommender.statistics import MovieStatistics
+from app.recommender.snapshot import SnapshotStore
+from app.recommender.ratings_cache import RatingsCache
+from app.recommender.popularity import POPULARITY_THRESHOLDS
+from app.recommender.seen import SeenMovies
+from app.recommender.changes import RatingChanges
+from app.rating_queue import RatingEventQueue
 
-from app.api.v1.routes import api as routes_v1
+snapshot_store = SnapshotStore(app.config.get("MODEL_SNAPSHOT_DIR"),
+                               keep=app.config.get("MODEL_SNAPSHOT_KEEP"),
+                               index_n_probe=app.config.get("MODEL_INDEX_N_PROBE"))
 
-app.register_blueprint(routes_v1, url_prefix='/api/v1')
+ratings_cache = RatingsCache(db,
+                             path=app.config.get("RATINGS_CACHE_DIR"),
+                             full_reload_every=app.config.get("RATINGS_CACHE_FULL_RELOAD_EVERY"),
+                             overlap_seconds=app.config.get("RATINGS_CACHE_OVERLAP_SECONDS")) \
+    if app.config.get("RATINGS_CACHE_DIR") else None
 
 estimator = Estimator(db,
                       redis_pool=redis_pool,
                       redis_chunk_size=app.config.get("REDIS_CHUNK_SIZE"),
                       model_params=app.config.get("MODEL_PARAMS"),
-                      top_n=app.config.get("TOP_N"))
+                      top_n=app.config.get("TOP_N"),
+                      candidates_factor=app.config.get("RECOMMENDATION_CANDIDATES_FACTOR"),
+                      block_size=app.config.get("RECOMPUTE_BLOCK_SIZE"),
+                      queue_size=app.config.get("RECOMPUTE_QUEUE_SIZE"),
+                      n_workers=app.config.get("RECOMPUTE_WORKERS"),
+                      warm_start_epochs=app.config.get("MODEL_WARM_START_EPOCHS"),
+                      warm_start_tol=app.config.get("MODEL_WARM_START_TOL"),
+                      cold_retrain_every=app.config.get("MODEL_COLD_RETRAIN_EVERY"),
+                      snapshot_store=snapshot_store,
+                      index_params={
+                          'index_type': app.config.get("MODEL_INDEX"),
+                          'n_clusters': app.config.get("MODEL_INDEX_N_CLUSTERS"),
+                          'n_probe': app.config.get("MODEL_INDEX_N_PROBE")
+                      },
+                      ratings_cache=ratings_cache,
+                      score_type=app.config.get("REDIS_SCORE_TYPE"))
+
+# the rating limits of the precomputed popularity rankings, including the one of the fallback recommendations
+popularity_thresholds = tuple(sorted(set(POPULARITY_THRESHOLDS) | {app.config.get("DEFAULT_RATING")}))
 
 movie_stats = MovieStatistics(db,
                               redis_pool=redis_pool,
                               users_lower_limit=app.config.get("STAT_MOVIE_USERS_LOWER_LIMIT"),
-                              redis_chunk_size=app.config.get("REDIS_CHUNK_SIZE"))
+                              redis_chunk_size=app.config.get("REDIS_CHUNK_SIZE"),
+                              popularity_thresholds=popularity_thresholds)
+
+rating_changes = RatingChanges(redis_pool)
 
+seen_movies = SeenMovies(db,
+                         redis_pool=redis_pool,
+                         redis_chunk_size=app.config.get("REDIS_CHUNK_SIZE"))
 
-def trigger_recompute_recommendations():
-    app.logger.info('Recomputing recommendations...')
-    estimator.recompute_recommendations()
 
+def refresh_flushed_users(user_ids):
+    # best effort: the events have been written already, and a user that is not refreshed keeps the recommendations
+    # of the latest recompute
+    if app.config.get("ONLINE_FOLD_IN"):
+        for user_id in user_ids:
+            try:
+                estimator.refresh_user_recommendations(user_id)
+            except Exception:
+                app.logger.exception(f"Failed to refresh recommendations of user with user_id={user_id}")
 
-def trigger_recompute_movie_stats():
-    app.logger.info('Recomputing movie statistics...')
-    movie_stats.calc_rating_stats()
 
+rating_queue = RatingEventQueue(db,
+                                redis_pool=redis_pool,
+                                flush_size=app.config.get("WRITE_BEHIND_FLUSH_SIZE"),
+                                flush_interval=app.config.get("WRITE_BEHIND_FLUSH_INTERVAL"),
+                                movie_stats=movie_stats,
+                                on_flush=refresh_flushed_users,
+                                rating_changes=rating_changes) \
+    if app.config.get("WRITE_BEHIND") else None
 
-scheduler = BackgroundScheduler()
-scheduler.add_job(trigger_recompute_recommendations, 'interval', minutes=15, next_run_time=datetime.now())
-scheduler.add_job(trigger_recompute_movie_stats, 'interval', minutes=30, next_run_time=datetime.now())
-scheduler.start()
+from app.api.v1.routes import api as routes_v1
+
+app.register_blueprint(routes_v1, url_prefix='/api/v1')
@@ -2,8 +2,42 @@
 
 from app import app
 from flask import jsonify
+from datetime import datetime, timedelta, timezone
+
+EPOCH = datetime(1970, 1, 1, tzinfo=timezone.utc)
 
 
 @app.route('/')
 def hello():
     return jsonify(message="Welcome to MovieRec!")
+
+
+def encode_cursor(cursor):
+    """
+    Encodes a pagination cursor, i.e., a tuple of values, as comma-separated values. Timestamps are encoded
+    as microseconds since the epoch, in order to be exact.
+    """
+    if cursor is None:
+        return None
+
+    return ','.join(str((value - EPOCH) // timedelta(microseconds=1)) if isinstance(value, datetime) else str(value)
+                    for value in cursor)
+
+
+def decode_cursor(value, types):
+    """
+    Decodes a pagination cursor (see encode_cursor)
+
+    :param value: the encoded cursor
+    :param types: the types of the values of the cursor, where datetime denotes a timestamp
+    :return: the cursor, or None when the value is malformed
+    """
+    values = value.split(',')
+
+    if len(values) != len(types):
+        return None
+
+    try:
+        return tuple(EPOCH + timedelta(microseconds=int(v)) if t is datetime else t(v) for v, t in zip(values, types))
+    except (ValueError, OverflowError):
+        return None
@@ -1,9 +1,12 @@
 # -*- coding: utf-8 -*-
 
-from flask import request, jsonify, abort, Blueprint
+from flask import request, jsonify, abort, Blueprint, Response, stream_with_context
+from datetime import datetime
 
-from app import app, db, redis_pool
+from app import app, db, redis_pool, estimator, popularity_thresholds, rating_queue, movie_stats, \
+    rating_changes
 from app.api import common
+from app.json_fragments import json_response, encode
 from app.controller import MovieRecController
 from app.models import user_schema, movie_schema, rating_schema
 
@@ -11,7 +14,17 @@
 app_controller = MovieRecController(db,
                                      redis_pool=redis_pool,
                                      default_rating=app.config.get("DEFAULT_RATING"),
-                                     top_n=app.config.get("TOP_N"))
+                                     top_n=app.config.get("TOP_N"),
+                                     movie_stats=movie_stats,
+                                     estimator=estimator,
+                                     online_fold_in=app.config.get("ONLINE_FOLD_IN"),
+                                     realtime=app.config.get("REALTIME_RECOMMENDATIONS"),
+                                     popularity_thresholds=popularity_thresholds,
+                                     redis_chunk_size=app.config.get("REDIS_CHUNK_SIZE"),
+                                     movie_cache_size=app.config.get("MOVIE_CACHE_SIZE"),
+                                     movie_cache_check_interval=app.config.get("MOVIE_CACHE_CHECK_INTERVAL"),
+                                     rating_queue=rating_queue,
+                                     rating_changes=rating_changes)
 
 api = Blueprint(name="v1", import_name="api")
 
@@ -47,22 +60,39 @@ def del_user(user_id):
     return abort(404) if result is None else jsonify({'user_id': user_id, 'msg': 'deleted'})
 
 
+def get_ratings_page_args(cursor_types):
+    limit = request.args.get('limit', 20, type=int)
+    after = request.args.get('after', None)
+
+    if limit < 1:
+        abort(400)
+
+    if after is not None:
+        after = common.decode_cursor(after, cursor_types)
+        if after is None:
+            abort(400)
+
+    return limit, after
+
+
 @api.route('/user/<int:user_id>/ratings/latest', methods=['GET'])
 def get_user_ratings(user_id):
-    limit = request.args.get('limit', 20)
+    limit, after = get_ratings_page_args((datetime, int))
 
-    result = app_controller.get_user_ratings(user_id, limit)
+    result, next_cursor = app_controller.get_user_ratings(user_id, limit, after)
 
-    return abort(404) if result is None else jsonify({'user_id': user_id, 'limit': limit, 'ratings': result})
+    return json_response({'user_id': user_id, 'limit': limit, 'ratings': result,
+                          'next': common.encode_cursor(next_cursor)})
 
 
 @api.route('/user/<int:user_id>/ratings/top', methods=['GET'])
 def get_user_top_ratings(user_id):
-    limit = request.args.get('limit', 20)
+    limit, after = get_ratings_page_args((float, datetime, int))
 
-    result = app_controller.get_user_top_ratings(user_id, limit)
+    result, next_cursor = app_controller.get_user_top_ratings(user_id, limit, after)
 
-    return abort(404) if result is None else jsonify({'user_id': user_id, 'limit': limit, 'ratings': result})
+    return json_response({'user_id': user_id, 'limit': limit, 'ratings': result,
+                          'next': common.encode_cursor(next_cursor)})
 
 
 @api.route('/movie/<int:movie_id>', methods=['GET'])
@@ -74,12 +104,12 @@ def get_movie_info(movie_id):
 
 @api.route('/movies/top', methods=['GET'])
 def get_top_movies():
-    limit = request.args.get('limit', 100)
-    rating_limit = request.args.get('rating_limit', None)
+    limit = request.args.get('limit', 100, type=int)
+    rating_limit = request.args.get('rating_limit', None, type=float)
 
     result = app_controller.get_top_movies(limit, rating_limit)
 
-    return abort(404) if result is None else jsonify(top_movies=result)
+    return abort(404) if result is None else json_response({'top_movies': result})
 
 
 @api.route('/user/<int:user_id>/rating', methods=['PUT'])
@@ -94,6 +124,32 @@ def set_user_rating(user_id):
     return abort(404) if result is None else jsonify(rating_schema.dump(result).data)
 
 
+@api.route('/ratings', methods=['PUT'])
+def set_ratings():
+    content = request.json
+
+    try:
+        entries = [(int(entry['user_id']),
+                    int(entry['movie_id']),
+                    None if entry.get('rating') is None else float(entry['rating']))
+                   for entry in content['ratings']]
+    except (TypeError, KeyError, ValueError, AttributeError):
+        return abort(400)
+
+    if len(entries) > app.config.get("BULK_RATINGS_MAX_ENTRIES"):
+        return abort(413)
+
+    inserted, updated, rejected = app_controller.set_movie_ratings(entries,
+                                                                   chunk_size=app.config.get("BULK_RATINGS_CHUNK_SIZE"))
+
+    return jsonify({'inserted': inserted, 'updated': updated, 'rejected': rejected})
+
+
+@api.route('/ratings/queue', methods=['GET'])
+def get_rating_queue_lag():
+    return abort(404) if rating_queue is None else jsonify(rating_queue.lag())
+
+
 @api.route('/user/<int:user_id>/rating', methods=['DELETE'])
 def del_user_rating(user_id):
     content = request.json
@@ -127,12 +183,42 @@ def handle_user_watched(user_id):
 
 @api.route("/user/<int:user_id>/recommendations", methods=['GET'])
 def recommendations(user_id):
-    result = app_controller.get_recommendations(user_id)
+    fresh = request.args.get('fresh', '0').lower() in ('1', 'true')
+
+    result = app_controller.get_recommendations(user_id, fresh=fresh)
 
     if result is None:
         return abort(404)
     else:
-        resulting_movies = [movie_schema.dump(m).data for m in result]
-        return jsonify({'user_id': user_id, 'recommendations': resulting_movies})
+        return json_response({'user_id': user_id, 'recommendations': result})
+
+
+@api.route("/users/recommendations", methods=['POST'])
+def batch_recommendations():
+    content = request.json
+
+    try:
+        user_ids = [int(user_id) for user_id in content['user_ids']]
+    except (TypeError, KeyError, ValueError):
+        return abort(400)
+
+    chunk_size = app.config.get("BATCH_RECOMMENDATIONS_CHUNK_SIZE")
+
+    if len(user_ids) > app.config.get("BATCH_RECOMMENDATIONS_MAX_USERS"):
+        return abort(413)
+
+    results = app_controller.get_batch_recommendations(user_ids, chunk_size=chunk_size)
+
+    if len(user_ids) <= chunk_size:
+        return json_response({
+            'recommendations': [{'user_id': user_id, 'recommendations': movies} for (user_id, movies) in results]
+        })
 
+    # large batches are streamed, chunk by chunk
+    def generate():
+        yield b'{"recommendations":['
+        for i, (user_id, movies) in enumerate(results):
+            yield (b',' if i > 0 else b'') + encode({'user_id': user_id, 'recommendations': movies})
+        yield b']}\n'
 
+    return Response(stream_with_context(generate()), mimetype='application/json')
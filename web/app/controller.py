@@ -2,19 +2,49 @@
 
 import logging
 import redis
-from app.models import User, Rating, Movie, movie_schema
-from sqlalchemy import func
+import numpy as np
+from collections import Counter
+from app.models import User, Rating, Movie, MoviePopularity
+from app.recommender.encoding import decode_recommendations
+from app.recommender.generations import Generations, RECOMMENDATIONS
+from app.recommender.popularity import PopularityCache, POPULARITY_THRESHOLDS
+from app.recommender.seen import SeenMovies
+from app.movie_cache import MovieCatalogCache
+from sqlalchemy import func, tuple_
+from sqlalchemy.dialects.postgresql import insert
 from datetime import timezone, datetime
 
 
 class MovieRecController:
 
-    def __init__(self, db, redis_pool, default_rating, top_n):
+    # the rating by which the watched movies (having no rating) are ordered in the top ratings of a user, i.e., lower
+    # than any rating
+    UNRATED = 0
+
+    def __init__(self, db, redis_pool, default_rating, top_n, movie_stats, estimator=None, online_fold_in=False,
+                 realtime=False, popularity_thresholds=POPULARITY_THRESHOLDS, redis_chunk_size=1000,
+                 movie_cache_size=100000, movie_cache_check_interval=30, rating_queue=None, rating_changes=None):
         self.logger = logging.getLogger('Controller')
         self.db = db
         self.redis_client = redis.Redis(connection_pool=redis_pool)
         self.default_rating = default_rating
         self.top_n = top_n
+        self.estimator = estimator
+        self.online_fold_in = online_fold_in
+        self.realtime = realtime
+        self.recommendations = Generations(self.redis_client, RECOMMENDATIONS)
+        self.popularity = PopularityCache(self.redis_client, popularity_thresholds)
+        self.seen = SeenMovies(db, redis_pool, redis_chunk_size)
+        self.movies = MovieCatalogCache(db, redis_pool, movie_cache_size, movie_cache_check_interval)
+
+        # when set, ratings are written behind through the queue (see RatingEventQueue)
+        self.rating_queue = rating_queue
+
+        # the incrementally maintained statistics of the movies (see MovieStatistics)
+        self.movie_stats = movie_stats
+
+        # when set, the changed ratings are recorded in order to drive the retraining (see RatingChanges)
+        self.rating_changes = rating_changes
 
     def get_user_info(self, user_id):
         self.logger.debug(f"Getting user info with user_id={user_id}")
@@ -40,70 +70,165 @@ def delete_user(self, user_id):
         if user is not None:
             self.db.session.delete(user)
             self.db.session.commit()
+            self.seen.delete(user_id)
             return user_id
         else:
             return None
 
-    def get_user_ratings(self, user_id, limit=None):
-        self.logger.debug(f"Get ratings of user with user_id={user_id}")
+    def get_user_ratings(self, user_id, limit=None, after=None):
+        """
+        Gives the ratings of a user, latest first (ties are broken by movie_id), a page at a time. Pages use keyset
+        pagination, i.e., the query seeks to the cursor of the previous page on the index
+        recommendation_ratings_user_ts_idx, thus the cost of a page does not depend on its depth.
+
+        :param user_id: the id of the user
+        :param limit: optionally, the maximum number of ratings of the page
+        :param after: optionally, the cursor of the previous page, i.e., a (ts, movie_id) tuple
+        :return: a tuple of the ratings and the cursor of the next page (None when there are no more ratings)
+        """
+        self.logger.debug(f"Get ratings of user with user_id={user_id} after {after}")
 
         query = self.db.session \
-            .query(Rating, Movie) \
-            .join(Movie, Rating.movie_id == Movie.movie_id) \
+            .query(Rating) \
             .filter(Rating.user_id == user_id) \
-            .order_by(Rating.ts.desc())
+            .order_by(Rating.ts.desc(), Rating.movie_id.desc())
+
+        if after is not None:
+            query = query.filter(tuple_(Rating.ts, Rating.movie_id) < tuple_(*after))
 
-        user_ratings = query.all() if limit is None else query.limit(limit).all()
+        return self.get_ratings_page(query, limit, lambda r: (r.ts, r.movie_id))
 
-        return self.convert_user_ratings(user_ratings)
+    def get_user_top_ratings(self, user_id, limit=None, after=None):
+        """
+        Gives the ratings of a user, highest first (ties are broken by ts and movie_id), a page at a time, using
+        keyset pagination on the index recommendation_ratings_user_top_idx (see get_user_ratings). The watched
+        movies (having no rating) come last, i.e., they are ordered as having the rating UNRATED.
+
+        :param user_id: the id of the user
+        :param limit: optionally, the maximum number of ratings of the page
+        :param after: optionally, the cursor of the previous page, i.e., a (rating, ts, movie_id) tuple
+        :return: a tuple of the ratings and the cursor of the next page (None when there are no more ratings)
+        """
+        self.logger.debug(f"Get top ratings of user with user_id={user_id} after {after}")
 
-    def get_user_top_ratings(self, user_id, limit=None):
-        self.logger.debug(f"Get top ratings of user with user_id={user_id}")
+        # the same expression as the index (see prototype/migrations/006_ratings_history_nulls.sql)
+        rating = func.coalesce(Rating.rating, self.UNRATED)
 
         query = self.db.session \
-            .query(Rating, Movie) \
-            .join(Movie, Rating.movie_id == Movie.movie_id) \
+            .query(Rating) \
             .filter(Rating.user_id == user_id) \
-            .order_by(Rating.rating.desc(), Rating.ts.desc())
+            .order_by(rating.desc(), Rating.ts.desc(), Rating.movie_id.desc())
 
-        user_ratings = query.all() if limit is None else query.limit(limit).all()
+        if after is not None:
+            query = query.filter(tuple_(rating, Rating.ts, Rating.movie_id) < tuple_(*after))
 
-        return self.convert_user_ratings(user_ratings)
+        return self.get_ratings_page(
+            query, limit, lambda r: (self.UNRATED if r.rating is None else r.rating, r.ts, r.movie_id))
+
+    def get_ratings_page(self, query, limit, cursor_of):
+        """
+        :param query: the ordered query of the ratings
+        :param limit: the maximum number of ratings of the page, or None for all ratings
+        :param cursor_of: a function that gives the cursor of a rating
+        :return: a tuple of the converted ratings of the page and the cursor of the next page (if any)
+        """
+        if limit is None:
+            return self.convert_user_ratings(query.all()), None
+
+        # one more rating is fetched, in order to know whether there is a next page
+        user_ratings = query.limit(limit + 1).all()
+
+        if len(user_ratings) <= limit:
+            return self.convert_user_ratings(user_ratings), None
+
+        user_ratings = user_ratings[:limit]
+
+        return self.convert_user_ratings(user_ratings), cursor_of(user_ratings[-1])
 
     def get_movie_info(self, movie_id):
         self.logger.debug(f"Getting movie info with movie_id={movie_id}")
         return self.db.session.query(Movie).get(movie_id)
 
+    def get_movies(self, movie_ids):
+        """
+        :return: a dictionary of the specified movie ids to the serialized JSON of the corresponding movies
+                 (see MovieCatalogCache), the ids of non-existing movies are omitted
+        """
+        if len(movie_ids) == 0:
+            return {}
+
+        return self.movies.get(movie_ids)
+
     def get_top_movies(self, top_n, rating_limit=None):
         if rating_limit is not None:
             assert(0.5 < rating_limit < 5.0)
 
         self.logger.debug(f"Getting top {top_n} movies, with rating_limit = {str(rating_limit)}")
 
-        avg_ratings = func.avg(Rating.rating).label("avg_ratings")
-        count_users = func.count(Rating.user_id).label("count_users")
+        # slice the precomputed popularity ranking, when it exists for the requested rating limit
+        ranking = self.popularity.get(3.5 if rating_limit is None else rating_limit)
+
+        if ranking is not None:
+            top_movie_ids, votes, avg_ratings = (values[:top_n].tolist() for values in ranking)
+            movies = self.get_movies(top_movie_ids)
 
-        rating_limit_filter = Rating.rating >= 3.5 if rating_limit is None else Rating.rating >= rating_limit
+            return [
+                {
+                    'avg_rating': avg,
+                    'votes': n_votes,
+                    'movie': movies[movie_id]
+                } for (movie_id, n_votes, avg) in zip(top_movie_ids, votes, avg_ratings) if movie_id in movies
+            ]
+
+        top_rated = self.top_movies_query(3.5 if rating_limit is None else rating_limit).subquery()
 
         top_n_rated = self.db.session \
-            .query(avg_ratings, count_users, Rating.movie_id, Movie) \
-            .join(Movie, Rating.movie_id == Movie.movie_id) \
-            .filter(rating_limit_filter) \
-            .group_by(Rating.movie_id, Movie) \
-            .order_by(func.count(Rating.user_id).desc(), func.avg(Rating.rating).desc()) \
+            .query(top_rated.c.avg_ratings, top_rated.c.count_users, top_rated.c.movie_id, Movie) \
+            .join(Movie, top_rated.c.movie_id == Movie.movie_id) \
+            .order_by(top_rated.c.count_users.desc(), top_rated.c.avg_ratings.desc()) \
             .limit(top_n) \
             .all()
 
+        movies = self.movies.put(m for (_, _, _, m) in top_n_rated)
+
         result = [
             {
                 'avg_rating': float(avg),
                 'votes': int(votes),
-                'movie': movie_schema.dump(m).data
+                'movie': movies[r_mid]
              } for (avg, votes, r_mid, m,) in top_n_rated
         ]
 
         return result
 
+    def top_movies_query(self, rating_limit):
+        """
+        For the half-star rating limits, reads the materialized view of the popularity of the movies, whose index
+        recommendation_movie_popularity_rank_idx gives the top movies with a single index scan. Otherwise, aggregates
+        the ratings per movie only (i.e., without the movie details, which are joined afterwards), thus the
+        aggregation is covered by the index recommendation_ratings_movie_idx.
+
+        :param rating_limit: only the ratings that are greater than or equal to the limit are counted
+        :return: the query of the average rating ('avg_ratings') and the votes ('count_users') of each movie
+        """
+        if float(rating_limit) in POPULARITY_THRESHOLDS:
+            return self.db.session \
+                .query(MoviePopularity.movie_id,
+                       MoviePopularity.avg_rating.label("avg_ratings"),
+                       MoviePopularity.votes.label("count_users")) \
+                .filter(MoviePopularity.threshold == float(rating_limit))
+
+        # aggregation function for computing the average ratings of a movie
+        avg_ratings = func.avg(Rating.rating).label("avg_ratings")
+
+        # aggregation function for computing the total number of users that reated/watched a movie
+        count_users = func.count(Rating.user_id).label("count_users")
+
+        return self.db.session \
+            .query(Rating.movie_id, avg_ratings, count_users) \
+            .filter(Rating.rating >= rating_limit) \
+            .group_by(Rating.movie_id)
+
     def set_movie_rating(self, user_id, movie_id, rating):
         self.logger.debug(f"User with user_id={user_id} rated with {rating} stars the movie with movie_id={movie_id}")
         assert(0.5 <= rating <= 5.0)
@@ -121,14 +246,46 @@ def set_movie_rating(self, user_id, movie_id, rating):
             ts=datetime.now(tz=timezone.utc)
         )
 
-        self.db.session.merge(movie_rating)
-        self.db.session.commit()
-
-        key = f"n_ratings_{user_id}"
-        self.redis_client.incr(key)
+        self.save_movie_rating(movie_rating)
 
         return movie_rating
 
+    def save_movie_rating(self, movie_rating):
+        """
+        Writes the given rating to the database, or pushes it to the write-behind queue when it is enabled, and
+        updates the counters of the user. In the latter case, the recommendations of the user are refreshed when
+        the queue is flushed.
+
+        :param movie_rating: the Rating to write
+        """
+        user_id, movie_id = movie_rating.user_id, movie_rating.movie_id
+
+        if self.rating_queue is None:
+            previous = self.movie_stats.lock_previous_ratings([(user_id, movie_id)]).get((user_id, movie_id))
+
+            self.db.session.merge(movie_rating)
+            self.db.session.commit()
+
+        with self.redis_client.pipeline(transaction=False) as pipe:
+            if self.rating_queue is None:
+                self.movie_stats.update(movie_id, previous, (movie_rating.rating, movie_rating.is_implicit),
+                                        client=pipe)
+                self.record_changes({user_id: 1}, client=pipe)
+            else:
+                self.rating_queue.push(user_id, movie_id,
+                                       rating=movie_rating.rating,
+                                       is_implicit=movie_rating.is_implicit,
+                                       ts=movie_rating.ts,
+                                       client=pipe)
+
+            key = f"n_ratings_{user_id}"
+            pipe.incr(key)
+            self.seen.add(user_id, movie_id, client=pipe)
+            pipe.execute()
+
+        if self.rating_queue is None:
+            self.refresh_recommendations(user_id)
+
     def delete_movie_rating(self, user_id, movie_id):
         self.logger.debug(f"Deleting rating of user with user_id={user_id} for movie with movie_id={movie_id}")
         movie_rating = Rating.query \
@@ -136,14 +293,29 @@ def delete_movie_rating(self, user_id, movie_id):
             .filter(Rating.movie_id == movie_id) \
             .one_or_none()
 
-        if movie_rating is None:
+        # with write-behind, the rating may still be in the queue
+        if movie_rating is None and (self.rating_queue is None or not self.seen.contains(user_id, movie_id)):
             return None
         else:
-            self.db.session.delete(movie_rating)
-            self.db.session.commit()
+            if self.rating_queue is None:
+                self.db.session.delete(movie_rating)
+                self.db.session.commit()
+
+            with self.redis_client.pipeline(transaction=False) as pipe:
+                if self.rating_queue is None:
+                    self.movie_stats.update(movie_id, (movie_rating.rating, movie_rating.is_implicit), None,
+                                            client=pipe)
+                    self.record_changes({user_id: 1}, client=pipe)
+                else:
+                    self.rating_queue.push(user_id, movie_id, delete=True, client=pipe)
 
-            key = f"n_ratings_{user_id}"
-            self.redis_client.decr(key)
+                key = f"n_ratings_{user_id}"
+                pipe.decr(key)
+                self.seen.remove(user_id, movie_id, client=pipe)
+                pipe.execute()
+
+            if self.rating_queue is None:
+                self.refresh_recommendations(user_id)
 
             return user_id, movie_id
 
@@ -155,10 +327,7 @@ def set_movie_watched(self, user_id, movie_id, set_watched=True):
 
         if set_watched:
 
-            key = 'm'+str(movie_id)+"#avg"
-            avg_opt = self.redis_client.get(key)
-
-            implicit_rating = float(avg_opt.decode("utf-8")) if avg_opt is not None else self.default_rating
+            implicit_rating = self.movie_stats.get_avg_ratings([movie_id]).get(movie_id, self.default_rating)
 
             movie_rating = Rating(
                 user_id=user_id,
@@ -167,17 +336,123 @@ def set_movie_watched(self, user_id, movie_id, set_watched=True):
                 is_implicit=True,
                 ts=datetime.now(tz=timezone.utc)
             )
-            self.db.session.merge(movie_rating)
-            self.db.session.commit()
 
-            key = f"n_ratings_{user_id}"
-            self.redis_client.incr(key)
+            self.save_movie_rating(movie_rating)
         else:
             self.delete_movie_rating(user_id, movie_id)
 
         return set_watched
 
-    def get_recommendations(self, user_id):
+    def set_movie_ratings(self, entries, chunk_size=1000):
+        """
+        Bulk version of set_movie_rating and set_movie_watched. The users and the movies are validated with one
+        query each, the implicit ratings of the watched movies are resolved with a single round trip (see
+        MovieStatistics.get_avg_ratings), the ratings are written with one 'INSERT ... ON CONFLICT DO UPDATE'
+        statement per chunk of chunk_size ratings (in a single transaction) and the counters as well as the movie
+        statistics are updated with a single pipeline.
+
+        Since bulk ingestion is meant for importing histories, the recommendations of the users are not refreshed
+        by online fold-in; they are updated by the next re-estimation (which the recorded changes may trigger).
+
+        :param entries: a list of (user_id, movie_id, rating) tuples, where rating is None for a watched movie
+        :return: a tuple of the number of inserted ratings, the number of updated ratings and the indices
+                 of the rejected entries (i.e., having an invalid rating or a non-existing user or movie)
+        """
+        self.logger.debug(f"Setting {len(entries)} ratings in bulk")
+
+        user_ids = {user_id for (user_id, _, _) in entries}
+        movie_ids = {movie_id for (_, movie_id, _) in entries}
+
+        existing_user_ids = {user_id for (user_id,) in self.db.session
+                             .query(User.user_id)
+                             .filter(User.user_id.in_(user_ids))} if user_ids else set()
+        existing_movie_ids = {movie_id for (movie_id,) in self.db.session
+                              .query(Movie.movie_id)
+                              .filter(Movie.movie_id.in_(movie_ids))} if movie_ids else set()
+
+        watched_movie_ids = sorted({movie_id for (_, movie_id, rating) in entries
+                                    if rating is None and movie_id in existing_movie_ids})
+        avg_ratings = self.movie_stats.get_avg_ratings(watched_movie_ids)
+
+        ts = datetime.now(tz=timezone.utc)
+
+        # the latest entry of each (user_id, movie_id) wins, since a single statement cannot update a row twice
+        rows = {}
+        rejected = []
+        for i, (user_id, movie_id, rating) in enumerate(entries):
+            if user_id not in existing_user_ids or movie_id not in existing_movie_ids \
+                    or (rating is not None and not 0.5 <= rating <= 5.0):
+                rejected.append(i)
+                continue
+
+            if rating is None:
+                row = {'rating': avg_ratings.get(movie_id, self.default_rating), 'is_implicit': True}
+            else:
+                row = {'rating': self.round_rating(rating), 'is_implicit': False}
+
+            row.update(user_id=user_id, movie_id=movie_id, ts=ts)
+            rows[(user_id, movie_id)] = row
+
+        previous = self.movie_stats.lock_previous_ratings(rows.keys())
+        rows = list(rows.values())
+
+        for start in range(0, len(rows), chunk_size):
+            statement = insert(Rating.__table__).values(rows[start:start + chunk_size])
+            statement = statement.on_conflict_do_update(
+                index_elements=[Rating.user_id, Rating.movie_id],
+                set_={
+                    'rating': statement.excluded.rating,
+                    'is_implicit': statement.excluded.is_implicit,
+                    'ts': statement.excluded.ts
+                })
+            self.db.session.execute(statement)
+
+        self.db.session.commit()
+
+        inserted_user_ids = [row['user_id'] for row in rows if (row['user_id'], row['movie_id']) not in previous]
+
+        with self.redis_client.pipeline(transaction=False) as pipe:
+            for user_id, n_inserted in Counter(inserted_user_ids).items():
+                key = f"n_ratings_{user_id}"
+                pipe.incrby(key, n_inserted)
+            for row in rows:
+                key = (row['user_id'], row['movie_id'])
+                self.seen.add(row['user_id'], row['movie_id'], client=pipe)
+                self.movie_stats.update(row['movie_id'], previous[key][:2] if key in previous else None,
+                                        (row['rating'], row['is_implicit']), client=pipe)
+            self.record_changes(Counter(row['user_id'] for row in rows), client=pipe)
+            pipe.execute()
+
+        return len(inserted_user_ids), len(rows) - len(inserted_user_ids), rejected
+
+    def record_changes(self, user_changes, client=None):
+        """
+        Records the given numbers of changed ratings per user, when the retraining is driven by changes
+
+        :param user_changes: a dictionary with the number of changed ratings of each user
+        :param client: optionally, a pipeline to execute the commands
+        """
+        if self.rating_changes is not None:
+            self.rating_changes.record(user_changes, client=client)
+
+    def refresh_recommendations(self, user_id):
+        """
+        When online fold-in is enabled, recomputes the recommendations of the specified user
+        from his/her current ratings, without waiting for the next periodic re-estimation.
+        The refresh is best-effort: since the rating has already been written, a failure (e.g., of loading
+        the model snapshot or of redis) is only logged and the recommendations are updated by the next
+        re-estimation.
+
+        :param user_id: the id of the user
+        """
+        if self.online_fold_in and self.estimator is not None:
+            self.logger.debug(f"Refreshing recommendations of user with user_id={user_id}")
+            try:
+                self.estimator.refresh_user_recommendations(user_id)
+            except Exception:
+                self.logger.exception(f"Failed to refresh recommendations of user with user_id={user_id}")
+
+    def get_recommendations(self, user_id, fresh=False):
         """
         Gives the estimated recommendations for the specified user. The general idea
         is to provide recommendations that have been calculated by our recommendation
@@ -186,15 +461,21 @@ def get_recommendations(self, user_id):
         Please note that for in situations below:
             (1) We do not have recommendations for the user, due to user cold-start problem.
             (2) The number of recommendations that we have is less than the desired number (top-N),
-            e.g., the user marked that he/she watched or rated one or more movies recently and our
-            recommendation algorithm has not yet executed to give updated recommendations.
+            e.g., the user marked that he/she watched or rated most of the stored candidate movies
+            (see RECOMMENDATION_CANDIDATES_FACTOR) and our recommendation algorithm has not yet
+            executed to give updated recommendations.
 
         This function will give the most popular movies and high-ranked as recommendations to the user.
         That is, movies that the users hasn't seen/ranked yet and have many voters, with top ratings (> 3).
 
 
+        When real-time scoring is requested (fresh=True) or enabled by default, the user is scored at request
+        time against the latest trained model, using his/her current ratings (see Estimator.predict_user_top_n).
+
         :param user_id: the id of the user to make movie recommendations
-        :return: the top-N movie recommendations for the user, if the user exists, otherwise None
+        :param fresh: whether to score the user at request time
+        :return: the top-N movie recommendations (i.e., their serialized JSON) for the user, if the user exists,
+                 otherwise None
         """
         self.logger.debug(f"Getting movie recommendations for user with user_id={user_id}")
 
@@ -202,62 +483,79 @@ def get_recommendations(self, user_id):
         if self.db.session.query(User).get(user_id) is None:
             return None
 
+        # get the pre-calculated candidates and the movies that the user has rated/watched with a single
+        # round trip to redis, the latter is None until the seen sets have been built (see SeenMovies)
+        with self.redis_client.pipeline(transaction=False) as pipe:
+            self.recommendations.get('u'+str(user_id), client=pipe)
+            self.seen.get(user_id, client=pipe)
+            stored_candidates, seen_members = pipe.execute()
+
+        seen_movie_ids = self.seen.parse(seen_members)
+
+        def get_seen_movie_ids(movie_ids=None):
+            """
+            :return: the movies that the user has rated/watched, from redis when the seen sets have been built,
+                     otherwise from the ratings table (optionally, restricted to the given movie ids)
+            """
+            if seen_movie_ids is not None:
+                return seen_movie_ids
+
+            query = self.db.session \
+                .query(Rating.movie_id) \
+                .filter(Rating.user_id == user_id)
+
+            if movie_ids is not None:
+                query = query.filter(Rating.movie_id.in_(movie_ids))
+
+            return {movie_id for (movie_id,) in query}
+
         def get_estimated_recommendations():
             """
             Gives the estimated recommendations for the specified user, if they exist.
-            We also filter the results by what the user has been watched so far. Therefore,
-            if the user watched/rated all the so far recommended movies, the the outcome
-            of this function will be None, otherwise will give the estimated recommendations.
+            The estimator stores a ranked list of candidates that is deeper than top-N, thus we
+            filter out the movies that the user has rated/watched since the list was computed and
+            take the first top-N remaining candidates. If the user watched/rated all the candidates,
+            the outcome of this function will be None, otherwise will give the estimated recommendations.
 
             :return: the estimated recommendations if they exist, otherwise None
             """
 
-            key = 'u'+str(user_id)
-            result = self.redis_client.get(key)
+            if stored_candidates is None:
+                return None
+
+            # get all pre-calculated candidates from redis, in descending order of estimation
+            candidate_movie_ids = self.decode_candidates(stored_candidates)
+
+            # make sure that the do not recommend any recently rated/watched movie
+            top_movie_ids = self.select_unseen(candidate_movie_ids, get_seen_movie_ids(candidate_movie_ids),
+                                               self.top_n)
 
-            if result is None:
+            # If we don't have any recommendation, return None (and thus fall-back to get_avg_recommendations)
+            if len(top_movie_ids) == 0:
                 return None
-            else:
-                result_str = result.decode("utf-8")
-
-                # get all pre-calculated estimated recommendations from redis
-                top_movie_ids = [int(v) for v in result_str.split(";")]
-
-                # make sure that the do not recommend any recently rated/watched movie
-                recs = self.db.session\
-                    .query(Rating.movie_id, Movie) \
-                    .join(Movie, Rating.movie_id == Movie.movie_id) \
-                    .filter(Rating.user_id != user_id) \
-                    .filter(Movie.movie_id.in_(top_movie_ids))\
-                    .limit(self.top_n)\
-                    .all()
-
-                # If we don't have any recommendation, return None (and thus fall-back to get_avg_recommendations)
-                # Otherwise check whether the estimated recommendations are less than self.top_n, due to
-                # recently watched/rated action(s) of the user.
-                #  - In that case, we simply fill the missing values by taking from get_avg_recommendations()
-                #  - otherwise, we just return the estimated recommendations :)
-                if len(recs) == 0:
-                    return None
-                else:
-                    estimated_recs = [m for (_, m) in recs]
 
-                    if len(estimated_recs) < self.top_n:
+            movies = self.get_movies(top_movie_ids)
+            top_movie_ids = [movie_id for movie_id in top_movie_ids if movie_id in movies]
+            estimated_recs = [movies[movie_id] for movie_id in top_movie_ids]
 
-                        self.logger.debug(f"Getting estimated recommendations extended with "
-                                          f"{self.top_n - len(estimated_recs)} average top movie "
-                                          f"recommendations for user with user_id={user_id}")
+            # Only when the user watched/rated almost all the candidates, the estimated recommendations
+            # are less than self.top_n. In that case, we simply fill the missing values by taking from
+            # get_avg_recommendations()
+            if len(estimated_recs) < self.top_n:
 
-                        exclude_ids = [m.movie_id for m in estimated_recs]
+                self.logger.debug(f"Getting estimated recommendations extended with "
+                                  f"{self.top_n - len(estimated_recs)} average top movie "
+                                  f"recommendations for user with user_id={user_id}")
 
-                        additional_recs = get_avg_recommendations(
-                            limit=self.top_n - len(estimated_recs),
-                            exclude_movie_ids=exclude_ids
-                        )
-                        return estimated_recs.extend(additional_recs)
-                    else:
-                        self.logger.debug(f"Getting estimated recommendations extended user with user_id={user_id}")
-                        return estimated_recs
+                additional_recs = get_avg_recommendations(
+                    limit=self.top_n - len(estimated_recs),
+                    exclude_movie_ids=top_movie_ids
+                )
+                estimated_recs.extend(additional_recs)
+            else:
+                self.logger.debug(f"Getting estimated recommendations for user with user_id={user_id}")
+
+            return estimated_recs
 
         def get_avg_recommendations(limit=self.top_n, exclude_movie_ids=None):
             """
@@ -272,6 +570,17 @@ def get_avg_recommendations(limit=self.top_n, exclude_movie_ids=None):
                               f"for user with user_id={user_id}, limit={limit} "
                               f"and exclude_movie_ids={exclude_movie_ids}")
 
+            ranking = self.popularity.get(self.default_rating)
+
+            if ranking is not None:
+                # slice the precomputed popularity ranking, excluding the movies that the user has rated/watched
+                top_movie_ids = self.select_popular(ranking, list(get_seen_movie_ids()) + list(exclude_movie_ids or []),
+                                                    limit)
+
+                movies = self.get_movies(top_movie_ids)
+
+                return [movies[movie_id] for movie_id in top_movie_ids if movie_id in movies]
+
             # Get the movie_ids that the user has rated or watched, in order
             # to exclude them later
             q_user_rated_movies = self.db.session \
@@ -279,49 +588,170 @@ def get_avg_recommendations(limit=self.top_n, exclude_movie_ids=None):
                 .filter(Rating.user_id == user_id) \
                 .subquery()
 
-            # aggregation function for computing the average ratings of a movie
-            avg_ratings = func.avg(Rating.rating).label("avg_ratings")
-
-            # aggregation function for computing the total number of users that reated/watched a movie
-            count_users = func.count(Rating.user_id).label("count_users")
+            top_rated = self.top_movies_query(self.default_rating).subquery()
 
             # Query for calculating the top movies w.r.t count_users and avg_ratings
             # therefore, we would like to have on a higher rank the movies having the
             # the greatest number of users and at the same time the highest possible rank
             q_top_movies = self.db.session \
-                .query(avg_ratings, count_users, Rating.movie_id, Movie) \
-                .join(Movie, Rating.movie_id == Movie.movie_id) \
-                .filter(Rating.rating >= self.default_rating) \
-                .group_by(Rating.movie_id, Movie) \
-                .order_by(func.count(Rating.user_id).desc(), func.avg(Rating.rating).desc())
+                .query(top_rated.c.avg_ratings, top_rated.c.count_users, top_rated.c.movie_id, Movie) \
+                .join(Movie, top_rated.c.movie_id == Movie.movie_id) \
+                .order_by(top_rated.c.count_users.desc(), top_rated.c.avg_ratings.desc())
 
             # exclude movie ids from exclude_movie_ids, when is set
-            q_top_movies if exclude_movie_ids is None else q_top_movies.filter(~Rating.movie_id.in_(exclude_movie_ids))
+            if exclude_movie_ids:
+                q_top_movies = q_top_movies.filter(~top_rated.c.movie_id.in_(exclude_movie_ids))
 
             # compute the actual query, with is composed of the previous ones,
             # filter out movies that the user watched and limit the results to the
             # desired top-N number of movies
             resulting_recommendations = q_top_movies\
-                .outerjoin(q_user_rated_movies, Rating.movie_id == q_user_rated_movies.c.movie_id) \
+                .outerjoin(q_user_rated_movies, top_rated.c.movie_id == q_user_rated_movies.c.movie_id) \
                 .filter(q_user_rated_movies.c.movie_id.is_(None))\
                 .limit(limit)
 
             recs = [m for (_, _, _, m) in resulting_recommendations]
-            return recs
+            movies = self.movies.put(recs)
+            return [movies[m.movie_id] for m in recs]
+
+        def get_realtime_recommendations():
+            """
+            Scores the user at request time against the latest trained model.
+
+            :return: the real-time recommendations if they can be computed, otherwise None
+            """
+            user_predictions = self.estimator.predict_user_top_n(
+                user_id, self.top_n, exclude_movie_ids=() if seen_movie_ids is None else seen_movie_ids)
+
+            if user_predictions is None or len(user_predictions) == 0:
+                return None
+
+            self.logger.debug(f"Getting real-time recommendations for user with user_id={user_id}")
+
+            top_movie_ids = [movie_id for (movie_id, _) in user_predictions]
+            movies = self.get_movies(top_movie_ids)
 
-        resulting_movies = get_estimated_recommendations()
+            return [movies[movie_id] for movie_id in top_movie_ids if movie_id in movies]
+
+        if (fresh or self.realtime) and self.estimator is not None:
+            resulting_movies = get_realtime_recommendations()
+        else:
+            resulting_movies = None
+
+        if resulting_movies is None:
+            resulting_movies = get_estimated_recommendations()
 
         return get_avg_recommendations() if resulting_movies is None else resulting_movies
 
     @staticmethod
-    def convert_user_ratings(user_ratings):
+    def decode_candidates(stored_candidates):
+        """
+        :param stored_candidates: the stored candidates of a user (see Estimator), or None
+        :return: the list of the candidate movie ids, in descending order of estimation
+        """
+        if stored_candidates is None:
+            return []
+
+        candidate_movie_ids, _ = decode_recommendations(stored_candidates)
+
+        return candidate_movie_ids.tolist()
+
+    @staticmethod
+    def select_unseen(movie_ids, seen_movie_ids, limit):
+        """
+        :return: the first limit of the given movie ids that the user has not rated/watched
+        """
+        return [movie_id for movie_id in movie_ids if movie_id not in seen_movie_ids][:limit]
+
+    @staticmethod
+    def select_popular(ranking, excluded_movie_ids, limit):
+        """
+        :param ranking: a precomputed popularity ranking (see PopularityCache)
+        :param excluded_movie_ids: the movies to exclude, e.g., the ones that the user has rated/watched
+        :param limit: the number of movies
+        :return: the first limit movie ids of the ranking that are not excluded
+        """
+        # at most len(excluded_movie_ids) of the first movies can be excluded
+        ranked_movie_ids = ranking[0][:limit + len(excluded_movie_ids)]
+
+        return ranked_movie_ids[~np.isin(ranked_movie_ids, excluded_movie_ids)][:limit].tolist()
+
+    def get_batch_recommendations(self, user_ids, chunk_size=500):
+        """
+        Gives the recommendations of many users, in chunks of chunk_size users. For each chunk, the existence of the
+        users is checked with a single query, the stored candidates and the seen sets of all users are fetched with
+        a single round trip to redis and the union of the resulting movies is loaded once (see get_movies). The
+        missing recommendations are filled from the precomputed popularity ranking (see get_recommendations).
+        Users whose recommendations cannot be computed in memory (e.g., before the seen sets or the popularity
+        rankings are built) fall back to get_recommendations. When real-time scoring is enabled by default, every
+        user is scored at request time by get_recommendations, as for a single user.
+
+        :param user_ids: the ids of the users
+        :param chunk_size: the number of users that are processed together
+        :return: a generator of (user_id, recommendations) pairs, in the order of user_ids, where recommendations
+                 are the serialized JSON of the movies, or None when the user does not exist
+        """
+        ranking = self.popularity.get(self.default_rating)
+
+        for start in range(0, len(user_ids), chunk_size):
+            chunk = user_ids[start:start + chunk_size]
+
+            self.logger.debug(f"Getting movie recommendations for {len(chunk)} users")
+
+            existing_user_ids = {user_id for (user_id,) in self.db.session
+                                 .query(User.user_id)
+                                 .filter(User.user_id.in_(chunk))}
+            users = [user_id for user_id in chunk if user_id in existing_user_ids]
+
+            if self.realtime and self.estimator is not None:
+                for user_id in chunk:
+                    yield user_id, self.get_recommendations(user_id) if user_id in existing_user_ids else None
+                continue
+
+            with self.redis_client.pipeline(transaction=False) as pipe:
+                for user_id in users:
+                    self.recommendations.get('u'+str(user_id), client=pipe)
+                    self.seen.get(user_id, client=pipe)
+                results = pipe.execute()
+
+            top_movie_ids = {}
+            for user_id, stored_candidates, seen_members in zip(users, results[0::2], results[1::2]):
+                seen_movie_ids = self.seen.parse(seen_members)
+
+                if seen_movie_ids is None:
+                    continue
+
+                movie_ids = self.select_unseen(self.decode_candidates(stored_candidates), seen_movie_ids, self.top_n)
+
+                if len(movie_ids) < self.top_n:
+                    if ranking is None:
+                        continue
+
+                    movie_ids.extend(self.select_popular(ranking, list(seen_movie_ids) + movie_ids,
+                                                         self.top_n - len(movie_ids)))
+
+                top_movie_ids[user_id] = movie_ids
+
+            movies = self.get_movies(list({movie_id for movie_ids in top_movie_ids.values() for movie_id in movie_ids}))
+
+            for user_id in chunk:
+                if user_id not in existing_user_ids:
+                    yield user_id, None
+                elif user_id in top_movie_ids:
+                    yield user_id, [movies[movie_id] for movie_id in top_movie_ids[user_id] if movie_id in movies]
+                else:
+                    yield user_id, self.get_recommendations(user_id)
+
+    def convert_user_ratings(self, user_ratings):
+        movies = self.get_movies([r.movie_id for r in user_ratings])
+
         result = [
             {
                 'is_implicit': r.is_implicit,
                 'rating': str(r.rating),
                 'ts': str(r.ts),
-                'movie': movie_schema.dump(m).data
-            } for (r, m) in user_ratings
+                'movie': movies[r.movie_id]
+            } for r in user_ratings if r.movie_id in movies
         ]
 
         return result
@@ -0,0 +1,38 @@
+# -*- coding: utf-8 -*-
+import json
+from flask import Response
+
+
+class RawJSON(bytes):
+    """
+    An already serialized JSON value, which is spliced as-is into the resulting JSON documents
+    """
+    pass
+
+
+def encode(value):
+    """
+    Serializes the given value to compact JSON (with sorted keys, as jsonify does), splicing any RawJSON fragment
+
+    :return: the JSON document as bytes
+    """
+    if isinstance(value, RawJSON):
+        return bytes(value)
+    elif isinstance(value, dict):
+        return b'{' + b','.join(json.dumps(str(k)).encode('utf-8') + b':' + encode(v)
+                                for k, v in sorted(value.items(), key=lambda kv: str(kv[0]))) + b'}'
+    elif isinstance(value, (list, tuple)):
+        return b'[' + b','.join(encode(v) for v in value) + b']'
+    else:
+        return json.dumps(value, separators=(',', ':')).encode('utf-8')
+
+
+def dumps(value):
+    return RawJSON(encode(value))
+
+
+def json_response(value):
+    """
+    Like jsonify, but the given value may contain pre-serialized RawJSON fragments
+    """
+    return Response(encode(value) + b'\n', mimetype='application/json')
@@ -0,0 +1,125 @@
+# -*- coding: utf-8 -*-
+import logging
+import os
+import socket
+import threading
+import uuid
+import redis
+
+
+class LeadershipLost(Exception):
+    """
+    Raised when an instance is found to be no longer the leader, e.g., in the middle of a long job
+    """
+    pass
+
+
+class LeaderElection:
+    """
+    Leader election among processes (e.g., trainer instances) using a lock in redis: the leader holds the key
+    'leader:<name>' with its identity and a time-to-live, which it renews every ttl / 3 seconds. When the leader
+    dies, the key expires and another instance takes over.
+
+    Since the leadership may be lost in the middle of a long job (e.g., when the leader stalls for longer than the
+    time-to-live), such jobs should check it between their stages (see check), while their final writes should be
+    fenced by the lock (see fence), i.e., applied atomically only when the lock is still held by this instance.
+    """
+
+    log = logging.getLogger(__name__)
+
+    # Renews the lock, only when it is held by the given identity
+    RENEW_SCRIPT = """
+        if redis.call('GET', KEYS[1]) == ARGV[1] then
+            return redis.call('PEXPIRE', KEYS[1], ARGV[2])
+        else
+            return 0
+        end
+    """
+
+    # Releases the lock, only when it is held by the given identity
+    RELEASE_SCRIPT = """
+        if redis.call('GET', KEYS[1]) == ARGV[1] then
+            return redis.call('DEL', KEYS[1])
+        else
+            return 0
+        end
+    """
+
+    def __init__(self, redis_pool, name, ttl):
+        """
+        :param redis_pool: the redis connection pool
+        :param name: the name of the election
+        :param ttl: the time-to-live of the leadership in seconds
+        """
+        self.redis_client = redis.Redis(connection_pool=redis_pool)
+        self.key = f'leader:{name}'
+        self.ttl_millis = int(ttl * 1000)
+        self.identity = f'{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex}'
+        self.is_leader = False
+
+        self._renew_script = self.redis_client.register_script(self.RENEW_SCRIPT)
+        self._release_script = self.redis_client.register_script(self.RELEASE_SCRIPT)
+        self._stopped = threading.Event()
+
+    def campaign(self):
+        """
+        Acquires or renews the leadership
+
+        :return: whether this instance is the leader
+        """
+        try:
+            if self.is_leader:
+                leader = self._renew_script(keys=[self.key], args=[self.identity, self.ttl_millis]) == 1
+            else:
+                leader = self.redis_client.set(self.key, self.identity, px=self.ttl_millis, nx=True) is True
+        except redis.RedisError:
+            self.log.exception(f"Failed to campaign for '{self.key}'")
+            leader = False
+
+        if leader != self.is_leader:
+            self.log.info(f"Instance {self.identity} {'became' if leader else 'is no longer'} the leader "
+                          f"of '{self.key}'")
+
+        self.is_leader = leader
+
+        return leader
+
+    @property
+    def fence(self):
+        """
+        :return: the (key, value) pair that holds in redis as long as this instance is the leader
+        """
+        return self.key, self.identity
+
+    def check(self):
+        """
+        Renews the leadership, raising LeadershipLost when this instance is no longer the leader
+        """
+        if not self.is_leader or not self.campaign():
+            raise LeadershipLost(f"Instance {self.identity} is no longer the leader of '{self.key}'")
+
+    def _run(self):
+        while not self._stopped.is_set():
+            self.campaign()
+            self._stopped.wait(self.ttl_millis / 3000)
+
+    def start(self):
+        """
+        Campaigns for the leadership in a background thread
+        """
+        self.campaign()
+
+        thread = threading.Thread(target=self._run, name=f"campaign-{self.key}", daemon=True)
+        thread.start()
+
+        return thread
+
+    def stop(self):
+        """
+        Stops campaigning and releases the leadership, if held
+        """
+        self._stopped.set()
+
+        if self.is_leader:
+            self._release_script(keys=[self.key], args=[self.identity])
+            self.is_leader = False
@@ -11,8 +11,14 @@ class Rating(db.Model):
     rating = db.Column(db.Float, nullable=True)
     is_implicit = db.Column(db.Boolean, nullable=False, default=False)
     ts = db.Column(db.TIMESTAMP(timezone=True),
-                   nullable=True,
+                   nullable=False,
                    default=datetime.now(tz=timezone.utc))
+    # the time that the rating has been written to the database, which sets it
+    # (see prototype/migrations/005_ratings_written_at.sql)
+    written_at = db.Column(db.TIMESTAMP(timezone=True),
+                           nullable=False,
+                           server_default=db.func.now(),
+                           onupdate=db.func.now())
 
     def __repr__(self):
         return f'<Rating(user_id={self.user_id},' \
@@ -22,9 +28,24 @@ def __repr__(self):
                f'ts={self.ts})>'
 
 
+class RatingDeletion(db.Model):
+    __tablename__ = 'recommendation_ratings_deletions'
+
+    id = db.Column(db.BigInteger, primary_key=True)
+    user_id = db.Column(db.Integer, nullable=False)
+    movie_id = db.Column(db.Integer, nullable=False)
+    deleted_at = db.Column(db.TIMESTAMP(timezone=True), nullable=False)
+
+    def __repr__(self):
+        return f'<RatingDeletion(user_id={self.user_id},' \
+               f'movie_id={self.movie_id},' \
+               f'deleted_at={self.deleted_at})>'
+
+
 class RatingSchema(ma.ModelSchema):
     class Meta:
         model = Rating
+        exclude = ('written_at',)
 
 
 rating_schema = RatingSchema()
@@ -76,3 +97,21 @@ class Meta:
 
 movie_schema = MovieSchema()
 
+
+class MoviePopularity(db.Model):
+    """
+    The materialized view of the votes and the average rating of each movie, for each half-star rating limit in
+    POPULARITY_THRESHOLDS (see prototype/migrations/004_movie_popularity_view.sql)
+    """
+    __tablename__ = 'recommendation_movie_popularity'
+
+    threshold = db.Column(db.Float, primary_key=True)
+    movie_id = db.Column(db.Integer, primary_key=True)
+    votes = db.Column(db.BigInteger, nullable=False)
+    avg_rating = db.Column(db.Float, nullable=False)
+
+    def __repr__(self):
+        return f'<MoviePopularity(threshold={self.threshold},' \
+               f'movie_id={self.movie_id},' \
+               f'votes={self.votes},' \
+               f'avg_rating={self.avg_rating})>'
@@ -0,0 +1,95 @@
+# -*- coding: utf-8 -*-
+import logging
+import threading
+import time
+import redis
+from collections import OrderedDict
+from app.models import Movie, movie_schema
+from app.json_fragments import dumps
+
+
+class MovieCatalogCache:
+    """
+    Read-through, in-process cache of the movie catalog, which keeps the serialized JSON of each movie (see
+    movie_schema) indexed by movie id. Thus, responses splice the cached fragments instead of loading and
+    serializing the movies on every request.
+
+    The cache holds at most max_size movies, evicting the least recently used ones. It is cleared when the catalog
+    version changes, i.e., whoever modifies the movies table should increment the redis key 'movies:version'. The
+    version is checked at most every version_check_interval seconds.
+    """
+
+    log = logging.getLogger(__name__)
+
+    VERSION_KEY = 'movies:version'
+
+    def __init__(self, db, redis_pool, max_size, version_check_interval):
+        self.db = db
+        self.redis_client = redis.Redis(connection_pool=redis_pool)
+        self.max_size = max_size
+        self.version_check_interval = version_check_interval
+
+        self._lock = threading.Lock()
+        self._fragments = OrderedDict()
+        self._version = None
+        self._version_checked = 0
+
+    def _check_version(self):
+        now = time.time()
+        if now - self._version_checked < self.version_check_interval:
+            return
+
+        version = self.redis_client.get(self.VERSION_KEY)
+
+        with self._lock:
+            self._version_checked = now
+            if version != self._version:
+                self.log.debug(f"Movie catalog version changed from {self._version} to {version}, "
+                               f"clearing {len(self._fragments)} cached movies")
+                self._fragments.clear()
+                self._version = version
+
+    def _add(self, movies):
+        fragments = {m.movie_id: dumps(movie_schema.dump(m).data) for m in movies}
+
+        with self._lock:
+            self._fragments.update(fragments)
+            while len(self._fragments) > self.max_size:
+                self._fragments.popitem(last=False)
+
+        return fragments
+
+    def put(self, movies):
+        """
+        Caches the given (already loaded) movies
+
+        :param movies: an iterable of Movie
+        :return: a dictionary of the movie ids to their JSON fragments
+        """
+        return self._add(list(movies))
+
+    def get(self, movie_ids):
+        """
+        Gives the JSON fragments of the specified movies, the missing ones are loaded with a single query
+
+        :param movie_ids: the movie ids
+        :return: a dictionary of the movie ids to their JSON fragments, the ids of non-existing movies are omitted
+        """
+        self._check_version()
+
+        fragments = {}
+        missing_movie_ids = []
+
+        with self._lock:
+            for movie_id in movie_ids:
+                fragment = self._fragments.get(movie_id)
+                if fragment is None:
+                    missing_movie_ids.append(movie_id)
+                else:
+                    self._fragments.move_to_end(movie_id)
+                    fragments[movie_id] = fragment
+
+        if len(missing_movie_ids) > 0:
+            fragments.update(self._add(self.db.session.query(Movie).filter(Movie.movie_id.in_(missing_movie_ids))))
+
+        return fragments
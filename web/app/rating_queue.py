@@ -0,0 +1,272 @@
+# -*- coding: utf-8 -*-
+import json
+import logging
+import time
+import redis
+from collections import Counter
+from datetime import datetime, timezone
+from app.models import Rating
+from sqlalchemy import and_, or_
+from sqlalchemy.dialects.postgresql import insert
+
+
+class RatingEventQueue:
+    """
+    Write-behind queue of rating events (i.e., set and delete of ratings/watched movies), which is kept in a redis
+    list. Requests only push their events to the queue, while a flusher periodically writes them to PostgreSQL in
+    large batches: the events of each batch are coalesced per (user_id, movie_id), keeping the latest one, and are
+    written with one upsert and one delete statement in a single transaction.
+
+    A batch is atomically moved to a processing list before being written and it is removed only after the
+    transaction commits, thus a batch that is interrupted (e.g., by a crash) is written again by the next flush.
+    Since rows are only overwritten by newer events, writing a batch again is harmless. The queue is as durable as
+    redis is (i.e., append-only file should be enabled).
+    """
+
+    log = logging.getLogger(__name__)
+
+    QUEUE_KEY = 'ratings:queue'
+    PROCESSING_KEY = 'ratings:queue:processing'
+    LOCK_KEY = 'ratings:queue:lock'
+    STATS_KEY = 'ratings:queue:stats'
+
+    # Moves at most ARGV[1] of the oldest events from the queue to the processing list
+    MOVE_SCRIPT = """
+        local unpack = unpack or table.unpack
+        local events = redis.call('LRANGE', KEYS[1], -tonumber(ARGV[1]), -1)
+        if #events > 0 then
+            redis.call('LTRIM', KEYS[1], 0, -#events - 1)
+            for i = 1, #events, 1000 do
+                redis.call('RPUSH', KEYS[2], unpack(events, i, math.min(i + 999, #events)))
+            end
+        end
+        return #events
+    """
+
+    def __init__(self, db, redis_pool, flush_size, flush_interval, movie_stats, on_flush=None, rating_changes=None):
+        """
+        :param db: the database
+        :param redis_pool: the redis connection pool
+        :param flush_size: the maximum number of events that are written with a single transaction
+        :param flush_interval: the interval of flushing in seconds
+        :param movie_stats: the MovieStatistics to update with the changes of the written ratings
+        :param on_flush: optionally, a function that is called with the ids of the users whose events have been
+                         written by a flush
+        :param rating_changes: optionally, the RatingChanges to record the written ratings to
+        """
+        self.db = db
+        self.redis_client = redis.Redis(connection_pool=redis_pool)
+        self.flush_size = flush_size
+        self.flush_interval = flush_interval
+        self.movie_stats = movie_stats
+        self.on_flush = on_flush
+        self.rating_changes = rating_changes
+        self._move_script = self.redis_client.register_script(self.MOVE_SCRIPT)
+
+    def push(self, user_id, movie_id, rating=None, is_implicit=False, delete=False, ts=None, client=None):
+        """
+        Pushes a rating event to the queue
+
+        :param delete: whether the rating is deleted, otherwise it is set
+        :param ts: the time of the event, default is now
+        :param client: optionally, a pipeline to execute the command
+        """
+        ts = datetime.now(tz=timezone.utc) if ts is None else ts
+
+        event = json.dumps({
+            'u': user_id,
+            'm': movie_id,
+            'r': rating,
+            'i': is_implicit,
+            'd': delete,
+            'ts': ts.timestamp()
+        })
+
+        (self.redis_client if client is None else client).lpush(self.QUEUE_KEY, event)
+
+    def lag(self):
+        """
+        :return: a dictionary with the number of queued events, the age in seconds of the oldest queued event and
+                 the statistics of the latest flush
+        """
+        with self.redis_client.pipeline(transaction=False) as pipe:
+            pipe.llen(self.QUEUE_KEY)
+            pipe.llen(self.PROCESSING_KEY)
+            pipe.lindex(self.QUEUE_KEY, -1)
+            pipe.hgetall(self.STATS_KEY)
+            queued, processing, oldest, stats = pipe.execute()
+
+        return {
+            'queued_events': queued,
+            'processing_events': processing,
+            'oldest_event_age_seconds': 0.0 if oldest is None else time.time() - json.loads(oldest)['ts'],
+            'last_flush': {k.decode('utf-8'): float(v) for k, v in stats.items()}
+        }
+
+    def wait_written(self, since, timeout):
+        """
+        Waits until the events that have been pushed before the given time are written to the database
+
+        :param since: the time in seconds since the epoch
+        :param timeout: the maximum time to wait in seconds
+        :return: whether the events have been written
+        """
+        deadline = time.time() + timeout
+        while True:
+            with self.redis_client.pipeline(transaction=False) as pipe:
+                pipe.llen(self.PROCESSING_KEY)
+                pipe.lindex(self.QUEUE_KEY, -1)
+                processing, oldest = pipe.execute()
+
+            if processing == 0 and (oldest is None or json.loads(oldest)['ts'] >= since):
+                return True
+            if time.time() >= deadline:
+                return False
+
+            time.sleep(min(self.flush_interval, 1))
+
+    @staticmethod
+    def coalesce(events):
+        """
+        :return: the latest event of each (user_id, movie_id), in a dictionary keyed by (user_id, movie_id)
+        """
+        latest = {}
+        for event in events:
+            key = (event['u'], event['m'])
+            if key not in latest or latest[key]['ts'] <= event['ts']:
+                latest[key] = event
+
+        return latest
+
+    @staticmethod
+    def changes(latest, previous):
+        """
+        Gives the changes of the ratings that the given events make. An event changes a rating only when it is newer
+        than it (see _write), while a rating without ts is older than any event.
+
+        :param latest: the latest event of each (user_id, movie_id), see coalesce
+        :param previous: the current ratings, see MovieStatistics.lock_previous_ratings
+        :return: a list of (movie_id, previous, current) tuples, where previous and current are (rating, is_implicit)
+                 pairs or None
+        """
+        changes = []
+        for key, e in latest.items():
+            current = None if e['d'] else (e['r'], e['i'])
+            if key not in previous:
+                changes.append((e['m'], None, current))
+            elif previous[key][2] is None or previous[key][2] <= datetime.fromtimestamp(e['ts'], tz=timezone.utc):
+                changes.append((e['m'], previous[key][:2], current))
+
+        return changes
+
+    def _write(self, events):
+        latest = self.coalesce(events)
+
+        changes = self.changes(latest, self.movie_stats.lock_previous_ratings(latest.keys()))
+
+        upserts = [{
+            'user_id': e['u'],
+            'movie_id': e['m'],
+            'rating': e['r'],
+            'is_implicit': e['i'],
+            'ts': datetime.fromtimestamp(e['ts'], tz=timezone.utc)
+        } for e in latest.values() if not e['d']]
+
+        deletions = [e for e in latest.values() if e['d']]
+
+        if len(upserts) > 0:
+            statement = insert(Rating.__table__).values(upserts)
+            statement = statement.on_conflict_do_update(
+                index_elements=[Rating.user_id, Rating.movie_id],
+                set_={
+                    'rating': statement.excluded.rating,
+                    'is_implicit': statement.excluded.is_implicit,
+                    'ts': statement.excluded.ts
+                },
+                where=or_(Rating.ts.is_(None), Rating.ts <= statement.excluded.ts))
+            self.db.session.execute(statement)
+
+        # a deletion removes only a rating that is older than it, i.e., that it has seen (or that has no ts)
+        if len(deletions) > 0:
+            self.db.session \
+                .query(Rating) \
+                .filter(or_(*[and_(Rating.user_id == e['u'],
+                                   Rating.movie_id == e['m'],
+                                   or_(Rating.ts.is_(None),
+                                       Rating.ts <= datetime.fromtimestamp(e['ts'], tz=timezone.utc)))
+                              for e in deletions])) \
+                .delete(synchronize_session=False)
+
+        self.db.session.commit()
+
+        return latest, changes
+
+    def _flush_batch(self):
+        start_time = time.time()
+
+        # first retry any batch that has been interrupted, otherwise move the next batch to the processing list
+        if self.redis_client.llen(self.PROCESSING_KEY) == 0:
+            self._move_script(keys=[self.QUEUE_KEY, self.PROCESSING_KEY], args=[self.flush_size])
+
+        # the queue (and thus the processing list) has the newest events first
+        events = [json.loads(event) for event in reversed(self.redis_client.lrange(self.PROCESSING_KEY, 0, -1))]
+
+        if len(events) == 0:
+            return 0
+
+        try:
+            latest, changes = self._write(events)
+        except Exception:
+            self.db.session.rollback()
+            raise
+
+        end_time = time.time()
+
+        with self.redis_client.pipeline(transaction=False) as pipe:
+            pipe.delete(self.PROCESSING_KEY)
+            for movie_id, previous, current in changes:
+                self.movie_stats.update(movie_id, previous, current, client=pipe)
+            if self.rating_changes is not None:
+                self.rating_changes.record(Counter(user_id for (user_id, _) in latest), client=pipe)
+            pipe.hmset(self.STATS_KEY, {
+                'events': len(events),
+                'rows': len(latest),
+                'duration_seconds': end_time - start_time,
+                'ts': end_time
+            })
+            pipe.execute()
+
+        self.log.debug(f'Time spend writing {len(events)} queued rating events as {len(latest)} rows: '
+                       f'{end_time - start_time} seconds')
+
+        if self.on_flush is not None:
+            self.on_flush({user_id for (user_id, _) in latest})
+
+        return len(events)
+
+    def flush(self):
+        """
+        Writes all queued events to the database, in batches of at most self.flush_size events. Only one flusher
+        runs at a time (across processes), the others return immediately.
+
+        :return: the number of written events
+        """
+        lock = self.redis_client.lock(self.LOCK_KEY, timeout=max(60, 10 * self.flush_interval))
+
+        if not lock.acquire(blocking=False):
+            return 0
+
+        counter = 0
+        try:
+            while True:
+                flushed = self._flush_batch()
+                counter += flushed
+                if flushed < self.flush_size:
+                    break
+        finally:
+            lock.release()
+
+        if counter > 0:
+            self.log.info(f'Total {counter} queued rating events have been written, lag: {self.lag()}')
+
+        return counter
@@ -0,0 +1,140 @@
+# -*- coding: utf-8 -*-
+import logging
+import time
+import redis
+
+
+class RatingChanges:
+    """
+    Journal of the rating changes since the latest re-estimation, which is kept in redis and drives the retraining
+    of the trainer process (instead of a fixed interval). It consists of:
+
+      - 'changes:ratings', the number of changed ratings,
+      - 'changes:users:hll', a HyperLogLog of the users whose ratings have changed (i.e., an approximate count
+        with constant memory),
+      - 'changes:users', the set of the users whose recommendations are stale, which is also consumed by the
+        per-user refresh of the recommendations (see take_stale_users).
+
+    A re-estimation first moves the journal to the ':processing' keys (see begin_recompute), thus the changes that
+    happen while training count towards the next re-estimation. The processing keys are removed when the
+    re-estimation succeeds, otherwise they are merged with the journal again by the next one.
+    """
+
+    log = logging.getLogger(__name__)
+
+    RATINGS_KEY = 'changes:ratings'
+    USERS_HLL_KEY = 'changes:users:hll'
+    USERS_KEY = 'changes:users'
+    PROCESSING_SUFFIX = ':processing'
+    LAST_RECOMPUTE_KEY = 'changes:last_recompute'
+
+    # Moves the journal (KEYS[1], KEYS[3], KEYS[5]) to the processing keys (KEYS[2], KEYS[4], KEYS[6]), merging it
+    # with the ones of an interrupted re-estimation
+    BEGIN_SCRIPT = """
+        local count = tonumber(redis.call('GET', KEYS[1]) or '0')
+        if count > 0 then
+            redis.call('INCRBY', KEYS[2], count)
+        end
+        if redis.call('EXISTS', KEYS[3]) == 1 then
+            redis.call('PFMERGE', KEYS[4], KEYS[4], KEYS[3])
+        end
+        if redis.call('EXISTS', KEYS[5]) == 1 then
+            redis.call('SUNIONSTORE', KEYS[6], KEYS[6], KEYS[5])
+        end
+        redis.call('DEL', KEYS[1], KEYS[3], KEYS[5])
+        return tonumber(redis.call('GET', KEYS[2]) or '0')
+    """
+
+    # Removes and gives all the stale users, unless they are more than ARGV[1]
+    TAKE_SCRIPT = """
+        if redis.call('SCARD', KEYS[1]) > tonumber(ARGV[1]) then
+            return false
+        end
+        local members = redis.call('SMEMBERS', KEYS[1])
+        redis.call('DEL', KEYS[1])
+        return members
+    """
+
+    def __init__(self, redis_pool):
+        self.redis_client = redis.Redis(connection_pool=redis_pool)
+        self._begin_script = self.redis_client.register_script(self.BEGIN_SCRIPT)
+        self._take_script = self.redis_client.register_script(self.TAKE_SCRIPT)
+
+    def _keys(self):
+        return [key
+                for journal_key in (self.RATINGS_KEY, self.USERS_HLL_KEY, self.USERS_KEY)
+                for key in (journal_key, journal_key + self.PROCESSING_SUFFIX)]
+
+    def record(self, user_changes, client=None):
+        """
+        Records changed ratings
+
+        :param user_changes: a dictionary with the number of changed ratings of each user
+        :param client: optionally, a pipeline to execute the commands
+        """
+        user_changes = {user_id: n for user_id, n in user_changes.items() if n > 0}
+
+        if len(user_changes) == 0:
+            return
+
+        pipe = self.redis_client.pipeline(transaction=False) if client is None else client
+        pipe.incrby(self.RATINGS_KEY, sum(user_changes.values()))
+        pipe.pfadd(self.USERS_HLL_KEY, *user_changes.keys())
+        pipe.sadd(self.USERS_KEY, *user_changes.keys())
+
+        if client is None:
+            pipe.execute()
+
+    def pending(self):
+        """
+        :return: a tuple of the number of changed ratings, the (approximate) number of users with changed ratings,
+                 the number of users with stale recommendations and the seconds since the latest re-estimation
+                 (None when there is none yet)
+        """
+        with self.redis_client.pipeline(transaction=False) as pipe:
+            pipe.mget(self.RATINGS_KEY, self.RATINGS_KEY + self.PROCESSING_SUFFIX)
+            pipe.pfcount(self.USERS_HLL_KEY, self.USERS_HLL_KEY + self.PROCESSING_SUFFIX)
+            pipe.scard(self.USERS_KEY)
+            pipe.get(self.LAST_RECOMPUTE_KEY)
+            ratings, users, stale_users, last_recompute = pipe.execute()
+
+        return (sum(int(count) for count in ratings if count is not None),
+                users,
+                stale_users,
+                None if last_recompute is None else time.time() - float(last_recompute))
+
+    def begin_recompute(self):
+        """
+        Starts a re-estimation, which covers all changes that have been recorded so far
+
+        :return: the number of changed ratings that the re-estimation covers
+        """
+        return self._begin_script(keys=self._keys())
+
+    def end_recompute(self):
+        """
+        Completes a successful re-estimation
+        """
+        with self.redis_client.pipeline(transaction=True) as pipe:
+            pipe.delete(*[key for key in self._keys() if key.endswith(self.PROCESSING_SUFFIX)])
+            pipe.set(self.LAST_RECOMPUTE_KEY, time.time())
+            pipe.execute()
+
+    def take_stale_users(self, limit):
+        """
+        Removes the users with stale recommendations from the journal (in order to refresh them), unless they
+        are too many.
+
+        :param limit: the maximum number of users to take
+        :return: the list of user ids, or None when they are more than limit
+        """
+        members = self._take_script(keys=[self.USERS_KEY], args=[limit])
+
+        return None if members is None else [int(user_id) for user_id in members]
+
+    def restore_stale_users(self, user_ids):
+        """
+        Adds back users that have been taken, e.g., when refreshing their recommendations has failed
+        """
+        if len(user_ids) > 0:
+            self.redis_client.sadd(self.USERS_KEY, *user_ids)
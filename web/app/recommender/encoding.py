@@ -0,0 +1,115 @@
+# -*- coding: utf-8 -*-
+import struct
+import numpy as np
+
+# Binary format of the recommendations of a user:
+#   header: magic (2 bytes), format version (uint8), score type (uint8), number of movies n (uint32)
+#   body:   n movie ids (little-endian int32), followed by n scores (little-endian float16 or float32)
+MAGIC = b'MR'
+FORMAT_VERSION = 1
+HEADER = struct.Struct('<2sBBI')
+
+SCORE_TYPES = {
+    1: np.dtype('<f2'),
+    2: np.dtype('<f4'),
+    3: np.dtype('<f8')
+}
+
+SCORE_TYPE_CODES = {
+    'float16': 1,
+    'float32': 2
+}
+
+MOVIE_ID_TYPE = np.dtype('<i4')
+
+
+def encode_recommendations(movie_ids, scores, score_type='float16'):
+    """
+    Encodes the ranked movie ids and their estimated scores of a user to a compact binary value
+
+    :param movie_ids: the ranked movie ids
+    :param scores: the corresponding scores
+    :param score_type: either 'float16' or 'float32'
+    :return: the binary value
+    """
+    score_type_code = SCORE_TYPE_CODES[score_type]
+    movie_ids = np.asarray(movie_ids, dtype=MOVIE_ID_TYPE)
+    scores = np.asarray(scores, dtype=SCORE_TYPES[score_type_code])
+
+    return HEADER.pack(MAGIC, FORMAT_VERSION, score_type_code, len(movie_ids)) + movie_ids.tobytes() + scores.tobytes()
+
+
+def decode_recommendations(value):
+    """
+    Decodes the recommendations of a user. The binary format is decoded without copying, i.e., the resulting arrays
+    are read-only views of the given value. The legacy format (';'-separated movie ids, as bytes or as str) is also
+    supported, having NaN scores.
+
+    :param value: the stored value
+    :return: a tuple of the movie ids (int32) and their scores
+    """
+    if isinstance(value, str) or value[:len(MAGIC)] != MAGIC:
+        legacy = value if isinstance(value, str) else value.decode("utf-8")
+        movie_ids = np.array([int(v) for v in legacy.split(";") if v], dtype=MOVIE_ID_TYPE)
+        return movie_ids, np.full(len(movie_ids), np.nan, dtype=np.float32)
+
+    _, version, score_type_code, count = HEADER.unpack_from(value)
+
+    if version != FORMAT_VERSION or score_type_code not in SCORE_TYPES:
+        raise ValueError(f"Unsupported recommendations format: version={version}, score_type={score_type_code}")
+
+    movie_ids = np.frombuffer(value, dtype=MOVIE_ID_TYPE, count=count, offset=HEADER.size)
+    scores = np.frombuffer(value, dtype=SCORE_TYPES[score_type_code], count=count,
+                           offset=HEADER.size + count * MOVIE_ID_TYPE.itemsize)
+
+    return movie_ids, scores
+
+
+# Binary format of a popularity ranking of movies (see popularity.py), having the same header as above
+# (with score type 3, or 2 when written by older versions) and as body the n ranked movie ids, followed by their
+# n votes (little-endian int32) and their n average ratings (little-endian float64, i.e., the same values as the
+# average ratings of the database)
+POPULARITY_MAGIC = b'MP'
+POPULARITY_SCORE_TYPE = 3
+
+
+def encode_popularity(movie_ids, votes, avg_ratings):
+    """
+    Encodes a popularity ranking of movies to a compact binary value
+
+    :param movie_ids: the ranked movie ids
+    :param votes: the corresponding number of votes
+    :param avg_ratings: the corresponding average ratings
+    :return: the binary value
+    """
+    movie_ids = np.asarray(movie_ids, dtype=MOVIE_ID_TYPE)
+    votes = np.asarray(votes, dtype=MOVIE_ID_TYPE)
+    avg_ratings = np.asarray(avg_ratings, dtype=SCORE_TYPES[POPULARITY_SCORE_TYPE])
+
+    return HEADER.pack(POPULARITY_MAGIC, FORMAT_VERSION, POPULARITY_SCORE_TYPE, len(movie_ids)) \
+        + movie_ids.tobytes() + votes.tobytes() + avg_ratings.tobytes()
+
+
+def decode_popularity(value):
+    """
+    Decodes a popularity ranking of movies, without copying (see decode_recommendations)
+
+    :param value: the stored value
+    :return: a tuple of the ranked movie ids, their votes and their average ratings
+    """
+    magic, version, score_type_code, count = HEADER.unpack_from(value)
+
+    if magic != POPULARITY_MAGIC or version != FORMAT_VERSION or score_type_code not in (2, 3):
+        raise ValueError(f"Unsupported popularity format: magic={magic}, version={version}, "
+                         f"score_type={score_type_code}")
+
+    offset = HEADER.size
+    movie_ids = np.frombuffer(value, dtype=MOVIE_ID_TYPE, count=count, offset=offset)
+
+    offset += count * MOVIE_ID_TYPE.itemsize
+    votes = np.frombuffer(value, dtype=MOVIE_ID_TYPE, count=count, offset=offset)
+
+    offset += count * MOVIE_ID_TYPE.itemsize
+    avg_ratings = np.frombuffer(value, dtype=SCORE_TYPES[score_type_code], count=count, offset=offset)
+
+    return movie_ids, votes, avg_ratings
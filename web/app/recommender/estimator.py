@@ -4,28 +4,63 @@
 import time
 import redis
 from surprise import SVD, Dataset, Reader
-from collections import defaultdict
 from app.models import Rating
+from app.recommender.scoring import FactorModel, rated_matrix, iter_top_n_blocks, fold_in_user, top_n_of_user
+from app.recommender.pipeline import prefetch
+from app.recommender.publisher import publish_blocks
+from app.recommender.parallel import parallel_top_n
+from app.recommender.training import warm_start_fit
+from app.recommender.index import build_index
+from app.recommender.generations import Generations, RECOMMENDATIONS
 
 
 class Estimator:
 
     log = logging.getLogger(__name__)
 
-    def __init__(self, db, redis_pool, redis_chunk_size, model_params, top_n):
+    def __init__(self, db, redis_pool, redis_chunk_size, model_params, top_n, block_size, queue_size, n_workers,
+                 warm_start_epochs, warm_start_tol, cold_retrain_every, snapshot_store=None,
+                 index_params=None, ratings_cache=None,
+                 score_type='float16', candidates_factor=1):
         self.db = db
         self.redis_client = redis.Redis(connection_pool=redis_pool)
         self.redis_chunk_size = redis_chunk_size
         self.model_params = model_params
         self.top_n = top_n
 
+        # the length of the ranked list of candidates that is stored for each user, which is deeper than top_n
+        # such that enough candidates remain after filtering out the movies that the user rates/watches meanwhile
+        self.n_candidates = top_n * max(1, candidates_factor)
+        self.block_size = block_size
+        self.queue_size = queue_size
+        self.n_workers = n_workers
+        self.warm_start_epochs = warm_start_epochs
+        self.warm_start_tol = warm_start_tol
+        self.cold_retrain_every = cold_retrain_every
+
+        # the number of warm-started trainings since the last training from scratch
+        self.cycles_since_cold = 0
+
+        # the factors of the latest trained model, used for refreshing the recommendations of a single user
+        # and for warm-starting the next training
+        self.factors = None
+        self.snapshot_store = snapshot_store
+        self.index_params = index_params
+        self.ratings_cache = ratings_cache
+        self.score_type = score_type
+        self.generations = Generations(self.redis_client, RECOMMENDATIONS)
+
     def load_dataset(self):
         _columns = ['user_id', 'movie_id', 'rating']
 
         start_time = time.time()
-        df = pd.read_sql(Rating.__tablename__,
-                         con=self.db.engine.connect(),
-                         columns=_columns)
+
+        if self.ratings_cache is not None:
+            df = self.ratings_cache.refresh()
+        else:
+            df = pd.read_sql(Rating.__tablename__,
+                             con=self.db.engine.connect(),
+                             columns=_columns)
 
         result = Dataset.load_from_df(df[_columns], Reader(rating_scale=(0.5, 5.0)))
 
@@ -35,96 +70,227 @@ def load_dataset(self):
 
         return result, df
 
-    def train_model(self, data_set, params):
-        self.log.debug(f"Training final model using whole data set with params: {params}")
+    def get_factors(self):
+        """
+        Gives the factors of the latest model, that is the latest published model snapshot (which may have been
+        trained by another process) when snapshots are enabled, otherwise the model trained by this estimator.
+
+        :return: the FactorModel of the latest model, or None when no model exists yet
+        """
+        if self.snapshot_store is not None:
+            factors = self.snapshot_store.latest()
+            if factors is not None:
+                return factors
+
+        return self.factors
 
-        svd = SVD(**params)
+    def train_model(self, training_set, params):
+        """
+        Trains the model over the given training set. When a previous model exists, the training is warm-started
+        from its factors and biases (see warm_start_fit), except every self.cold_retrain_every cycles (or when
+        warm-start is disabled) which the model is trained from scratch using SVD.
+
+        :return: the FactorModel of the trained model
+        """
+        previous = self.get_factors()
+
+        warm_start = self.warm_start_epochs > 0 \
+            and previous is not None \
+            and previous.pu.shape[1] == params.get('n_factors', 100) \
+            and self.cycles_since_cold < self.cold_retrain_every - 1
 
         start_time = time.time()
-        training_set = data_set.build_full_trainset()
-        model = svd.fit(training_set)
+
+        if warm_start:
+            self.log.debug(f"Training final model using whole data set, warm-started from previous model "
+                           f"with params: {params}")
+
+            factors = warm_start_fit(training_set, previous, params, self.warm_start_epochs, self.warm_start_tol)
+            self.cycles_since_cold += 1
+        else:
+            self.log.debug(f"Training final model using whole data set with params: {params}")
+
+            svd = SVD(**params)
+            factors = FactorModel.from_svd(svd.fit(training_set))
+            self.cycles_since_cold = 0
+
         end_time = time.time()
         self.log.info(f'Time spend on training final model: {end_time - start_time} seconds')
 
-        return model
+        return factors
 
-    def get_top_n_predictions(self, data_set, model, n):
+    def get_top_n_predictions(self, factors, rated, n):
+        """
+        Lazily computes the top-n predictions of all users, block by block.
+
+        :return: a generator of blocks, each block is a list of (uid, [(iid, est), ...]) pairs
+        """
         predictions_start_time = time.time()
 
-        anti_testset_start = time.time()
-        self.log.debug("Constructing anti_testset...")
-        test_set = data_set.build_full_trainset().build_anti_testset()
-        anti_testset_end = time.time()
-        self.log.debug(f'Total time spend on anti_testset construction: '
-                      f'{anti_testset_end - anti_testset_start} seconds')
-
-        predictions_start = time.time()
-        self.log.debug("Calculating predictions...")
-        predictions = model.test(test_set)
-        predictions_end = time.time()
-        self.log.debug(f'Total time spend on prediction calculations: '
-                      f'{predictions_end - predictions_start} seconds')
-
-        topn_start = time.time()
-        self.log.debug("get-topN...")
-        top_n_result = self.get_top_n(predictions, n)
-        topn_end = time.time()
-        self.log.debug(f'Total time spend on top-n: '
-                      f'{topn_end - topn_start} seconds')
+        self.log.debug(f"Calculating top-{n} predictions of {factors.n_users} users over {factors.n_items} "
+                       f"movies, in blocks of {self.block_size} users...")
+
+        yield from iter_top_n_blocks(factors, rated, n, self.block_size)
 
         predictions_end_time = time.time()
         self.log.debug(f'Total time spend on predictions of top-{n}: '
-                      f'{predictions_end_time - predictions_start_time} seconds')
+                       f'{predictions_end_time - predictions_start_time} seconds')
 
-        return top_n_result
+    def persist(self, resulting_predictions, generation):
+        """
+        Sends the top-n predictions to the given generation in redis, as soon as each block of predictions
+        becomes available. They become visible to readers all at once, when the generation is activated.
 
-    def persist(self, resulting_predictions):
+        :param resulting_predictions: an iterable of blocks, each block is a list of (uid, [(iid, est), ...]) pairs
+        :param generation: the generation to write to
+        """
         start_time = time.time()
 
-        with self.redis_client.pipeline() as pipe:
-            pipe.multi()
-
-            counter = 0
-            for uid, user_ratings in resulting_predictions.items():
-                key = 'u'+str(uid)
-                value = str(";".join([str(iid) for (iid, _) in user_ratings]))
-                pipe.set(key, value)
-                counter += 1
-                if counter % self.redis_chunk_size == 0:
-                    pipe.execute()
-                    pipe.multi()
-                    self.log.debug(f'Current number of keys send to redis: {counter}')
-
-            pipe.execute()
-            self.log.debug(f'Total {counter} keys have been send to redis')
+        counter = publish_blocks(self.redis_client, resulting_predictions, self.redis_chunk_size,
+                                 score_type=self.score_type,
+                                 key_prefixes=[self.generations.prefix(generation)])
+        self.log.debug(f'Total {counter} keys have been send to redis')
+
         end_time = time.time()
 
         self.log.info(f'Total time spend sending top-n to redis: {end_time - start_time} seconds')
 
-    def recompute_recommendations(self):
+    def persist_parallel(self, factors, rated, n, generation):
+        """
+        Computes and sends to the given generation in redis the top-n predictions of all users,
+        using self.n_workers processes
+        """
+        start_time = time.time()
+
+        counter = parallel_top_n(factors, rated, n,
+                                 block_size=self.block_size,
+                                 redis_kwargs=self.redis_client.connection_pool.connection_kwargs,
+                                 redis_chunk_size=self.redis_chunk_size,
+                                 score_type=self.score_type,
+                                 key_prefix=self.generations.prefix(generation),
+                                 n_workers=self.n_workers)
+        self.log.debug(f'Total {counter} keys have been send to redis')
+
+        end_time = time.time()
+
+        self.log.info(f'Total time spend on parallel predictions of top-{n} and sending them to redis, '
+                      f'using {self.n_workers} workers: {end_time - start_time} seconds')
+
+    def predict_user_top_n(self, user_id, n, exclude_movie_ids=()):
+        """
+        Computes at request time the top-n predictions of a single user from his/her current ratings, by folding-in
+        the user to the latest trained model (i.e., item factors are kept fixed). Movies that the user has already
+        rated/watched are excluded.
+
+        :param user_id: the id of the user
+        :param n: the number of predictions
+        :param exclude_movie_ids: optionally, more movies to exclude, e.g., the seen set of the user, which has also
+                                  the ratings that are still in the write-behind queue
+        :return: a list of (movie_id, est) pairs, or None when there is no trained model yet or the user
+                 has not rated any movie that is known to the model
+        """
+        factors = self.get_factors()
+
+        if factors is None:
+            return None
+
+        user_ratings = self.db.session \
+            .query(Rating.movie_id, Rating.rating) \
+            .filter(Rating.user_id == user_id) \
+            .all()
+
+        known_ratings = [(factors.inner_iids[movie_id], rating)
+                         for (movie_id, rating) in user_ratings if movie_id in factors.inner_iids]
+
+        if len(known_ratings) == 0:
+            return None
+
+        inner_iids, ratings = zip(*known_ratings)
+        bu, pu = fold_in_user(factors, inner_iids, ratings, self.model_params.get('reg_all', 0.02))
+
+        excluded_inner_iids = set(inner_iids)
+        excluded_inner_iids.update(factors.inner_iids[movie_id] for movie_id in exclude_movie_ids
+                                   if movie_id in factors.inner_iids)
+
+        return top_n_of_user(factors, bu, pu, list(excluded_inner_iids), n)
+
+    def refresh_user_recommendations(self, user_id):
+        """
+        Recomputes the top-n recommendations of a single user (see predict_user_top_n) and sends them to redis.
+
+        :param user_id: the id of the user
+        :return: the resulting top-n predictions, or None when they cannot be computed
+        """
+        start_time = time.time()
+
+        user_predictions = self.predict_user_top_n(user_id, self.n_candidates)
+
+        if user_predictions is None:
+            return None
+
+        # write to the active generation, as well as to the one that is being published (if any)
+        key_prefixes = [self.generations.prefix(generation) for generation in self.generations.live()]
+
+        publish_blocks(self.redis_client, [[(user_id, user_predictions)]], self.redis_chunk_size,
+                       score_type=self.score_type,
+                       key_prefixes=key_prefixes or [''])
+
+        end_time = time.time()
+        self.log.debug(f'Time spend refreshing top-{self.n_candidates} recommendations of user with '
+                       f'user_id={user_id}: {end_time - start_time} seconds')
+
+        return user_predictions
+
+    def recompute_recommendations(self, leadership=None):
+        """
+        Retrains the model, publishes its snapshot and sends the top-n recommendations of all users to a new
+        generation in redis, which is activated when all of them have been sent.
+
+        :param leadership: optionally, the LeaderElection of the calling process, the leadership is checked between
+                           the stages (raising LeadershipLost when it has been lost) and the activation of the new
+                           generation is fenced by it
+        """
+        def check_leadership():
+            if leadership is not None:
+                leadership.check()
 
         total_time_start = time.time()
 
         data, _ = self.load_dataset()
-        model = self.train_model(data, self.model_params)
-        resulting_predictions = self.get_top_n_predictions(data, model, self.top_n)
-        self.persist(resulting_predictions)
+        training_set = data.build_full_trainset()
 
-        total_time_end = time.time()
+        check_leadership()
 
-        self.log.info(f"Total time of calculating latest recommendations (top-{self.top_n}): "
-                      f"{total_time_end - total_time_start} seconds")
+        factors = self.train_model(training_set, self.model_params)
+        rated = rated_matrix(training_set)
+
+        if self.index_params is not None:
+            factors.index = build_index(factors=factors, **self.index_params)
+
+        check_leadership()
 
-    @staticmethod
-    def get_top_n(predictions, n=10):
-        # First map the predictions to each user.
-        top_n = defaultdict(list)
-        for uid, iid, true_r, est, _ in predictions:
-            top_n[uid].append((iid, est))
+        self.factors = factors
 
-        # Then sort the predictions for each user and retrieve the k highest ones.
-        for uid, user_ratings in top_n.items():
-            user_ratings.sort(key=lambda x: x[1], reverse=True)
-            top_n[uid] = user_ratings[:n]
+        if self.snapshot_store is not None:
+            self.snapshot_store.save(factors)
 
-        return top_n
\ No newline at end of file
+        generation = self.generations.begin()
+
+        try:
+            if self.n_workers > 1:
+                self.persist_parallel(factors, rated, self.n_candidates, generation)
+            else:
+                # scoring runs ahead of sending to redis by at most self.queue_size blocks
+                resulting_predictions = prefetch(self.get_top_n_predictions(factors, rated, self.n_candidates),
+                                                 self.queue_size)
+                self.persist(resulting_predictions, generation)
+        except Exception:
+            self.generations.abort(generation)
+            raise
+
+        self.generations.activate(generation, fence=None if leadership is None else leadership.fence)
+
+        total_time_end = time.time()
+
+        self.log.info(f"Total time of calculating latest recommendations (top-{self.n_candidates}): "
+                      f"{total_time_end - total_time_start} seconds")
@@ -0,0 +1,220 @@
+# -*- coding: utf-8 -*-
+import logging
+import threading
+import time
+from app.leader import LeadershipLost
+
+# The namespaces of the generational keys, i.e., of the top-n recommendations of users and of the movie statistics
+RECOMMENDATIONS = 'recs'
+STATISTICS = 'stats'
+
+
+class Generations:
+    """
+    Generations of keys in redis, under a namespace (e.g., 'recs'). A publisher writes all of its keys to a new
+    generation (i.e., keys prefixed by '<namespace>:<generation>:') with plain, non-transactional pipelines and, when
+    done, activates the generation by atomically flipping the pointer key '<namespace>:gen'. Thus, readers never see
+    a mix of old and new keys. The previous generation is kept for instant rollback, while older generations are
+    reclaimed in the background with UNLINK.
+
+    The tradeoff is that a publisher's keys become visible only when its generation is activated, not as soon as
+    they are written (e.g., the blocks of a recomputation are sent one by one, but they are all visible at once,
+    after the last block). Until then, readers keep seeing the previous generation.
+    """
+
+    log = logging.getLogger(__name__)
+
+    # Gives the value of a key in the active generation, or the value of the legacy (non-generational) key
+    # when no generation has been activated yet
+    GET_SCRIPT = """
+        local generation = redis.call('GET', KEYS[1])
+        if generation then
+            return redis.call('GET', ARGV[1] .. ':' .. generation .. ':' .. ARGV[2])
+        else
+            return redis.call('GET', ARGV[2])
+        end
+    """
+
+    # Makes ARGV[1] the active generation (KEYS[1] is the pointer), only when the fence KEYS[2] holds the value
+    # ARGV[2]. Gives a list of the previous generation (empty when there is none), or 0 when the fence does not hold
+    FENCED_ACTIVATE_SCRIPT = """
+        if redis.call('GET', KEYS[2]) ~= ARGV[2] then
+            return 0
+        end
+        return {redis.call('GETSET', KEYS[1], ARGV[1])}
+    """
+
+    def __init__(self, redis_client, namespace, reclaim_batch_size=1000):
+        self.redis_client = redis_client
+        self.namespace = namespace
+        self.reclaim_batch_size = reclaim_batch_size
+        self._get_script = redis_client.register_script(self.GET_SCRIPT)
+        self._fenced_activate_script = redis_client.register_script(self.FENCED_ACTIVATE_SCRIPT)
+
+    @property
+    def pointer_key(self):
+        return f'{self.namespace}:gen'
+
+    @property
+    def previous_key(self):
+        return f'{self.namespace}:gen:previous'
+
+    @property
+    def pending_key(self):
+        return f'{self.namespace}:gen:pending'
+
+    @property
+    def counter_key(self):
+        return f'{self.namespace}:gen:counter'
+
+    @property
+    def all_key(self):
+        return f'{self.namespace}:gen:all'
+
+    def prefix(self, generation):
+        return f'{self.namespace}:{generation}:'
+
+    def key(self, generation, key):
+        return self.prefix(generation) + key
+
+    def current(self):
+        """
+        :return: the active generation, or None when no generation has been activated yet
+        """
+        generation = self.redis_client.get(self.pointer_key)
+        return None if generation is None else int(generation)
+
+    def live(self):
+        """
+        :return: the active generation and the generation that is being published (if any), i.e., the generations
+                 that a single key update should be written to
+        """
+        current, pending = self.redis_client.mget([self.pointer_key, self.pending_key])
+        return [int(generation) for generation in (current, pending) if generation is not None]
+
+    def get(self, key, client=None):
+        """
+        Gives the value of a key in the active generation (using a single round trip)
+
+        :param key: the key, without the generation prefix
+        :param client: optionally, a pipeline to execute the command
+        """
+        return self._get_script(keys=[self.pointer_key], args=[self.namespace, key], client=client)
+
+    def begin(self):
+        """
+        Allocates a new generation to publish to
+
+        :return: the new generation
+        """
+        generation = self.redis_client.incr(self.counter_key)
+
+        with self.redis_client.pipeline(transaction=False) as pipe:
+            pipe.sadd(self.all_key, generation)
+            pipe.set(self.pending_key, generation)
+            pipe.execute()
+
+        self.log.debug(f"Publishing to generation {generation} of '{self.namespace}'")
+
+        return generation
+
+    def activate(self, generation, fence=None):
+        """
+        Atomically makes the given generation the active one, and reclaims in the background
+        all generations except of the active and the previous one.
+
+        :param fence: optionally, the (key, value) of a leadership lock (see LeaderElection.fence), the generation
+                      is activated only when the lock is still held, otherwise it is discarded and LeadershipLost
+                      is raised
+        """
+        if fence is None:
+            previous = self.redis_client.getset(self.pointer_key, generation)
+        else:
+            result = self._fenced_activate_script(keys=[self.pointer_key, fence[0]], args=[generation, fence[1]])
+
+            if result == 0:
+                self.abort(generation)
+                raise LeadershipLost(f"Generation {generation} of '{self.namespace}' has not been activated, "
+                                     f"since the lock '{fence[0]}' is no longer held")
+
+            previous = result[0] if len(result) > 0 else None
+
+        with self.redis_client.pipeline(transaction=False) as pipe:
+            if previous is not None:
+                pipe.set(self.previous_key, previous)
+            pipe.delete(self.pending_key)
+            pipe.execute()
+
+        self.log.info(f"Activated generation {generation} of '{self.namespace}' (previous: {previous})")
+
+        keep = {generation} if previous is None else {generation, int(previous)}
+        self.reclaim_in_background(keep)
+
+    def abort(self, generation):
+        """
+        Discards a generation that has not been activated (e.g., when publishing failed)
+        """
+        self.redis_client.delete(self.pending_key)
+        self.reclaim_in_background({g for g in self.live() if g != generation})
+
+    def rollback(self):
+        """
+        Instantly re-activates the previous generation
+
+        :return: the re-activated generation, or None when there is no previous generation
+        """
+        previous = self.redis_client.get(self.previous_key)
+
+        if previous is None:
+            return None
+
+        current = self.redis_client.getset(self.pointer_key, previous)
+        if current is not None:
+            self.redis_client.set(self.previous_key, current)
+
+        self.log.info(f"Rolled back '{self.namespace}' from generation {current} to generation {previous}")
+
+        return int(previous)
+
+    def reclaim_in_background(self, keep):
+        thread = threading.Thread(target=self.reclaim, args=(keep,), name=f"reclaim-{self.namespace}", daemon=True)
+        thread.start()
+
+        return thread
+
+    def reclaim(self, keep):
+        """
+        Removes all keys of the generations that are not in keep, using UNLINK (i.e., memory is freed by redis
+        in the background)
+        """
+        start_time = time.time()
+
+        # never reclaim the generations that are active, previous or being published
+        keep = set(keep)
+        keep.update(int(generation)
+                    for generation in self.redis_client.mget([self.pointer_key, self.previous_key, self.pending_key])
+                    if generation is not None)
+
+        for generation in [int(g) for g in self.redis_client.smembers(self.all_key)]:
+            if generation in keep:
+                continue
+
+            counter = 0
+            batch = []
+            for key in self.redis_client.scan_iter(match=self.prefix(generation) + '*', count=self.reclaim_batch_size):
+                batch.append(key)
+                if len(batch) == self.reclaim_batch_size:
+                    self.redis_client.execute_command('UNLINK', *batch)
+                    counter += len(batch)
+                    batch = []
+
+            if len(batch) > 0:
+                self.redis_client.execute_command('UNLINK', *batch)
+                counter += len(batch)
+
+            self.redis_client.srem(self.all_key, generation)
+
+            self.log.debug(f"Reclaimed {counter} keys of generation {generation} of '{self.namespace}'")
+
+        end_time = time.time()
+        self.log.debug(f"Time spend reclaiming generations of '{self.namespace}': {end_time - start_time} seconds")
@@ -0,0 +1,283 @@
+# -*- coding: utf-8 -*-
+import logging
+import time
+import numpy as np
+from app.recommender.scoring import top_n_of_scores, top_n_block
+
+log = logging.getLogger(__name__)
+
+
+def augmented_items(factors):
+    """
+    Gives the item vectors [qi, bi], such that the (user-dependent part of the) estimation of an item is the
+    inner product with the query vector [pu, 1].
+    """
+    return np.hstack([factors.qi, factors.bi[:, np.newaxis]]).astype(np.float32)
+
+
+def augmented_queries(pu):
+    pu = np.atleast_2d(pu).astype(np.float32)
+    return np.hstack([pu, np.ones((pu.shape[0], 1), dtype=np.float32)])
+
+
+def mips_to_nn(items):
+    """
+    Transforms the maximum inner product search (MIPS) to a nearest neighbour search, by appending the extra
+    dimension sqrt(M^2 - ||x||^2) to each item vector x, where M is the maximum norm of the items. All transformed
+    items have norm M, thus their euclidean distance to a query [y, 0] is monotone to their inner product with y.
+    """
+    norms = np.einsum('ij,ij->i', items, items)
+    extra = np.sqrt(np.maximum(norms.max() - norms, 0.0))
+
+    return np.hstack([items, extra[:, np.newaxis]])
+
+
+def kmeans(points, n_clusters, n_iter, rng):
+    """
+    Lloyd's k-means, initialized by randomly chosen points
+
+    :return: a tuple of the centroids and the cluster assignment of each point
+    """
+    centroids = points[rng.choice(len(points), n_clusters, replace=False)].copy()
+
+    assignments = None
+    for _ in range(n_iter):
+        # argmin of ||x - c||^2 is argmax of x * c - ||c||^2 / 2
+        similarities = points.dot(centroids.T) - 0.5 * np.einsum('ij,ij->i', centroids, centroids)
+        new_assignments = np.argmax(similarities, axis=1)
+
+        if assignments is not None and np.array_equal(assignments, new_assignments):
+            break
+        assignments = new_assignments
+
+        for cluster in range(n_clusters):
+            members = points[assignments == cluster]
+            if len(members) > 0:
+                centroids[cluster] = members.mean(axis=0)
+
+    return centroids, assignments
+
+
+class ExactIndex:
+    """
+    Exhaustive top-K retrieval over all item factors
+    """
+
+    TYPE = 'exact'
+
+    def __init__(self, qi, bi):
+        self.qi = qi
+        self.bi = bi
+
+    @classmethod
+    def build(cls, factors, **kwargs):
+        return cls(factors.qi, factors.bi)
+
+    def arrays(self):
+        return {}
+
+    @classmethod
+    def from_arrays(cls, factors, arrays, **kwargs):
+        return cls(factors.qi, factors.bi)
+
+    def search(self, pu, n, exclude_inner_iids=(), n_probe=None):
+        """
+        Gives the n items with the highest estimation for the given user latent vector, excluding the specified ones
+
+        :return: a tuple of the inner item ids and their scores (i.e., bi + qi * pu), sorted in descending order
+        """
+        scores = self.qi.dot(np.asarray(pu, dtype=np.float32)) + self.bi
+        scores[np.asarray(exclude_inner_iids, dtype=np.int64)] = -np.inf
+
+        top_items, top_scores = top_n_of_scores(scores[np.newaxis, :], n)
+        valid = np.isfinite(top_scores[0])
+
+        return top_items[0][valid], top_scores[0][valid]
+
+    def top_n_block(self, factors, rated, start, stop, n):
+        return top_n_block(factors, rated, start, stop, n)
+
+
+class IVFIndex:
+    """
+    Approximate top-K retrieval over item factors, using an inverted file (IVF) of the items: The items are
+    transformed from maximum inner product search to nearest neighbour search (see mips_to_nn) and partitioned
+    by k-means. A query scores the cluster centroids and only the items of the n_probe most promising clusters
+    are scored exactly. n_probe is the recall/latency knob, while probing all clusters is equivalent to exact search.
+    """
+
+    TYPE = 'ivf'
+
+    def __init__(self, qi, bi, centroids, offsets, item_order, n_probe):
+        self.qi = qi
+        self.bi = bi
+        self.centroids = centroids
+        self.offsets = offsets
+        self.item_order = item_order
+        self.n_probe = n_probe
+
+        self._ordered = None
+
+    @property
+    def n_clusters(self):
+        return len(self.centroids)
+
+    @classmethod
+    def build(cls, factors, n_clusters=0, n_probe=8, n_iter=20, random_state=None):
+        """
+        Builds the index of the item factors of the given model
+
+        :param factors: the FactorModel
+        :param n_clusters: the number of partitions, when is not positive it is set to sqrt(number of items)
+        :param n_probe: the default number of partitions to probe for each query
+        :param n_iter: the maximum number of k-means iterations
+        :param random_state: the seed of the k-means initialization
+        """
+        start_time = time.time()
+
+        items = augmented_items(factors)
+
+        if n_clusters <= 0:
+            n_clusters = int(np.sqrt(len(items)))
+        n_clusters = max(1, min(n_clusters, len(items)))
+
+        transformed = mips_to_nn(items)
+        centroids, assignments = kmeans(transformed, n_clusters, n_iter, np.random.RandomState(random_state))
+
+        item_order = np.argsort(assignments, kind='mergesort').astype(np.int32)
+        offsets = np.zeros(n_clusters + 1, dtype=np.int64)
+        np.cumsum(np.bincount(assignments, minlength=n_clusters), out=offsets[1:])
+
+        end_time = time.time()
+        log.info(f'Time spend building IVF index of {len(items)} items with {n_clusters} clusters: '
+                 f'{end_time - start_time} seconds')
+
+        # keep only the centroid dimensions that correspond to the query vector [pu, 1, 0]
+        return cls(factors.qi, factors.bi, centroids[:, :-1].astype(np.float32), offsets, item_order, n_probe)
+
+    def arrays(self):
+        return {
+            'centroids': self.centroids,
+            'offsets': self.offsets,
+            'item_order': self.item_order
+        }
+
+    @classmethod
+    def from_arrays(cls, factors, arrays, n_probe=8):
+        return cls(factors.qi, factors.bi, arrays['centroids'], arrays['offsets'], arrays['item_order'], n_probe)
+
+    def search(self, pu, n, exclude_inner_iids=(), n_probe=None):
+        """
+        Gives (approximately) the n items with the highest estimation for the given user latent vector, excluding the
+        specified ones. More clusters than n_probe are probed, when needed for giving n items.
+
+        :return: a tuple of the inner item ids and their scores (i.e., bi + qi * pu), sorted in descending order
+        """
+        n_probe = self.n_probe if n_probe is None else n_probe
+        pu = np.asarray(pu, dtype=np.float32)
+        exclude_inner_iids = np.asarray(exclude_inner_iids, dtype=np.int64)
+
+        cluster_order = np.argsort(-self.centroids.dot(augmented_queries(pu)[0]))
+        cluster_sizes = self.offsets[cluster_order + 1] - self.offsets[cluster_order]
+
+        # probe at least n_probe clusters, and as many as needed to have n candidates after the exclusions
+        enough = np.searchsorted(np.cumsum(cluster_sizes), n + len(exclude_inner_iids)) + 1
+        probed = cluster_order[:max(n_probe, enough)]
+
+        candidates = np.concatenate([self.item_order[self.offsets[c]:self.offsets[c + 1]] for c in probed])
+        if len(exclude_inner_iids) > 0:
+            candidates = candidates[~np.isin(candidates, exclude_inner_iids)]
+
+        scores = self.qi[candidates].dot(pu) + self.bi[candidates]
+        top, top_scores = top_n_of_scores(scores[np.newaxis, :], n)
+
+        return candidates[top[0]], top_scores[0]
+
+    def _ordered_items(self):
+        """
+        :return: a tuple of the item factors and biases in the order of the clusters, i.e., each cluster is a
+                 contiguous range of rows (see offsets), and of the position of each inner item id in that order
+        """
+        if self._ordered is None:
+            positions = np.empty_like(self.item_order)
+            positions[self.item_order] = np.arange(len(self.item_order), dtype=self.item_order.dtype)
+            self._ordered = (np.ascontiguousarray(self.qi[self.item_order]), self.bi[self.item_order], positions)
+        return self._ordered
+
+    def top_n_block(self, factors, rated, start, stop, n):
+        """
+        Gives the top-n items of each user of the block [start, stop), excluding the items that they have already
+        rated (see scoring.top_n_block). Each user probes the same clusters as with search, while each probed
+        cluster is scored with a single matrix product for all users of the block that probe it. Rows having less
+        than n items are padded with -inf scores.
+        """
+        n_users = stop - start
+        qi, bi, positions = self._ordered_items()
+        pu = factors.pu[start:stop]
+
+        # the rank of each cluster for each user, from the most promising one
+        cluster_order = np.argsort(-augmented_queries(pu).dot(self.centroids.T), axis=1)
+        cluster_rank = np.empty_like(cluster_order)
+        cluster_rank[np.arange(n_users)[:, np.newaxis], cluster_order] = np.arange(self.n_clusters)
+
+        # probe at least n_probe clusters, and as many as needed to have n candidates after the exclusions
+        block = rated[start:stop]
+        n_rated = np.diff(block.indptr)
+        cumulative_sizes = np.cumsum(np.diff(self.offsets)[cluster_order], axis=1)
+        enough = (cumulative_sizes < (n + n_rated)[:, np.newaxis]).sum(axis=1) + 1
+        probes = cluster_rank < np.maximum(self.n_probe, enough)[:, np.newaxis]
+
+        # the scores of the items (in the order of the clusters) that are not probed by a user remain -inf
+        scores = np.full((n_users, len(qi)), -np.inf, dtype=np.float32)
+        for cluster in np.flatnonzero(probes.any(axis=0)):
+            users = np.flatnonzero(probes[:, cluster])
+            first, last = self.offsets[cluster], self.offsets[cluster + 1]
+            scores[users, first:last] = pu[users].dot(qi[first:last].T) + bi[first:last]
+
+        scores[np.repeat(np.arange(n_users), n_rated), positions[block.indices]] = -np.inf
+
+        top, top_scores = top_n_of_scores(scores, n)
+        top_scores += (factors.bu[start:stop] + factors.global_mean)[:, np.newaxis].astype(np.float32)
+
+        return self.item_order[top].astype(np.int64), top_scores
+
+
+INDEX_TYPES = {index_type.TYPE: index_type for index_type in (ExactIndex, IVFIndex)}
+
+
+def build_index(index_type, factors, **kwargs):
+    return INDEX_TYPES[index_type].build(factors, **kwargs)
+
+
+def benchmark_recall(factors, index, n, n_users=1000, n_probes=(1, 2, 4, 8, 16, 32), random_state=None):
+    """
+    Measures the recall@n and the latency of the given index against exact scoring, over a random sample of users
+
+    :return: a list of dictionaries, one for each n_probe, with the recall and the mean latencies in milliseconds
+    """
+    rng = np.random.RandomState(random_state)
+    users = rng.choice(factors.n_users, min(n_users, factors.n_users), replace=False)
+
+    exact = ExactIndex.build(factors)
+
+    start_time = time.time()
+    exact_results = [set(exact.search(factors.pu[u], n)[0].tolist()) for u in users]
+    exact_latency = (time.time() - start_time) * 1000 / len(users)
+
+    results = []
+    for n_probe in n_probes:
+        start_time = time.time()
+        approx_results = [index.search(factors.pu[u], n, n_probe=n_probe)[0].tolist() for u in users]
+        approx_latency = (time.time() - start_time) * 1000 / len(users)
+
+        hits = sum(len(expected.intersection(found)) for expected, found in zip(exact_results, approx_results))
+        total = sum(len(expected) for expected in exact_results)
+
+        results.append({
+            'n_probe': n_probe,
+            'recall': hits / max(total, 1),
+            'latency_ms': approx_latency,
+            'exact_latency_ms': exact_latency
+        })
+
+    return results
@@ -0,0 +1,120 @@
+# -*- coding: utf-8 -*-
+import logging
+import multiprocessing
+import os
+import numpy as np
+import redis
+from multiprocessing.sharedctypes import RawArray
+from scipy import sparse
+from app.recommender.scoring import FactorModel, iter_top_n_blocks
+from app.recommender.publisher import publish_blocks
+from app.recommender.index import INDEX_TYPES
+
+log = logging.getLogger(__name__)
+
+# The state of each worker process, which is initialized once by _init_worker
+_worker = {}
+
+
+def share_array(array):
+    """
+    Copies the given array to a block of shared memory, in order to be accessed by the worker processes without copying
+
+    :return: a picklable (at process creation) tuple of the shared memory block, the dtype and the shape of the array
+    """
+    array = np.ascontiguousarray(array)
+    shared = RawArray('b', max(array.nbytes, 1))
+    np.frombuffer(shared, dtype=array.dtype, count=array.size)[:] = array.ravel()
+
+    return shared, array.dtype.str, array.shape
+
+
+def shared_as_array(shared_array):
+    """
+    Gives a NumPy view (i.e., zero-copy) of an array that has been shared by share_array
+    """
+    shared, dtype, shape = shared_array
+    size = int(np.prod(shape))
+
+    return np.frombuffer(shared, dtype=np.dtype(dtype), count=size).reshape(shape)
+
+
+def _init_worker(arrays, global_mean, rating_scale, n_items, index_type, index_n_probe,
+                 redis_kwargs, top_n, block_size, redis_chunk_size, score_type, key_prefix):
+    views = {name: shared_as_array(shared_array) for name, shared_array in arrays.items()}
+
+    _worker['factors'] = FactorModel(global_mean,
+                                     views['bu'], views['bi'], views['pu'], views['qi'],
+                                     views['raw_uids'], views['raw_iids'], rating_scale)
+
+    if index_type is not None:
+        index_arrays = {name[len('index_'):]: view for name, view in views.items() if name.startswith('index_')}
+        _worker['factors'].index = INDEX_TYPES[index_type].from_arrays(_worker['factors'], index_arrays,
+                                                                       n_probe=index_n_probe)
+
+    _worker['rated'] = sparse.csr_matrix((views['rated_data'], views['rated_indices'], views['rated_indptr']),
+                                         shape=(len(views['pu']), n_items), copy=False)
+
+    _worker['redis_client'] = redis.Redis(**redis_kwargs)
+    _worker['top_n'] = top_n
+    _worker['block_size'] = block_size
+    _worker['redis_chunk_size'] = redis_chunk_size
+    _worker['score_type'] = score_type
+    _worker['key_prefix'] = key_prefix
+
+
+def _score_and_publish(user_range):
+    first_user, last_user = user_range
+
+    blocks = iter_top_n_blocks(_worker['factors'], _worker['rated'], _worker['top_n'], _worker['block_size'],
+                               first_user=first_user, last_user=last_user)
+
+    return publish_blocks(_worker['redis_client'], blocks, _worker['redis_chunk_size'],
+                          score_type=_worker['score_type'],
+                          key_prefixes=[_worker['key_prefix']])
+
+
+def parallel_top_n(factors, rated, top_n, block_size, redis_kwargs, redis_chunk_size, n_workers,
+                   score_type='float16', key_prefix=''):
+    """
+    Computes and sends to redis the top-n predictions of all users, using a pool of n_workers processes.
+    The factor matrices, the sparse index of rated items and the arrays of the retrieval index of the model (when
+    exists) are placed once in shared memory, while each worker scores a range of users and writes its results
+    directly to redis.
+
+    :return: the total number of keys that have been send to redis
+    """
+    arrays = {
+        'bu': factors.bu,
+        'bi': factors.bi,
+        'pu': factors.pu,
+        'qi': factors.qi,
+        'raw_uids': factors.raw_uids,
+        'raw_iids': factors.raw_iids,
+        'rated_data': rated.data,
+        'rated_indices': rated.indices,
+        'rated_indptr': rated.indptr
+    }
+
+    index_type, index_n_probe = None, None
+    if factors.index is not None:
+        index_type, index_n_probe = factors.index.TYPE, getattr(factors.index, 'n_probe', None)
+        arrays.update({'index_' + name: array for name, array in factors.index.arrays().items()})
+
+    shared_arrays = {name: share_array(array) for name, array in arrays.items()}
+
+    user_ranges = [(start, min(start + block_size, factors.n_users))
+                   for start in range(0, factors.n_users, block_size)]
+
+    log.debug(f"Scoring {factors.n_users} users in {len(user_ranges)} ranges using {n_workers} worker processes "
+              f"(parent pid={os.getpid()})")
+
+    init_args = (shared_arrays, factors.global_mean, factors.rating_scale, factors.n_items, index_type, index_n_probe,
+                 redis_kwargs, top_n, block_size, redis_chunk_size, score_type, key_prefix)
+
+    counter = 0
+    with multiprocessing.Pool(processes=n_workers, initializer=_init_worker, initargs=init_args) as pool:
+        for n_keys in pool.imap_unordered(_score_and_publish, user_ranges):
+            counter += n_keys
+
+    return counter
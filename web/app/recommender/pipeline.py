@@ -0,0 +1,63 @@
+# -*- coding: utf-8 -*-
+import queue
+import threading
+
+
+_END_OF_STREAM = object()
+
+
+class _StageError:
+
+    def __init__(self, error):
+        self.error = error
+
+
+def prefetch(iterable, max_size, poll_interval=0.5):
+    """
+    Runs the given iterable (e.g., a generator of scored user blocks) in a background thread and gives its items
+    through a bounded queue. The producer blocks when max_size items are waiting to be consumed, therefore the
+    memory is bounded by the speed of the slowest stage (backpressure). Any error raised by the producer is
+    re-raised to the consumer.
+
+    :param iterable: the producing stage
+    :param max_size: the maximum number of produced but not yet consumed items
+    :param poll_interval: interval (in seconds) that the producer checks whether the consumer has stopped
+    :return: a generator of the produced items
+    """
+    items = queue.Queue(maxsize=max_size)
+    stopped = threading.Event()
+
+    def put(item):
+        while not stopped.is_set():
+            try:
+                items.put(item, timeout=poll_interval)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def produce():
+        try:
+            for item in iterable:
+                if not put(item):
+                    return
+        except Exception as e:
+            put(_StageError(e))
+        else:
+            put(_END_OF_STREAM)
+
+    producer = threading.Thread(target=produce, name="prefetch", daemon=True)
+    producer.start()
+
+    try:
+        while True:
+            item = items.get()
+            if item is _END_OF_STREAM:
+                break
+            elif isinstance(item, _StageError):
+                raise item.error
+            else:
+                yield item
+    finally:
+        stopped.set()
+        producer.join()
@@ -0,0 +1,87 @@
+# -*- coding: utf-8 -*-
+import logging
+import threading
+import time
+import numpy as np
+from app.recommender.encoding import decode_popularity
+from app.recommender.generations import Generations, STATISTICS
+
+# The rating limits of the precomputed popularity rankings, i.e., all half-star ratings in (0.5, 5.0)
+POPULARITY_THRESHOLDS = (1.0, 1.5, 2.0, 2.5, 3.0, 3.5, 4.0, 4.5)
+
+
+def popularity_key(threshold):
+    return f'popular#{float(threshold)}'
+
+
+def rank_popularity(movie_ids, votes, avg_ratings):
+    """
+    Ranks the movies in descending order of votes and then of average rating, ignoring movies without votes
+
+    :return: a tuple of the ranked movie ids, their votes and their average ratings
+    """
+    movie_ids = np.asarray(movie_ids)
+    votes = np.asarray(votes)
+    avg_ratings = np.asarray(avg_ratings)
+
+    voted = votes > 0
+    movie_ids, votes, avg_ratings = movie_ids[voted], votes[voted], avg_ratings[voted]
+
+    order = np.lexsort((-avg_ratings, -votes))
+
+    return movie_ids[order], votes[order], avg_ratings[order]
+
+
+class PopularityCache:
+    """
+    In-process cache of the popularity rankings of movies, that are precomputed by MovieStatistics for each rating
+    limit and are stored in redis under the active generation of statistics. The rankings are reloaded only when
+    a newer generation is activated, thus at request time only the generation pointer is read from redis.
+    """
+
+    log = logging.getLogger(__name__)
+
+    def __init__(self, redis_client, thresholds=POPULARITY_THRESHOLDS):
+        self.redis_client = redis_client
+        self.thresholds = tuple(thresholds)
+        self.generations = Generations(redis_client, STATISTICS)
+        self._lock = threading.Lock()
+        self._loaded = (None, {})
+
+    def _load(self, generation):
+        start_time = time.time()
+
+        values = self.redis_client.mget([self.generations.key(generation, popularity_key(threshold))
+                                         for threshold in self.thresholds])
+
+        rankings = {float(threshold): decode_popularity(value)
+                    for threshold, value in zip(self.thresholds, values) if value is not None}
+
+        end_time = time.time()
+        self.log.debug(f'Time spend loading {len(rankings)} popularity rankings of generation {generation}: '
+                       f'{end_time - start_time} seconds')
+
+        return rankings
+
+    def get(self, threshold):
+        """
+        Gives the popularity ranking of the movies for the given rating limit
+
+        :param threshold: the rating limit, i.e., only ratings greater than or equal to it are counted
+        :return: a tuple of the ranked movie ids, their votes and their average ratings, or None when
+                 there is no precomputed ranking for the given rating limit
+        """
+        generation = self.generations.current()
+        loaded_generation, rankings = self._loaded
+
+        if generation is None:
+            return None
+
+        if generation != loaded_generation:
+            with self._lock:
+                loaded_generation, rankings = self._loaded
+                if generation != loaded_generation:
+                    rankings = self._load(generation)
+                    self._loaded = (generation, rankings)
+
+        return rankings.get(float(threshold))
@@ -0,0 +1,43 @@
+# -*- coding: utf-8 -*-
+import logging
+from app.recommender.encoding import encode_recommendations
+
+log = logging.getLogger(__name__)
+
+
+def publish_blocks(redis_client, blocks, chunk_size, score_type='float16', key_prefixes=('',)):
+    """
+    Sends the top-n predictions to redis, as soon as each block of predictions becomes available.
+    Keys are sent using plain (non-transactional) pipelines. When the keys are prefixed by a pending generation
+    (see Generations), they are sent block by block but readers see them only when the generation is activated.
+
+    :param redis_client: the redis client
+    :param blocks: an iterable of blocks, each block is a list of (uid, [(iid, est), ...]) pairs
+    :param chunk_size: the maximum number of keys to buffer in the redis pipeline
+    :param score_type: the type of the stored scores (see encoding.encode_recommendations)
+    :param key_prefixes: the prefixes of the keys, e.g., of the generation(s) to write to (see Generations.prefix)
+    :return: the total number of keys that have been send to redis
+    """
+    with redis_client.pipeline(transaction=False) as pipe:
+
+        counter = 0
+        for block in blocks:
+            for uid, user_ratings in block:
+                value = encode_recommendations([iid for (iid, _) in user_ratings],
+                                               [est for (_, est) in user_ratings],
+                                               score_type)
+                for key_prefix in key_prefixes:
+                    pipe.set(key_prefix + 'u' + str(uid), value)
+                    counter += 1
+                    if counter % chunk_size == 0:
+                        pipe.execute()
+                        log.debug(f'Current number of keys send to redis: {counter}')
+
+            # send the keys of the current block, before scoring the next one(s), thus sending overlaps with scoring
+            # and the pipeline never buffers more than a block
+            if len(pipe) > 0:
+                pipe.execute()
+
+        pipe.execute()
+
+    return counter
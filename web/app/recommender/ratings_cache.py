@@ -0,0 +1,217 @@
+# -*- coding: utf-8 -*-
+import logging
+import os
+import time
+import numpy as np
+import pandas as pd
+from datetime import datetime, timezone, timedelta
+from sqlalchemy import func
+from app.models import Rating, RatingDeletion
+
+
+def _to_micros(timestamps):
+    """
+    Converts a pandas Series of (timezone-aware) timestamps to int64 microseconds since epoch, missing values are 0
+    """
+    timestamps = pd.to_datetime(timestamps, utc=True)
+    micros = timestamps.values.astype('datetime64[us]').astype(np.int64)
+    micros[timestamps.isnull().values] = 0
+
+    return micros
+
+
+def _from_micros(micros):
+    return datetime.fromtimestamp(0, tz=timezone.utc) + timedelta(microseconds=int(micros))
+
+
+def _keys(user_ids, movie_ids):
+    return (user_ids.astype(np.int64) << 32) | movie_ids.astype(np.int64)
+
+
+def _deleted(keys, ts, deleted_keys, deleted_at):
+    """
+    :param keys: the keys of the cached ratings
+    :param ts: the timestamps of the cached ratings
+    :param deleted_keys: the keys of the deleted ratings
+    :param deleted_at: the deletion timestamps of the deleted ratings
+    :return: a boolean mask of the cached ratings that are older than the latest deletion of their key
+    """
+    if len(deleted_keys) == 0:
+        return np.zeros(len(keys), dtype=bool)
+
+    order = np.argsort(deleted_keys, kind='mergesort')
+    deleted_keys, deleted_at = deleted_keys[order], deleted_at[order]
+    unique_keys, starts = np.unique(deleted_keys, return_index=True)
+    latest_deleted_at = np.maximum.reduceat(deleted_at, starts)
+
+    positions = np.minimum(np.searchsorted(unique_keys, keys), len(unique_keys) - 1)
+    matched = unique_keys[positions] == keys
+
+    return matched & (ts < latest_deleted_at[positions])
+
+
+class RatingsCache:
+    """
+    Local columnar cache of the ratings table, i.e., int32 user/movie ids, float32 ratings and int64 timestamps
+    (microseconds since epoch), which is persisted in a single '.npz' file.
+
+    On each refresh only the ratings that have been written after the last watermark are fetched, together with
+    the ratings that have been deleted since then (see table 'recommendation_ratings_deletions'), and they are
+    applied to the cached columns. The watermark follows the write time of the ratings (i.e., column written_at,
+    which the database sets), not their ts, since a queued rating event is written with its original ts, possibly
+    long after it happened (see RatingEventQueue). Every full_reload_every refreshes, the cache is fully reconciled
+    with the database.
+
+    A deletion may be fetched again by later refreshes (within the overlap), thus it removes a cached rating only
+    when the rating is older than the deletion, i.e., it does not remove a rating that has been re-inserted after it.
+    The deletions watermark follows the clock of the database, which also sets the deletion timestamps.
+    """
+
+    log = logging.getLogger(__name__)
+
+    COLUMNS = ('user_id', 'movie_id', 'rating', 'ts')
+    DTYPES = (np.int32, np.int32, np.float32, np.int64)
+
+    def __init__(self, db, path, full_reload_every, overlap_seconds):
+        self.db = db
+        self.path = path
+        self.full_reload_every = full_reload_every
+        self.overlap_micros = int(overlap_seconds * 1e6)
+
+        self.columns = None
+        self.watermark = 0
+        self.deletions_watermark = 0
+        self.refreshes_since_full = 0
+
+    @property
+    def file_path(self):
+        return os.path.join(self.path, 'ratings.npz')
+
+    def _load_file(self):
+        if self.columns is not None or not os.path.exists(self.file_path):
+            return
+
+        with np.load(self.file_path) as cached:
+            self.columns = {name: cached[name] for name in self.COLUMNS}
+            self.watermark = int(cached['watermark'])
+            self.deletions_watermark = int(cached['deletions_watermark'])
+            self.refreshes_since_full = int(cached['refreshes_since_full'])
+
+        self.log.debug(f"Loaded {len(self.columns['user_id'])} cached ratings from '{self.file_path}'")
+
+    def _save_file(self):
+        os.makedirs(self.path, exist_ok=True)
+
+        tmp_file_path = os.path.join(self.path, f'.ratings-{os.getpid()}.npz')
+        np.savez(tmp_file_path,
+                 watermark=self.watermark,
+                 deletions_watermark=self.deletions_watermark,
+                 refreshes_since_full=self.refreshes_since_full,
+                 **self.columns)
+
+        os.replace(tmp_file_path, self.file_path)
+
+    def _read_ratings(self, query):
+        """
+        :return: the cached columns of the ratings of the query, as well as the latest write time (in microseconds
+                 since epoch) of them, which is None when there are no ratings
+        """
+        df = pd.read_sql(query.statement, con=self.db.engine)
+
+        columns = {
+            'user_id': df['user_id'].values.astype(np.int32),
+            'movie_id': df['movie_id'].values.astype(np.int32),
+            'rating': df['rating'].values.astype(np.float32),
+            'ts': _to_micros(df['ts'])
+        }
+
+        return columns, int(_to_micros(df['written_at']).max()) if len(df.index) > 0 else None
+
+    def _db_now(self):
+        """
+        :return: the current time of the database clock, in microseconds since epoch
+        """
+        now = self.db.session.query(func.now()).scalar()
+        now = now if now.tzinfo is not None else now.replace(tzinfo=timezone.utc)
+
+        return (now - datetime.fromtimestamp(0, tz=timezone.utc)) // timedelta(microseconds=1)
+
+    def _full_reload(self):
+        # the deletions that happen during the full load, are applied by the next refresh
+        self.deletions_watermark = self._db_now() - self.overlap_micros
+
+        query = self.db.session.query(Rating.user_id, Rating.movie_id, Rating.rating, Rating.ts, Rating.written_at)
+        self.columns, written_at = self._read_ratings(query)
+        self.watermark = 0 if written_at is None else written_at
+        self.refreshes_since_full = 0
+
+        self.db.session \
+            .query(RatingDeletion) \
+            .filter(RatingDeletion.deleted_at < _from_micros(self.deletions_watermark)) \
+            .delete(synchronize_session=False)
+        self.db.session.commit()
+
+    def _apply_changes(self):
+        since = self.watermark - self.overlap_micros
+        deletions_since = self.deletions_watermark - self.overlap_micros
+
+        # the deletions that happen from now on, are fetched by the next refresh
+        refresh_start = self._db_now()
+
+        deletions = pd.read_sql(
+            self.db.session
+                .query(RatingDeletion.user_id, RatingDeletion.movie_id, RatingDeletion.deleted_at)
+                .filter(RatingDeletion.deleted_at > _from_micros(deletions_since))
+                .statement,
+            con=self.db.engine)
+
+        changes, written_at = self._read_ratings(
+            self.db.session
+                .query(Rating.user_id, Rating.movie_id, Rating.rating, Rating.ts, Rating.written_at)
+                .filter(Rating.written_at > _from_micros(since)))
+
+        cached_keys = _keys(self.columns['user_id'], self.columns['movie_id'])
+
+        # first remove the cached ratings that are older than their deletion, as well as the previous versions of
+        # the changed ones, then append the changed ratings (which are the current ones, even if they have been
+        # re-inserted after a deletion)
+        deleted = _deleted(cached_keys, self.columns['ts'],
+                           _keys(deletions['user_id'].values, deletions['movie_id'].values),
+                           _to_micros(deletions['deleted_at']))
+        keep = ~deleted & ~np.isin(cached_keys, _keys(changes['user_id'], changes['movie_id']))
+
+        self.columns = {name: np.concatenate([self.columns[name][keep], changes[name]]).astype(dtype)
+                        for name, dtype in zip(self.COLUMNS, self.DTYPES)}
+
+        if written_at is not None:
+            self.watermark = max(self.watermark, written_at)
+        self.deletions_watermark = max(self.deletions_watermark, refresh_start)
+
+        self.refreshes_since_full += 1
+
+        self.log.debug(f"Applied {len(changes['ts'])} changed and {len(deletions.index)} deleted ratings "
+                       f"to the ratings cache")
+
+    def refresh(self):
+        """
+        Brings the cache up to date with the database, either incrementally or by a full reload
+
+        :return: a DataFrame with the columns user_id, movie_id, rating and ts of all ratings
+        """
+        start_time = time.time()
+
+        self._load_file()
+
+        if self.columns is None or self.refreshes_since_full >= self.full_reload_every - 1:
+            self.log.debug("Fully reloading the ratings cache")
+            self._full_reload()
+        else:
+            self._apply_changes()
+
+        self._save_file()
+
+        end_time = time.time()
+        self.log.info(f"Time spend refreshing the ratings cache of {len(self.columns['user_id'])} ratings: "
+                      f"{end_time - start_time} seconds")
+
+        return pd.DataFrame(self.columns, columns=self.COLUMNS)
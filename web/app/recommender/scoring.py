@@ -0,0 +1,251 @@
+# -*- coding: utf-8 -*-
+import numpy as np
+from scipy import sparse
+
+
+class FactorModel:
+    """
+    Dense, array-based view of a trained (biased) SVD model. The estimation of a rating is the
+    same as in scikit-surprise, i.e., global_mean + bu + bi + qi * pu, however all parameters are kept
+    as contiguous NumPy arrays, together with the mapping of raw ids to their inner (row) ids.
+    """
+
+    def __init__(self, global_mean, bu, bi, pu, qi, raw_uids, raw_iids, rating_scale=(0.5, 5.0)):
+        self.global_mean = float(global_mean)
+        self.bu = np.ascontiguousarray(bu, dtype=np.float32)
+        self.bi = np.ascontiguousarray(bi, dtype=np.float32)
+        self.pu = np.ascontiguousarray(pu, dtype=np.float32)
+        self.qi = np.ascontiguousarray(qi, dtype=np.float32)
+        self.raw_uids = np.asarray(raw_uids)
+        self.raw_iids = np.asarray(raw_iids)
+        self.rating_scale = rating_scale
+
+        self._inner_uids = None
+        self._inner_iids = None
+
+        # optional top-K retrieval index over the item factors (see app.recommender.index)
+        self.index = None
+
+    @property
+    def inner_uids(self):
+        if self._inner_uids is None:
+            self._inner_uids = {raw_uid: inner_uid for inner_uid, raw_uid in enumerate(self.raw_uids.tolist())}
+        return self._inner_uids
+
+    @property
+    def inner_iids(self):
+        if self._inner_iids is None:
+            self._inner_iids = {raw_iid: inner_iid for inner_iid, raw_iid in enumerate(self.raw_iids.tolist())}
+        return self._inner_iids
+
+    @property
+    def n_users(self):
+        return self.pu.shape[0]
+
+    @property
+    def n_items(self):
+        return self.qi.shape[0]
+
+    @classmethod
+    def from_svd(cls, model):
+        """
+        Creates a FactorModel from a fitted scikit-surprise SVD model
+
+        :param model: the fitted SVD model
+        :return: the resulting FactorModel
+        """
+        trainset = model.trainset
+
+        raw_uids = [trainset.to_raw_uid(inner_uid) for inner_uid in range(trainset.n_users)]
+        raw_iids = [trainset.to_raw_iid(inner_iid) for inner_iid in range(trainset.n_items)]
+
+        if model.biased:
+            global_mean, bu, bi = trainset.global_mean, model.bu, model.bi
+        else:
+            global_mean, bu, bi = 0.0, np.zeros(trainset.n_users), np.zeros(trainset.n_items)
+
+        return cls(global_mean, bu, bi, model.pu, model.qi, raw_uids, raw_iids, trainset.rating_scale)
+
+
+def rated_matrix(trainset):
+    """
+    Builds a sparse (users x items) boolean matrix, indexed by inner ids, where an entry exists
+    for every item that the user has already rated.
+
+    :param trainset: the scikit-surprise Trainset
+    :return: a scipy.sparse CSR matrix
+    """
+    lengths = np.fromiter((len(trainset.ur[inner_uid]) for inner_uid in range(trainset.n_users)),
+                          dtype=np.int64, count=trainset.n_users)
+
+    indptr = np.zeros(trainset.n_users + 1, dtype=np.int64)
+    np.cumsum(lengths, out=indptr[1:])
+
+    indices = np.fromiter((inner_iid for inner_uid in range(trainset.n_users)
+                           for (inner_iid, _) in trainset.ur[inner_uid]),
+                          dtype=np.int32, count=int(indptr[-1]))
+
+    data = np.ones(len(indices), dtype=np.bool_)
+
+    result = sparse.csr_matrix((data, indices, indptr), shape=(trainset.n_users, trainset.n_items))
+    result.sort_indices()
+
+    return result
+
+
+def score_block(factors, start, stop):
+    """
+    Computes the estimated ratings of the users in [start, stop) for all items, using a single matrix product.
+
+    :return: a dense (stop - start) x n_items float32 array
+    """
+    scores = factors.pu[start:stop].dot(factors.qi.T)
+    scores += factors.bi[np.newaxis, :]
+    scores += factors.bu[start:stop, np.newaxis]
+    scores += factors.global_mean
+
+    return scores
+
+
+def top_n_of_scores(scores, n):
+    """
+    Ranks each row of the given scores and keeps the n highest ones. Entries having -inf
+    score (i.e., masked ones) are expected to be filtered out by the caller.
+
+    :param scores: a dense 2D array of scores
+    :param n: the number of top entries to keep
+    :return: a tuple of the (rows x n) column indices and their corresponding scores, sorted in descending order
+    """
+    n_rows, n_cols = scores.shape
+    k = min(n, n_cols)
+
+    if k < n_cols:
+        top = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+    else:
+        top = np.tile(np.arange(n_cols), (n_rows, 1))
+
+    row_index = np.arange(n_rows)[:, np.newaxis]
+    top_scores = scores[row_index, top]
+
+    order = np.argsort(-top_scores, axis=1, kind='mergesort')
+
+    return top[row_index, order], top_scores[row_index, order]
+
+
+def top_n_block(factors, rated, start, stop, n):
+    """
+    Scores a block of users [start, stop), masks the items that they have already rated and gives their top-n items
+
+    :param factors: the FactorModel
+    :param rated: the sparse matrix of rated items (see rated_matrix)
+    :param start: the first inner user id of the block
+    :param stop: the last (exclusive) inner user id of the block
+    :param n: the number of recommendations per user
+    :return: a tuple of the (block x n) inner item ids and their corresponding scores
+    """
+    scores = score_block(factors, start, stop)
+
+    block = rated[start:stop]
+    rows = np.repeat(np.arange(stop - start), np.diff(block.indptr))
+    scores[rows, block.indices] = -np.inf
+
+    return top_n_of_scores(scores, n)
+
+
+def iter_top_n_blocks(factors, rated, n, block_size, first_user=0, last_user=None):
+    """
+    Iterates over the users of the model (by default all of them, otherwise the inner user ids in
+    [first_user, last_user)) in blocks of block_size users, giving the top-n items of each user.
+    The peak memory is bounded by block_size x n_items scores. When the model has a retrieval index,
+    the top-n items are retrieved by the index.
+
+    :return: a generator of blocks, each block is a list of (raw_uid, [(raw_iid, estimation), ...]) pairs
+    """
+    lower_bound, upper_bound = factors.rating_scale
+    last_user = factors.n_users if last_user is None else min(last_user, factors.n_users)
+
+    for start in range(first_user, last_user, block_size):
+        stop = min(start + block_size, last_user)
+
+        if factors.index is not None:
+            top_items, top_scores = factors.index.top_n_block(factors, rated, start, stop, n)
+        else:
+            top_items, top_scores = top_n_block(factors, rated, start, stop, n)
+
+        top_scores = np.where(np.isfinite(top_scores), np.clip(top_scores, lower_bound, upper_bound), np.nan)
+
+        block_result = []
+        for offset, raw_uid in enumerate(factors.raw_uids[start:stop].tolist()):
+            valid = ~np.isnan(top_scores[offset])
+            raw_iids = factors.raw_iids[top_items[offset][valid]].tolist()
+            estimations = top_scores[offset][valid].tolist()
+
+            if len(raw_iids) > 0:
+                block_result.append((raw_uid, list(zip(raw_iids, estimations))))
+
+        yield block_result
+
+
+def solve_ridge(vectors, biases, global_mean, ratings, reg):
+    """
+    Gives the regularized least-squares solution of a bias and a latent vector, given the fixed latent vectors
+    and biases of the other side (e.g., of the items that a user has rated), that is:
+
+        min sum_j (r_j - global_mean - b_j - b - v_j * w)^2 + reg * (b^2 + ||w||^2)
+
+    :return: a tuple of the bias b and the latent vector w
+    """
+    x = np.empty((len(vectors), vectors.shape[1] + 1), dtype=np.float64)
+    x[:, 0] = 1.0
+    x[:, 1:] = vectors
+
+    y = np.asarray(ratings, dtype=np.float64) - global_mean - biases
+
+    a = x.T.dot(x)
+    a[np.diag_indices_from(a)] += reg
+    w = np.linalg.solve(a, x.T.dot(y))
+
+    return w[0], w[1:]
+
+
+def fold_in_user(factors, inner_iids, ratings, reg):
+    """
+    Estimates the bias and the latent vector of a single user, while keeping fixed the item factors and biases of the
+    model (see solve_ridge). Like in the SVD, the regularization is scaled by the number of ratings of the user.
+
+    :param factors: the FactorModel
+    :param inner_iids: the inner ids of the items that the user has rated
+    :param ratings: the corresponding ratings of the user
+    :param reg: the regularization term (per rating)
+    :return: a tuple of the user bias and the user latent vector
+    """
+    inner_iids = np.asarray(inner_iids, dtype=np.int64)
+
+    return solve_ridge(factors.qi[inner_iids], factors.bi[inner_iids], factors.global_mean, ratings,
+                       reg * len(inner_iids))
+
+
+def top_n_of_user(factors, bu, pu, exclude_inner_iids, n):
+    """
+    Scores all items (or retrieves them by the index of the model, when exists) for a single user and gives
+    the top-n of them, excluding the specified ones
+
+    :return: a list of (raw_iid, estimation) pairs, sorted in descending order of estimation
+    """
+    if factors.index is not None:
+        top_items, top_scores = factors.index.search(pu, n, exclude_inner_iids)
+        top_scores = top_scores + np.float32(bu + factors.global_mean)
+    else:
+        scores = factors.qi.dot(np.asarray(pu, dtype=np.float32))
+        scores += factors.bi
+        scores += np.float32(bu + factors.global_mean)
+        scores[np.asarray(exclude_inner_iids, dtype=np.int64)] = -np.inf
+
+        top_items, top_scores = top_n_of_scores(scores[np.newaxis, :], n)
+        top_items, top_scores = top_items[0], top_scores[0]
+
+    valid = np.isfinite(top_scores)
+    lower_bound, upper_bound = factors.rating_scale
+
+    return list(zip(factors.raw_iids[top_items[valid]].tolist(),
+                    np.clip(top_scores[valid], lower_bound, upper_bound).tolist()))
@@ -0,0 +1,221 @@
+# -*- coding: utf-8 -*-
+import itertools
+import logging
+import re
+import time
+import redis
+from app.models import Rating, User
+
+
+class SeenMovies:
+    """
+    Per-user sets of the movies that each user has rated or watched, which are kept in redis (key 'seen:<user_id>')
+    in order to exclude them from the recommendations without querying PostgreSQL. Redis stores small sets of
+    integers compactly (as intsets).
+
+    The sets are updated by each rating/watch action of a user and they are periodically rebuilt from the ratings
+    table. The key 'seen:ready' marks that the sets have been built at least once, before that readers should not
+    trust a missing set.
+
+    While a rebuild runs (key 'seen:rebuilding'), the actions of each user are also journaled (key
+    'seen:<user_id>:ops', the latest action per movie), and they are applied to the rebuilt set of the user when it
+    replaces the current one. Thus the rebuild removes the stale movies without losing the actions that its snapshot
+    of the ratings table has missed.
+    """
+
+    log = logging.getLogger(__name__)
+
+    READY_KEY = 'seen:ready'
+    REBUILDING_KEY = 'seen:rebuilding'
+
+    # Gives the members of a seen set, or nil when the seen sets have not been built yet
+    GET_SCRIPT = """
+        if redis.call('EXISTS', KEYS[1]) == 1 then
+            return redis.call('SMEMBERS', KEYS[2])
+        else
+            return false
+        end
+    """
+
+    # Adds (ARGV[2] is 1) or removes (ARGV[2] is 0) the movie ARGV[1] to/from the set KEYS[1], and journals the
+    # action to KEYS[3] while a rebuild runs
+    UPDATE_SCRIPT = """
+        if ARGV[2] == '1' then
+            redis.call('SADD', KEYS[1], ARGV[1])
+        else
+            redis.call('SREM', KEYS[1], ARGV[1])
+        end
+        if redis.call('EXISTS', KEYS[2]) == 1 then
+            redis.call('HSET', KEYS[3], ARGV[1], ARGV[2])
+        end
+    """
+
+    # Applies the journaled actions KEYS[2] to the rebuilt set KEYS[1], then replaces the set KEYS[3] with it
+    REPLACE_SCRIPT = """
+        local ops = redis.call('HGETALL', KEYS[2])
+        for i = 1, #ops, 2 do
+            if ops[i + 1] == '1' then
+                redis.call('SADD', KEYS[1], ops[i])
+            else
+                redis.call('SREM', KEYS[1], ops[i])
+            end
+        end
+        if redis.call('EXISTS', KEYS[1]) == 1 then
+            redis.call('RENAME', KEYS[1], KEYS[3])
+        else
+            redis.call('DEL', KEYS[3])
+        end
+        redis.call('DEL', KEYS[2])
+    """
+
+    SET_KEY_PATTERN = re.compile(rb'^seen:(\d+)$')
+
+    def __init__(self, db, redis_pool, redis_chunk_size):
+        self.db = db
+        self.redis_client = redis.Redis(connection_pool=redis_pool)
+        self.redis_chunk_size = redis_chunk_size
+        self._get_script = self.redis_client.register_script(self.GET_SCRIPT)
+        self._update_script = self.redis_client.register_script(self.UPDATE_SCRIPT)
+        self._replace_script = self.redis_client.register_script(self.REPLACE_SCRIPT)
+
+    @staticmethod
+    def key(user_id):
+        return f'seen:{user_id}'
+
+    @staticmethod
+    def ops_key(user_id):
+        return f'seen:{user_id}:ops'
+
+    @staticmethod
+    def rebuilt_key(user_id):
+        return f'seen:{user_id}:rebuilt'
+
+    def _update(self, user_id, movie_id, added, client):
+        self._update_script(keys=[self.key(user_id), self.REBUILDING_KEY, self.ops_key(user_id)],
+                            args=[movie_id, 1 if added else 0],
+                            client=self.redis_client if client is None else client)
+
+    def add(self, user_id, movie_id, client=None):
+        self._update(user_id, movie_id, True, client)
+
+    def remove(self, user_id, movie_id, client=None):
+        self._update(user_id, movie_id, False, client)
+
+    def delete(self, user_id, client=None):
+        (self.redis_client if client is None else client).delete(self.key(user_id), self.ops_key(user_id))
+
+    def contains(self, user_id, movie_id):
+        return self.redis_client.sismember(self.key(user_id), movie_id)
+
+    def get(self, user_id, client=None):
+        """
+        Gives the seen set of a user (using a single round trip)
+
+        :param user_id: the id of the user
+        :param client: optionally, a pipeline to execute the command, its result should be converted with parse
+        :return: the set of movie ids, or None when the seen sets have not been built yet
+        """
+        if client is not None:
+            return self._get_script(keys=[self.READY_KEY, self.key(user_id)], client=client)
+
+        return self.parse(self._get_script(keys=[self.READY_KEY, self.key(user_id)]))
+
+    @staticmethod
+    def parse(members):
+        return None if members is None else {int(movie_id) for movie_id in members}
+
+    def _replace(self, user_id, client):
+        self._replace_script(keys=[self.rebuilt_key(user_id), self.ops_key(user_id), self.key(user_id)],
+                             client=client)
+
+    def _execute_rebuilt(self, pipe, user_ids):
+        """
+        Executes the commands of the rebuilt sets of the specified users, then deletes the sets of the users that
+        have been deleted meanwhile (a user is deleted from the database before its set)
+        """
+        pipe.execute()
+
+        if len(user_ids) == 0:
+            return
+
+        existing = {user_id for (user_id,) in self.db.session
+                    .query(User.user_id)
+                    .filter(User.user_id.in_(user_ids))}
+
+        deleted = [user_id for user_id in user_ids if user_id not in existing]
+        if len(deleted) > 0:
+            self.redis_client.delete(*[key for user_id in deleted
+                                       for key in (self.key(user_id), self.ops_key(user_id))])
+
+    def _delete_journals(self):
+        """
+        Deletes the journals and the rebuilt sets that are left by a rebuild
+        """
+        for pattern in ('seen:*:ops', 'seen:*:rebuilt'):
+            keys = list(self.redis_client.scan_iter(match=pattern, count=self.redis_chunk_size))
+            for i in range(0, len(keys), self.redis_chunk_size):
+                self.redis_client.delete(*keys[i:i + self.redis_chunk_size])
+
+    def rebuild(self, before_snapshot=None):
+        """
+        Rebuilds the seen sets of all users from the ratings table. The ratings of the existing users are streamed
+        (ordered by user) using a server-side cursor into a new set per user, which replaces the current set after
+        the actions that have been journaled since the start of the rebuild are applied to it. The sets of the users
+        without ratings are replaced in the same way at the end.
+
+        :param before_snapshot: optionally, a function that is called after the journaling starts and before the
+                                ratings are read, e.g., in order to wait for the write-behind queue to write the
+                                actions that have not been journaled
+        """
+        start_time = time.time()
+
+        # the journals of an interrupted rebuild are stale
+        self._delete_journals()
+        self.redis_client.set(self.REBUILDING_KEY, 1)
+
+        if before_snapshot is not None:
+            before_snapshot()
+
+        query = self.db.session \
+            .query(Rating.user_id, Rating.movie_id) \
+            .join(User, User.user_id == Rating.user_id) \
+            .order_by(Rating.user_id) \
+            .yield_per(self.redis_chunk_size)
+
+        counter = 0
+        rebuilt = set()
+        with self.redis_client.pipeline(transaction=False) as pipe:
+            user_ids = []
+            for user_id, ratings in itertools.groupby(query, key=lambda r: r.user_id):
+                pipe.delete(self.rebuilt_key(user_id))
+                pipe.sadd(self.rebuilt_key(user_id), *[movie_id for (_, movie_id) in ratings])
+                self._replace(user_id, pipe)
+                user_ids.append(user_id)
+                rebuilt.add(user_id)
+
+                counter += 1
+                if counter % self.redis_chunk_size == 0:
+                    self._execute_rebuilt(pipe, user_ids)
+                    user_ids = []
+                    self.log.debug(f'Current number of rebuilt seen sets: {counter}')
+
+            self._execute_rebuilt(pipe, user_ids)
+
+            # the sets of the users without ratings have only the journaled actions left
+            for key in self.redis_client.scan_iter(match='seen:*', count=self.redis_chunk_size):
+                match = self.SET_KEY_PATTERN.match(key)
+                if match is not None and int(match.group(1)) not in rebuilt:
+                    self._replace(int(match.group(1)), pipe)
+                    counter += 1
+                    if counter % self.redis_chunk_size == 0:
+                        pipe.execute()
+            pipe.execute()
+
+            pipe.delete(self.REBUILDING_KEY)
+            pipe.set(self.READY_KEY, 1)
+            pipe.execute()
+
+        self._delete_journals()
+
+        end_time = time.time()
+        self.log.info(f'Time spend rebuilding the seen sets of {counter} users: {end_time - start_time} seconds')
@@ -0,0 +1,184 @@
+# -*- coding: utf-8 -*-
+import json
+import logging
+import os
+import shutil
+import threading
+import time
+import uuid
+import numpy as np
+from app.recommender.scoring import FactorModel
+from app.recommender.index import INDEX_TYPES
+
+
+class SnapshotStore:
+    """
+    Versioned, on-disk snapshots of trained models. Each snapshot is a directory (e.g., 'v1538312120123-3f2a9c1e',
+    i.e., the creation time in milliseconds and a random suffix, thus saves in the same millisecond never collide)
+    that contains the factor matrices, the biases and the raw ids of users and items as contiguous '.npy' arrays,
+    together with a small 'manifest.json'. When the model has a retrieval index, its arrays are stored next to the
+    model as 'index_<name>.npy'. The file 'CURRENT' points to the latest published snapshot.
+
+    Snapshots are written in a temporary directory which is atomically renamed when complete, while 'CURRENT' is
+    atomically replaced. Therefore, readers never see a partially written snapshot. Snapshots are loaded as
+    read-only memory maps, thus loading is fast and the memory is shared between processes through the page cache.
+    """
+
+    FORMAT_VERSION = 1
+    CURRENT = 'CURRENT'
+    MANIFEST = 'manifest.json'
+    ARRAYS = ('bu', 'bi', 'pu', 'qi', 'raw_uids', 'raw_iids')
+
+    log = logging.getLogger(__name__)
+
+    def __init__(self, path, keep, index_n_probe=8):
+        self.path = path
+        self.keep = keep
+        self.index_n_probe = index_n_probe
+        self._lock = threading.Lock()
+        self._loaded = (None, None)
+
+    def save(self, factors):
+        """
+        Writes and publishes a new snapshot of the given model
+
+        :param factors: the FactorModel to save
+        :return: the version of the resulting snapshot
+        """
+        start_time = time.time()
+
+        os.makedirs(self.path, exist_ok=True)
+
+        version = f'v{int(time.time() * 1000)}-{uuid.uuid4().hex[:8]}'
+        tmp_path = os.path.join(self.path, f'.tmp-{version}-{os.getpid()}')
+        os.makedirs(tmp_path)
+
+        for name in self.ARRAYS:
+            np.save(os.path.join(tmp_path, name + '.npy'), np.ascontiguousarray(getattr(factors, name)),
+                    allow_pickle=False)
+
+        index_type = None
+        if factors.index is not None:
+            index_type = factors.index.TYPE
+            for name, array in factors.index.arrays().items():
+                np.save(os.path.join(tmp_path, 'index_' + name + '.npy'), np.ascontiguousarray(array),
+                        allow_pickle=False)
+
+        manifest = {
+            'format_version': self.FORMAT_VERSION,
+            'version': version,
+            'created': time.time(),
+            'global_mean': factors.global_mean,
+            'rating_scale': list(factors.rating_scale),
+            'n_users': factors.n_users,
+            'n_items': factors.n_items,
+            'n_factors': factors.qi.shape[1],
+            'index': index_type
+        }
+
+        with open(os.path.join(tmp_path, self.MANIFEST), 'w') as manifest_file:
+            json.dump(manifest, manifest_file)
+
+        os.rename(tmp_path, os.path.join(self.path, version))
+        self._publish(version)
+
+        end_time = time.time()
+        self.log.info(f'Time spend saving model snapshot {version}: {end_time - start_time} seconds')
+
+        self._cleanup(version)
+
+        return version
+
+    def _publish(self, version):
+        tmp_current = os.path.join(self.path, f'.{self.CURRENT}-{os.getpid()}')
+
+        with open(tmp_current, 'w') as current_file:
+            current_file.write(version)
+            current_file.flush()
+            os.fsync(current_file.fileno())
+
+        os.replace(tmp_current, os.path.join(self.path, self.CURRENT))
+
+    @staticmethod
+    def _version_time(version):
+        """
+        :return: the creation time (in milliseconds) of the given version
+        """
+        return int(version[1:].split('-')[0])
+
+    def _cleanup(self, current_version):
+        versions = sorted((v for v in os.listdir(self.path) if v.startswith('v')), key=self._version_time)
+
+        for version in versions[:-self.keep] if self.keep > 0 else []:
+            if version != current_version:
+                self.log.debug(f'Removing old model snapshot {version}')
+                shutil.rmtree(os.path.join(self.path, version), ignore_errors=True)
+
+    def current_version(self):
+        """
+        :return: the version of the latest published snapshot, or None when no snapshot exists
+        """
+        try:
+            with open(os.path.join(self.path, self.CURRENT)) as current_file:
+                return current_file.read().strip() or None
+        except FileNotFoundError:
+            return None
+
+    def load(self, version):
+        """
+        Memory-maps the specified snapshot
+
+        :param version: the version of the snapshot
+        :return: the FactorModel of the snapshot
+        """
+        start_time = time.time()
+
+        version_path = os.path.join(self.path, version)
+
+        with open(os.path.join(version_path, self.MANIFEST)) as manifest_file:
+            manifest = json.load(manifest_file)
+
+        if manifest.get('format_version') != self.FORMAT_VERSION:
+            raise ValueError(f"Unsupported format version of model snapshot {version}: "
+                             f"{manifest.get('format_version')}")
+
+        arrays = {name: np.load(os.path.join(version_path, name + '.npy'), mmap_mode='r', allow_pickle=False)
+                  for name in self.ARRAYS}
+
+        factors = FactorModel(manifest['global_mean'],
+                              arrays['bu'], arrays['bi'], arrays['pu'], arrays['qi'],
+                              arrays['raw_uids'], arrays['raw_iids'],
+                              tuple(manifest['rating_scale']))
+
+        index_type = manifest.get('index')
+        if index_type is not None:
+            index_arrays = {name[len('index_'):-len('.npy')]: np.load(os.path.join(version_path, name),
+                                                                      mmap_mode='r', allow_pickle=False)
+                            for name in os.listdir(version_path) if name.startswith('index_')}
+            factors.index = INDEX_TYPES[index_type].from_arrays(factors, index_arrays, n_probe=self.index_n_probe)
+
+        end_time = time.time()
+        self.log.debug(f'Time spend loading model snapshot {version}: {end_time - start_time} seconds')
+
+        return factors
+
+    def latest(self):
+        """
+        Gives the latest published snapshot. The snapshot is loaded once, and it is swapped
+        when a newer snapshot is published (e.g., by another process).
+
+        :return: the FactorModel of the latest snapshot, or None when no snapshot exists
+        """
+        version = self.current_version()
+        loaded_version, factors = self._loaded
+
+        if version is None or version == loaded_version:
+            return factors
+
+        with self._lock:
+            loaded_version, factors = self._loaded
+            if version != loaded_version:
+                factors = self.load(version)
+                self._loaded = (version, factors)
+
+        return factors
@@ -1,65 +1,300 @@
 # -*- coding: utf-8 -*-
+import itertools
 import redis
 import time
 import logging
-from app.models import Rating
-from sqlalchemy import func
+import numpy as np
+from app.models import Rating, MoviePopularity
+from app.recommender.encoding import encode_popularity
+from app.recommender.generations import Generations, STATISTICS
+from app.recommender.popularity import POPULARITY_THRESHOLDS, popularity_key, rank_popularity
+from sqlalchemy import func, tuple_, text
 
 
 class MovieStatistics:
+    """
+    Statistics of the movies, i.e., the sum and the count of the explicit ratings of each movie, which are kept
+    in two redis hashes that are incrementally updated by every rating change and periodically reconciled with the
+    ratings table, as well as the precomputed popularity rankings (see calc_popularity_rankings).
+    """
 
     log = logging.getLogger(__name__)
 
-    def __init__(self, db, redis_pool, users_lower_limit, redis_chunk_size):
+    RATING_SUMS_KEY = 'stats:rating_sums'
+    RATING_COUNTS_KEY = 'stats:rating_counts'
+
+    # rating sums that differ less than that are considered equal (i.e., rounding errors of the increments)
+    SUM_TOLERANCE = 1e-6
+
+    def __init__(self, db, redis_pool, users_lower_limit, redis_chunk_size,
+                 popularity_thresholds=POPULARITY_THRESHOLDS):
         self.redis_client = redis.Redis(connection_pool=redis_pool)
         self.users_lower_limit = users_lower_limit
         self.redis_chunk_size = redis_chunk_size
+        self.popularity_thresholds = popularity_thresholds
         self.db = db
+        self.generations = Generations(self.redis_client, STATISTICS)
+
+    def popularity_query(self, thresholds=None):
+        """
+        :param thresholds: the rating limits, default is self.popularity_thresholds
+        :return: the query of the votes and the average rating of each movie, for each rating limit (it is covered
+                 by the index recommendation_ratings_movie_idx)
+        """
+        columns = [Rating.movie_id]
+        for threshold in (self.popularity_thresholds if thresholds is None else thresholds):
+            columns.append(func.count(Rating.user_id).filter(Rating.rating >= threshold))
+            columns.append(func.avg(Rating.rating).filter(Rating.rating >= threshold))
+
+        return self.db.session \
+            .query(*columns) \
+            .group_by(Rating.movie_id)
+
+    def refresh_popularity_view(self):
+        """
+        Refreshes the materialized view of the popularity of the movies (see MoviePopularity), without blocking its
+        readers
+        """
+        start_time = time.time()
+
+        self.db.session.execute(text(f'REFRESH MATERIALIZED VIEW CONCURRENTLY {MoviePopularity.__tablename__}'))
+        self.db.session.commit()
+
+        end_time = time.time()
+        self.log.info(f'Total time spend refreshing the materialized view of movie popularity: '
+                      f'{end_time - start_time} seconds')
+
+    def calc_popularity_rankings(self):
+        """
+        Computes the popularity ranking of the movies for each rating limit in self.popularity_thresholds. That is,
+        the movies in descending order of the number of ratings that are greater than or equal to the limit, and
+        then of their average. The rankings of the half-star limits are read from the materialized view of the
+        popularity of the movies (which should be refreshed first), the rest are computed with a single aggregation
+        over all ratings.
+
+        :return: a dictionary of each rating limit to a tuple of the ranked movie ids, their votes and
+                 their average ratings
+        """
+        start_time = time.time()
+
+        view_thresholds = [t for t in self.popularity_thresholds if float(t) in POPULARITY_THRESHOLDS]
+        other_thresholds = [t for t in self.popularity_thresholds if float(t) not in POPULARITY_THRESHOLDS]
+
+        rankings = {}
+
+        if len(view_thresholds) > 0:
+            rows = self.db.session \
+                .query(MoviePopularity.threshold, MoviePopularity.movie_id,
+                       MoviePopularity.votes, MoviePopularity.avg_rating) \
+                .filter(MoviePopularity.threshold.in_([float(t) for t in view_thresholds])) \
+                .all()
+
+            values = np.array(rows, dtype=np.float64).reshape(len(rows), 4)
+
+            for threshold in view_thresholds:
+                selected = values[values[:, 0] == float(threshold)]
+                rankings[threshold] = rank_popularity(selected[:, 1].astype(np.int32), selected[:, 2], selected[:, 3])
+
+        if len(other_thresholds) > 0:
+            rows = self.popularity_query(other_thresholds).all()
+
+            # missing averages (i.e., no ratings above a limit) become NaN
+            values = np.array(rows, dtype=np.float64).reshape(len(rows), 1 + 2 * len(other_thresholds))
+            movie_ids = values[:, 0].astype(np.int32)
+
+            for i, threshold in enumerate(other_thresholds):
+                rankings[threshold] = rank_popularity(movie_ids, values[:, 1 + 2 * i], values[:, 2 + 2 * i])
+
+        end_time = time.time()
+        self.log.info(f'Total time spend computing popularity rankings for rating limits '
+                      f'{self.popularity_thresholds}: {end_time - start_time} seconds')
+
+        return rankings
+
+    @staticmethod
+    def rating_delta(previous, current):
+        """
+        Gives the change of the rating sum and of the rating count of a movie, when a rating of a user changes.
+        Only explicit ratings are counted.
+
+        :param previous: the previous (rating, is_implicit) of the user, or None when the user had not rated
+        :param current: the current (rating, is_implicit) of the user, or None when the rating is deleted
+        :return: a tuple of the sum delta and of the count delta
+        """
+        sum_delta, count_delta = 0.0, 0
+
+        if previous is not None and not previous[1]:
+            sum_delta -= previous[0]
+            count_delta -= 1
+
+        if current is not None and not current[1]:
+            sum_delta += current[0]
+            count_delta += 1
+
+        return sum_delta, count_delta
+
+    def lock_previous_ratings(self, keys):
+        """
+        Gives the current ratings of the specified (user_id, movie_id) pairs, which are locked (i.e., SELECT FOR
+        UPDATE) until the end of the transaction, such that their changes give correct deltas (see rating_delta)
+
+        :param keys: a collection of (user_id, movie_id) pairs
+        :return: a dictionary of the existing (user_id, movie_id) pairs to their (rating, is_implicit, ts)
+        """
+        if len(keys) == 0:
+            return {}
+
+        return {(user_id, movie_id): (rating, is_implicit, ts)
+                for (user_id, movie_id, rating, is_implicit, ts) in self.db.session
+                .query(Rating.user_id, Rating.movie_id, Rating.rating, Rating.is_implicit, Rating.ts)
+                .filter(tuple_(Rating.user_id, Rating.movie_id).in_(list(keys)))
+                .with_for_update()}
 
-    def calc_rating_stats(self):
+    def update(self, movie_id, previous, current, client=None):
+        """
+        Incrementally updates the rating sum and the rating count of a movie (see rating_delta)
 
-        pg_start_time = time.time()
-        avg_ratings_func = func.avg(Rating.rating).label("avg_ratings")
-        count_users_func = func.count(Rating.user_id).label("count_users")
+        :param client: optionally, a pipeline to execute the commands
+        """
+        sum_delta, count_delta = self.rating_delta(previous, current)
 
-        result = self.db.session \
-            .query(Rating.movie_id, count_users_func, avg_ratings_func) \
+        client = self.redis_client if client is None else client
+
+        if count_delta != 0 or sum_delta != 0.0:
+            client.hincrbyfloat(self.RATING_SUMS_KEY, movie_id, sum_delta)
+            client.hincrby(self.RATING_COUNTS_KEY, movie_id, count_delta)
+
+    def get_avg_ratings(self, movie_ids):
+        """
+        Gives the average (explicit) ratings of the specified movies, using a single round trip
+
+        :return: a dictionary of the movie ids to their average ratings, movies that have been rated by
+                 self.users_lower_limit users or less are omitted
+        """
+        if len(movie_ids) == 0:
+            return {}
+
+        with self.redis_client.pipeline(transaction=False) as pipe:
+            pipe.hmget(self.RATING_SUMS_KEY, movie_ids)
+            pipe.hmget(self.RATING_COUNTS_KEY, movie_ids)
+            sums, counts = pipe.execute()
+
+        return {
+            movie_id: float(rating_sum) / int(count)
+            for movie_id, rating_sum, count in zip(movie_ids, sums, counts)
+            if count is not None and int(count) > self.users_lower_limit
+        }
+
+    def reconcile_query(self):
+        """
+        :return: the query of the sum and the count of the explicit ratings of each movie (it is covered by the
+                 index recommendation_ratings_movie_idx)
+        """
+        return self.db.session \
+            .query(Rating.movie_id, func.sum(Rating.rating), func.count(Rating.user_id)) \
             .filter(Rating.is_implicit.is_(False)) \
-            .group_by(Rating.movie_id) \
-            .order_by(func.count(Rating.user_id).desc()) \
-            .having(func.count(Rating.user_id) > self.users_lower_limit)\
-            .all()
+            .group_by(Rating.movie_id)
 
-        pg_end_time = time.time()
+    def reconcile_rating_stats(self, leadership=None):
+        """
+        Recomputes the rating sums and counts of all movies from the ratings table, correcting any drift of their
+        incremental maintenance. The aggregation is streamed through a server-side cursor and the current hashes are
+        read as soon as it has started (i.e., at about its snapshot). The difference of each movie is then applied
+        with increments, instead of replacing the hashes, thus the increments of the rating changes that happen
+        during the reconciliation are kept. Only the changes that are committed between the snapshot and the reading
+        of the hashes may be counted twice or not at all, until the next reconciliation.
 
-        self.log.info(f'Total time spend computing movie statistics: {pg_end_time - pg_start_time} seconds')
+        :param leadership: optionally, the LeaderElection of the calling process, which is checked before each
+                           chunk of increments (raising LeadershipLost when it has been lost), since the increments
+                           of two concurrent reconciliations would be applied twice
+        """
+        start_time = time.time()
 
-        redis_start_time = time.time()
+        result = iter(self.reconcile_query().yield_per(self.redis_chunk_size))
 
-        with self.redis_client.pipeline() as pipe:
-            pipe.multi()
+        # the snapshot of the aggregation is taken when its first rows are fetched
+        first = next(result, None)
 
-            counter = 0
-            for m_id, count_users, avg_ratings in result:
-                key_counts = 'm'+str(m_id)+"#counts"
-                value_counts = count_users
+        with self.redis_client.pipeline(transaction=True) as pipe:
+            pipe.hgetall(self.RATING_SUMS_KEY)
+            pipe.hgetall(self.RATING_COUNTS_KEY)
+            current_sums, current_counts = pipe.execute()
+
+        current_sums = {int(m_id): float(rating_sum) for m_id, rating_sum in current_sums.items()}
+        current_counts = {int(m_id): int(count_users) for m_id, count_users in current_counts.items()}
+
+        rows = [] if first is None else itertools.chain([first], result)
 
-                key_avg = 'm'+str(m_id)+"#avg"
-                value_avg = avg_ratings
+        with self.redis_client.pipeline(transaction=False) as pipe:
 
-                pipe.set(key_counts, value_counts)
-                pipe.set(key_avg, value_avg)
+            counter = 0
+            corrected = 0
+            for m_id, rating_sum, count_users in rows:
+                sum_delta = float(rating_sum) - current_sums.pop(m_id, 0.0)
+                count_delta = count_users - current_counts.pop(m_id, 0)
+
+                if count_delta != 0 or abs(sum_delta) > self.SUM_TOLERANCE:
+                    pipe.hincrbyfloat(self.RATING_SUMS_KEY, m_id, sum_delta)
+                    pipe.hincrby(self.RATING_COUNTS_KEY, m_id, count_delta)
+                    corrected += 1
 
-                counter += 2
+                counter += 1
                 if counter % self.redis_chunk_size == 0:
+                    if leadership is not None:
+                        leadership.check()
                     pipe.execute()
-                    pipe.multi()
-                    self.log.info(f'Current number of keys send to redis: {counter}')
+                    self.log.debug(f'Current number of reconciled movie statistics: {counter}')
+
+            # the movies that have no explicit ratings any more
+            for m_id in set(current_sums) | set(current_counts):
+                if current_counts.get(m_id, 0) != 0 or abs(current_sums.get(m_id, 0.0)) > self.SUM_TOLERANCE:
+                    pipe.hincrbyfloat(self.RATING_SUMS_KEY, m_id, -current_sums.get(m_id, 0.0))
+                    pipe.hincrby(self.RATING_COUNTS_KEY, m_id, -current_counts.get(m_id, 0))
+                    corrected += 1
 
+            if leadership is not None:
+                leadership.check()
             pipe.execute()
-            self.log.info(f'Total {counter} keys have been send to redis')
 
-        redis_end_time = time.time()
+        end_time = time.time()
+
+        self.log.info(f'Total time spend reconciling the statistics of {counter} movies ({corrected} corrected): '
+                      f'{end_time - start_time} seconds')
+
+    def calc_rating_stats(self, leadership=None):
+        """
+        Refreshes the materialized view of the popularity of the movies, computes the popularity rankings of the
+        movies (see calc_popularity_rankings) and publishes them to a new generation of statistics in redis
+
+        :param leadership: optionally, the LeaderElection of the calling process, which fences the activation of
+                           the new generation
+        """
+        self.refresh_popularity_view()
+
+        rankings = self.calc_popularity_rankings()
+
+        redis_start_time = time.time()
 
-        self.log.info(f'Total time spend sending movie statistics to redis: {redis_end_time - redis_start_time} seconds')
+        generation = self.generations.begin()
+
+        try:
+            with self.redis_client.pipeline(transaction=False) as pipe:
+
+                counter = 0
+                for threshold, (movie_ids, votes, avg_ratings) in rankings.items():
+                    pipe.set(self.generations.key(generation, popularity_key(threshold)),
+                             encode_popularity(movie_ids, votes, avg_ratings))
+                    counter += 1
+
+                pipe.execute()
+                self.log.info(f'Total {counter} keys have been send to redis')
+        except Exception:
+            self.generations.abort(generation)
+            raise
+
+        self.generations.activate(generation, fence=None if leadership is None else leadership.fence)
+
+        redis_end_time = time.time()
 
+        self.log.info(f'Total time spend sending movie statistics to redis: '
+                      f'{redis_end_time - redis_start_time} seconds')
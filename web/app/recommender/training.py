@@ -0,0 +1,131 @@
+# -*- coding: utf-8 -*-
+import logging
+import numpy as np
+from scipy import sparse
+from app.recommender.scoring import FactorModel, solve_ridge
+
+log = logging.getLogger(__name__)
+
+
+def ratings_matrix(trainset):
+    """
+    Builds a sparse (users x items) matrix of the ratings of the given trainset, indexed by inner ids
+
+    :param trainset: the scikit-surprise Trainset
+    :return: a scipy.sparse CSR matrix
+    """
+    users, items, ratings = zip(*trainset.all_ratings()) if trainset.n_ratings > 0 else ([], [], [])
+
+    return sparse.csr_matrix((np.asarray(ratings, dtype=np.float64), (users, items)),
+                             shape=(trainset.n_users, trainset.n_items))
+
+
+def _initial_parameters(previous_factors, previous_biases, previous_inner_ids, raw_ids,
+                        n_factors, init_mean, init_std_dev, rng):
+    """
+    Gives the initial latent vectors and biases of the given raw ids, by copying the ones of the previous
+    model when they exist, otherwise by drawing them from a normal distribution (and zero bias).
+    """
+    vectors = rng.normal(init_mean, init_std_dev, (len(raw_ids), n_factors))
+    biases = np.zeros(len(raw_ids), dtype=np.float64)
+
+    new_ids, previous_ids = [], []
+    for inner_id, raw_id in enumerate(raw_ids):
+        previous_id = previous_inner_ids.get(raw_id)
+        if previous_id is not None:
+            new_ids.append(inner_id)
+            previous_ids.append(previous_id)
+
+    vectors[new_ids] = previous_factors[previous_ids]
+    biases[new_ids] = previous_biases[previous_ids]
+
+    return vectors, biases, len(new_ids)
+
+
+def _als_half_step(matrix, fixed_vectors, fixed_biases, global_mean, reg, vectors, biases):
+    """
+    Solves in place the latent vector and the bias of every row of the given ratings matrix, while
+    the parameters of the other side (columns) are kept fixed. The regularization of each row is scaled
+    by its number of ratings (see _objective).
+    """
+    for row in range(matrix.shape[0]):
+        start, stop = matrix.indptr[row], matrix.indptr[row + 1]
+
+        if start == stop:
+            continue
+
+        cols = matrix.indices[start:stop]
+        biases[row], vectors[row] = solve_ridge(fixed_vectors[cols], fixed_biases[cols],
+                                                global_mean, matrix.data[start:stop], reg * (stop - start))
+
+
+def _objective(matrix, global_mean, bu, bi, pu, qi, reg):
+    """
+    The objective that the SGD of the scikit-surprise SVD minimizes. SVD regularizes the parameters of the user
+    and of the item on every rating, thus the regularization of each user (item) is scaled by its number of ratings:
+
+        sum_ui (r_ui - global_mean - bu - bi - pu * qi)^2 + reg * sum_ui (bu^2 + bi^2 + ||pu||^2 + ||qi||^2)
+    """
+    coo = matrix.tocoo()
+    errors = coo.data - (global_mean + bu[coo.row] + bi[coo.col] + np.einsum('ij,ij->i', pu[coo.row], qi[coo.col]))
+
+    user_counts = np.diff(matrix.indptr)
+    item_counts = np.bincount(matrix.indices, minlength=matrix.shape[1])
+
+    return np.dot(errors, errors) + reg * (np.dot(user_counts, bu * bu + np.sum(pu * pu, axis=1)) +
+                                           np.dot(item_counts, bi * bi + np.sum(qi * qi, axis=1)))
+
+
+def warm_start_fit(trainset, previous, params, max_epochs, tol):
+    """
+    Fits a biased matrix factorization model, i.e., with the same objective as the SGD of the scikit-surprise
+    SVD (see _objective), by starting from the factors and biases of the previous model. Users and items that
+    are not known to the previous model are initialized like in SVD. The optimization alternates between solving
+    the user and the item parameters (ALS), where the regularization of each user (item) is scaled by its number
+    of ratings (ALS-WR), and it converges in a few epochs when starting close to the optimum.
+    It stops after max_epochs, or earlier when the relative improvement of the objective is less than tol.
+
+    :param trainset: the scikit-surprise Trainset
+    :param previous: the FactorModel of the previous model
+    :param params: the parameters of the model (see Config.MODEL_PARAMS)
+    :param max_epochs: the maximum number of epochs
+    :param tol: the relative improvement tolerance of the objective
+    :return: the resulting FactorModel
+    """
+    n_factors = previous.pu.shape[1]
+    reg = params.get('reg_all', 0.02)
+    rng = np.random.RandomState(params.get('random_state'))
+
+    raw_uids = [trainset.to_raw_uid(inner_uid) for inner_uid in range(trainset.n_users)]
+    raw_iids = [trainset.to_raw_iid(inner_iid) for inner_iid in range(trainset.n_items)]
+
+    pu, bu, known_users = _initial_parameters(previous.pu, previous.bu, previous.inner_uids, raw_uids,
+                                              n_factors, params.get('init_mean', 0), params.get('init_std_dev', .1),
+                                              rng)
+    qi, bi, known_items = _initial_parameters(previous.qi, previous.bi, previous.inner_iids, raw_iids,
+                                              n_factors, params.get('init_mean', 0), params.get('init_std_dev', .1),
+                                              rng)
+
+    log.debug(f"Warm start from previous model: {known_users}/{trainset.n_users} known users, "
+              f"{known_items}/{trainset.n_items} known items")
+
+    by_user = ratings_matrix(trainset)
+    by_item = by_user.T.tocsr()
+    global_mean = trainset.global_mean
+
+    current_objective = _objective(by_user, global_mean, bu, bi, pu, qi, reg)
+
+    for epoch in range(max_epochs):
+        _als_half_step(by_user, qi, bi, global_mean, reg, pu, bu)
+        _als_half_step(by_item, pu, bu, global_mean, reg, qi, bi)
+
+        previous_objective, current_objective = current_objective, _objective(by_user, global_mean,
+                                                                              bu, bi, pu, qi, reg)
+        improvement = (previous_objective - current_objective) / max(previous_objective, np.finfo(np.float64).eps)
+
+        log.debug(f"Warm start epoch {epoch + 1}: objective={current_objective}, relative improvement={improvement}")
+
+        if improvement < tol:
+            break
+
+    return FactorModel(global_mean, bu, bi, pu, qi, raw_uids, raw_iids, trainset.rating_scale)
@@ -0,0 +1,142 @@
+# -*- coding: utf-8 -*-
+"""
+The trainer process, which periodically recomputes the recommendations and the movie statistics, separately from
+the web workers. Many trainer instances may run (e.g., for availability), but only the elected leader runs the jobs.
+
+Usage: python -m app.trainer
+"""
+import sys
+import time
+import logging
+import functools
+from apscheduler.schedulers.blocking import BlockingScheduler
+from datetime import datetime
+from app import app, redis_pool, estimator, movie_stats, seen_movies, rating_queue, rating_changes
+from app.leader import LeaderElection, LeadershipLost
+
+log = logging.getLogger(__name__)
+
+
+def leader_only(election, job):
+    """
+    Runs the job only when this instance is the leader. The job is given the election, in order to check the
+    leadership between its stages and to fence its final writes (see LeaderElection), and it is aborted when the
+    leadership is lost.
+    """
+    @functools.wraps(job)
+    def run():
+        if not election.is_leader:
+            log.debug(f"Skipping job '{job.__name__}', this instance is not the leader")
+            return
+
+        try:
+            job(election)
+        except LeadershipLost as e:
+            log.warning(f"Aborted job '{job.__name__}': {e}")
+
+    return run
+
+
+def trigger_recompute_recommendations(leadership):
+    app.logger.info('Recomputing recommendations...')
+
+    covered = rating_changes.begin_recompute()
+    estimator.recompute_recommendations(leadership=leadership)
+    rating_changes.end_recompute()
+
+    app.logger.info(f'Recomputed recommendations, covering {covered} changed ratings')
+
+
+def trigger_refresh_stale_users(leadership, user_ids):
+    app.logger.info(f'Refreshing recommendations of {len(user_ids)} users with changed ratings...')
+
+    for i, user_id in enumerate(user_ids):
+        try:
+            leadership.check()
+            estimator.refresh_user_recommendations(user_id)
+        except Exception:
+            rating_changes.restore_stale_users(user_ids[i:])
+            raise
+
+
+def trigger_check_rating_changes(leadership):
+    """
+    Recomputes the recommendations when enough ratings (or users) have changed since the latest re-estimation,
+    but not earlier than RECOMPUTE_MIN_MINUTES and not later than RECOMPUTE_MAX_MINUTES after it. Otherwise,
+    when RECOMPUTE_STALE_USERS_LIMIT is set and at most that many users have changed ratings, only the
+    recommendations of these users are refreshed (by folding them in the latest model).
+    """
+    n_ratings, n_users, n_stale_users, elapsed = rating_changes.pending()
+
+    app.logger.debug(f'Changes since the latest re-estimation: {n_ratings} ratings of ~{n_users} users, '
+                     f'{n_stale_users} users with stale recommendations, elapsed: {elapsed} seconds')
+
+    if elapsed is None or elapsed >= 60 * app.config.get("RECOMPUTE_MAX_MINUTES"):
+        trigger_recompute_recommendations(leadership)
+    elif elapsed >= 60 * app.config.get("RECOMPUTE_MIN_MINUTES") \
+            and (n_ratings >= app.config.get("RECOMPUTE_CHANGED_RATINGS")
+                 or n_users >= app.config.get("RECOMPUTE_CHANGED_USERS")):
+        trigger_recompute_recommendations(leadership)
+    elif n_stale_users > 0 and app.config.get("RECOMPUTE_STALE_USERS_LIMIT") > 0:
+        user_ids = rating_changes.take_stale_users(app.config.get("RECOMPUTE_STALE_USERS_LIMIT"))
+        if user_ids is not None:
+            trigger_refresh_stale_users(leadership, user_ids)
+
+
+def trigger_recompute_movie_stats(leadership):
+    app.logger.info('Recomputing movie statistics...')
+    movie_stats.calc_rating_stats(leadership=leadership)
+
+
+def trigger_reconcile_movie_stats(leadership):
+    app.logger.info('Reconciling movie statistics...')
+    movie_stats.reconcile_rating_stats(leadership=leadership)
+
+
+def trigger_flush_rating_queue(leadership):
+    rating_queue.flush()
+
+
+def trigger_rebuild_seen_movies(leadership):
+    app.logger.info('Rebuilding seen movies of users...')
+
+    # the actions that are still queued are neither in the ratings table nor journaled by the rebuild
+    def wait_rating_queue():
+        if not rating_queue.wait_written(time.time(), timeout=max(60, 10 * rating_queue.flush_interval)):
+            app.logger.warning('The queued rating events have not been written before rebuilding the seen movies, '
+                               'some of them may be missing until the next rebuild')
+
+    seen_movies.rebuild(before_snapshot=None if rating_queue is None else wait_rating_queue)
+
+
+def main():
+    logging.basicConfig(format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
+                        level=app.config.get("TRAINER_LOG_LEVEL"),
+                        stream=sys.stdout)
+
+    election = LeaderElection(redis_pool, 'trainer', ttl=app.config.get("TRAINER_LEADER_TTL"))
+    election.start()
+
+    scheduler = BlockingScheduler()
+    scheduler.add_job(leader_only(election, trigger_check_rating_changes), 'interval',
+                      seconds=app.config.get("RECOMPUTE_CHECK_SECONDS"), next_run_time=datetime.now())
+    scheduler.add_job(leader_only(election, trigger_recompute_movie_stats), 'interval',
+                      minutes=app.config.get("STAT_RECOMPUTE_MINUTES"), next_run_time=datetime.now())
+    scheduler.add_job(leader_only(election, trigger_reconcile_movie_stats), 'interval',
+                      hours=app.config.get("STAT_RECONCILE_HOURS"), next_run_time=datetime.now())
+    scheduler.add_job(leader_only(election, trigger_rebuild_seen_movies), 'interval',
+                      hours=app.config.get("SEEN_MOVIES_REBUILD_HOURS"), next_run_time=datetime.now())
+    if rating_queue is not None:
+        scheduler.add_job(leader_only(election, trigger_flush_rating_queue), 'interval',
+                          seconds=app.config.get("WRITE_BEHIND_FLUSH_INTERVAL"), coalesce=True)
+
+    try:
+        scheduler.start()
+    except (KeyboardInterrupt, SystemExit):
+        pass
+    finally:
+        election.stop()
+
+
+if __name__ == '__main__':
+    main()
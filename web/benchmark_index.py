@@ -0,0 +1,46 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import sys
+import logging
+import argparse
+
+from app import app
+from app.recommender.snapshot import SnapshotStore
+from app.recommender.index import IVFIndex, benchmark_recall
+
+log = logging.getLogger("benchmark_index")
+
+
+def main():
+    logging.basicConfig(format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
+                        level=logging.INFO,
+                        stream=sys.stdout)
+
+    parser = argparse.ArgumentParser(description="Reports the recall@N and the latency of the IVF index of the "
+                                                 "latest model snapshot, against exact scoring")
+    parser.add_argument('--top-n', type=int, default=app.config.get("TOP_N"))
+    parser.add_argument('--n-users', type=int, default=1000)
+    parser.add_argument('--n-clusters', type=int, default=app.config.get("MODEL_INDEX_N_CLUSTERS"))
+    parser.add_argument('--n-probes', type=int, nargs='+', default=[1, 2, 4, 8, 16, 32])
+    args = parser.parse_args()
+
+    store = SnapshotStore(app.config.get("MODEL_SNAPSHOT_DIR"), keep=app.config.get("MODEL_SNAPSHOT_KEEP"))
+    factors = store.latest()
+
+    if factors is None:
+        log.error(f"No model snapshot exists in '{store.path}'")
+        sys.exit(1)
+
+    index = factors.index if isinstance(factors.index, IVFIndex) else IVFIndex.build(factors, args.n_clusters)
+
+    log.info(f"Benchmarking IVF index with {index.n_clusters} clusters over {factors.n_items} movies, "
+             f"for {min(args.n_users, factors.n_users)} users")
+
+    for result in benchmark_recall(factors, index, args.top_n, args.n_users, args.n_probes):
+        log.info(f"n_probe={result['n_probe']}: recall@{args.top_n}={result['recall']:.4f}, "
+                 f"latency={result['latency_ms']:.3f} ms (exact: {result['exact_latency_ms']:.3f} ms)")
+
+
+if __name__ == '__main__':
+    main()
@@ -1,6 +1,7 @@
 # -*- coding: utf-8 -*-
 
 import os
+import tempfile
 basedir = os.path.abspath(os.path.dirname(__file__))
 
 
@@ -22,9 +23,34 @@ class Config(object):
     REDIS_HOST = os.getenv('REDIS_HOST', "localhost")
     REDIS_PORT = int(os.getenv('REDIS_PORT', "6379"))
     REDIS_DB = int(os.getenv('REDIS_DB', "0"))
+    REDIS_SCORE_TYPE = os.getenv('REDIS_SCORE_TYPE', "float16")
     DEFAULT_RATING = float(os.getenv('DEFAULT_RATING', "3.5"))
     TOP_N = int(os.getenv('TOP_N', "20"))
+    RECOMMENDATION_CANDIDATES_FACTOR = int(os.getenv('RECOMMENDATION_CANDIDATES_FACTOR', "5"))
     STAT_MOVIE_USERS_LOWER_LIMIT = int(os.getenv('STAT_MOVIE_USERS_LOWER_LIMIT', "5"))
+    STAT_RECONCILE_HOURS = int(os.getenv('STAT_RECONCILE_HOURS', "24"))
+    STAT_RECOMPUTE_MINUTES = int(os.getenv('STAT_RECOMPUTE_MINUTES', "30"))
+    RECOMPUTE_BLOCK_SIZE = int(os.getenv('RECOMPUTE_BLOCK_SIZE', "512"))
+    RECOMPUTE_QUEUE_SIZE = int(os.getenv('RECOMPUTE_QUEUE_SIZE', "2"))
+    RECOMPUTE_WORKERS = int(os.getenv('RECOMPUTE_WORKERS', "1"))
+    RECOMPUTE_CHECK_SECONDS = int(os.getenv('RECOMPUTE_CHECK_SECONDS', "60"))
+    RECOMPUTE_MIN_MINUTES = float(os.getenv('RECOMPUTE_MIN_MINUTES', "5"))
+    RECOMPUTE_MAX_MINUTES = float(os.getenv('RECOMPUTE_MAX_MINUTES', "60"))
+    RECOMPUTE_CHANGED_RATINGS = int(os.getenv('RECOMPUTE_CHANGED_RATINGS', "1000"))
+    RECOMPUTE_CHANGED_USERS = int(os.getenv('RECOMPUTE_CHANGED_USERS', "100"))
+    RECOMPUTE_STALE_USERS_LIMIT = int(os.getenv('RECOMPUTE_STALE_USERS_LIMIT', "0"))
+    ONLINE_FOLD_IN = os.getenv('ONLINE_FOLD_IN', "true").lower() == "true"
+    REALTIME_RECOMMENDATIONS = os.getenv('REALTIME_RECOMMENDATIONS', "false").lower() == "true"
+    SEEN_MOVIES_REBUILD_HOURS = int(os.getenv('SEEN_MOVIES_REBUILD_HOURS', "24"))
+    BATCH_RECOMMENDATIONS_MAX_USERS = int(os.getenv('BATCH_RECOMMENDATIONS_MAX_USERS', "10000"))
+    BATCH_RECOMMENDATIONS_CHUNK_SIZE = int(os.getenv('BATCH_RECOMMENDATIONS_CHUNK_SIZE', "500"))
+    BULK_RATINGS_MAX_ENTRIES = int(os.getenv('BULK_RATINGS_MAX_ENTRIES', "10000"))
+    BULK_RATINGS_CHUNK_SIZE = int(os.getenv('BULK_RATINGS_CHUNK_SIZE', "1000"))
+    WRITE_BEHIND = os.getenv('WRITE_BEHIND', "false").lower() == "true"
+    WRITE_BEHIND_FLUSH_SIZE = int(os.getenv('WRITE_BEHIND_FLUSH_SIZE', "5000"))
+    WRITE_BEHIND_FLUSH_INTERVAL = int(os.getenv('WRITE_BEHIND_FLUSH_INTERVAL', "1"))
+    MOVIE_CACHE_SIZE = int(os.getenv('MOVIE_CACHE_SIZE', "100000"))
+    MOVIE_CACHE_CHECK_INTERVAL = int(os.getenv('MOVIE_CACHE_CHECK_INTERVAL', "30"))
 
     MODEL_PARAMS = {
         'n_factors': int(os.getenv('MODEL_N_FACTORS', 50)),
@@ -33,6 +59,22 @@ class Config(object):
         'reg_all': float(os.getenv('MODEL_REG_ALL', 0.2))
     }
 
+    MODEL_WARM_START_EPOCHS = int(os.getenv('MODEL_WARM_START_EPOCHS', "5"))
+    MODEL_WARM_START_TOL = float(os.getenv('MODEL_WARM_START_TOL', "0.001"))
+    MODEL_COLD_RETRAIN_EVERY = int(os.getenv('MODEL_COLD_RETRAIN_EVERY', "12"))
+    MODEL_SNAPSHOT_DIR = os.getenv('MODEL_SNAPSHOT_DIR', os.path.join(tempfile.gettempdir(), 'movierec', 'snapshots'))
+    MODEL_SNAPSHOT_KEEP = int(os.getenv('MODEL_SNAPSHOT_KEEP', "3"))
+    MODEL_INDEX = os.getenv('MODEL_INDEX', "exact")
+    MODEL_INDEX_N_CLUSTERS = int(os.getenv('MODEL_INDEX_N_CLUSTERS', "0"))
+    MODEL_INDEX_N_PROBE = int(os.getenv('MODEL_INDEX_N_PROBE', "8"))
+
+    RATINGS_CACHE_DIR = os.getenv('RATINGS_CACHE_DIR', os.path.join(tempfile.gettempdir(), 'movierec', 'ratings'))
+    RATINGS_CACHE_FULL_RELOAD_EVERY = int(os.getenv('RATINGS_CACHE_FULL_RELOAD_EVERY', "24"))
+    RATINGS_CACHE_OVERLAP_SECONDS = int(os.getenv('RATINGS_CACHE_OVERLAP_SECONDS', "300"))
+
+    TRAINER_LEADER_TTL = int(os.getenv('TRAINER_LEADER_TTL', "30"))
+    TRAINER_LOG_LEVEL = os.getenv('TRAINER_LOG_LEVEL', "INFO").upper()
+
 
 class ProductionConfig(Config):
     DEBUG = False
@@ -40,4 +82,4 @@ class ProductionConfig(Config):
 
 class DevelopmentConfig(Config):
     DEVELOPMENT = True
-    DEBUG = True
\ No newline at end of file
+    DEBUG = True
@@ -0,0 +1,110 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import sys
+import json
+import logging
+import argparse
+
+from sqlalchemy import text
+from app import db, movie_stats
+from app.api.v1.routes import app_controller
+
+log = logging.getLogger("explain_queries")
+
+RATINGS_TABLE = 'recommendation_ratings'
+RATINGS_MOVIE_INDEX = 'recommendation_ratings_movie_idx'
+POPULARITY_VIEW = 'recommendation_movie_popularity'
+POPULARITY_RANK_INDEX = 'recommendation_movie_popularity_rank_idx'
+
+
+def plan_scans(plan, relation):
+    """
+    :return: the scan nodes of the given table (or view) in the given plan (recursively)
+    """
+    scans = [plan] if plan.get('Relation Name') == relation else []
+
+    for child in plan.get('Plans', []):
+        scans.extend(plan_scans(child, relation))
+
+    return scans
+
+
+def explain(query, planner_defaults, session=None):
+    """
+    :param session: optionally, the session to explain the query with, default is the session of the application
+    :return: the JSON plan of the given query
+    """
+    session = db.session if session is None else session
+    statement = query.statement.compile(dialect=session.get_bind().dialect, compile_kwargs={"literal_binds": True})
+
+    try:
+        # by default, sequential and bitmap scans are disabled, thus the check depends only on the access paths
+        # that the indexes provide and not on the size (or the statistics) of the tables
+        if not planner_defaults:
+            session.execute(text("SET LOCAL enable_seqscan = off"))
+            session.execute(text("SET LOCAL enable_bitmapscan = off"))
+
+        (result,) = session.execute(text(f"EXPLAIN (FORMAT JSON) {statement}")).fetchone()
+    finally:
+        session.rollback()
+
+    return (json.loads(result) if isinstance(result, str) else result)[0]['Plan']
+
+
+def checked_queries():
+    """
+    :return: a list of the checked queries, each one as a (name, query, relation, index) tuple of the table (or view)
+             and the index that it should read
+    """
+    return [
+        ('popularity rankings', movie_stats.popularity_query(), RATINGS_TABLE, RATINGS_MOVIE_INDEX),
+        ('movie statistics reconciliation', movie_stats.reconcile_query(), RATINGS_TABLE, RATINGS_MOVIE_INDEX),
+        ('top movies', app_controller.top_movies_query(3.5).order_by(text('count_users desc, avg_ratings desc')),
+         POPULARITY_VIEW, POPULARITY_RANK_INDEX),
+        ('top movies (not half-star rating limit)', app_controller.top_movies_query(3.75),
+         RATINGS_TABLE, RATINGS_MOVIE_INDEX)
+    ]
+
+
+def index_only_scans(query, relation, index, planner_defaults, session=None):
+    """
+    :return: a tuple of whether the query reads the relation only by index-only scans of the index, of the scans of
+             the relation and of the plan
+    """
+    plan = explain(query, planner_defaults, session)
+    scans = [(scan['Node Type'], scan.get('Index Name')) for scan in plan_scans(plan, relation)]
+
+    return len(scans) > 0 and all(scan == ('Index Only Scan', index) for scan in scans), scans, plan
+
+
+def main():
+    logging.basicConfig(format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
+                        level=logging.INFO,
+                        stream=sys.stdout)
+
+    parser = argparse.ArgumentParser(description="Manual diagnostic that checks that the aggregation queries over "
+                                                 "the ratings, as well as the queries of the top movies, can be "
+                                                 "answered by index-only scans (by default, sequential and bitmap "
+                                                 "scans are disabled)")
+    parser.add_argument('--planner-defaults', action='store_true',
+                        help="do not disable sequential and bitmap scans, i.e., check the plans that the planner "
+                             "actually chooses for the current tables")
+    args = parser.parse_args()
+
+    failures = 0
+    for name, query, relation, index in checked_queries():
+        passed, scans, plan = index_only_scans(query, relation, index, args.planner_defaults)
+
+        if passed:
+            log.info(f"Query of {name}: {scans}")
+        else:
+            failures += 1
+            log.error(f"Query of {name} does not use an index-only scan of '{index}': {scans}, "
+                      f"plan: {json.dumps(plan)}")
+
+    sys.exit(1 if failures > 0 else 0)
+
+
+if __name__ == '__main__':
+    main()
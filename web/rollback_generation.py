@@ -0,0 +1,37 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import sys
+import logging
+import argparse
+import redis
+
+from app import redis_pool
+from app.recommender.generations import Generations, RECOMMENDATIONS, STATISTICS
+
+log = logging.getLogger("rollback_generation")
+
+
+def main():
+    logging.basicConfig(format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
+                        level=logging.INFO,
+                        stream=sys.stdout)
+
+    parser = argparse.ArgumentParser(description="Instantly re-activates the previous generation of the "
+                                                 "recommendations or of the movie statistics in redis, e.g., after "
+                                                 "publishing a bad model (running it again rolls forward)")
+    parser.add_argument('namespace', choices=[RECOMMENDATIONS, STATISTICS])
+    args = parser.parse_args()
+
+    generations = Generations(redis.Redis(connection_pool=redis_pool), args.namespace)
+    generation = generations.rollback()
+
+    if generation is None:
+        log.error(f"There is no previous generation of '{args.namespace}' to roll back to")
+        sys.exit(1)
+
+    log.info(f"Generation {generation} of '{args.namespace}' is now active")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,119 @@
+# -*- coding: utf-8 -*-
+import json
+import unittest
+from datetime import datetime, timedelta, timezone
+from types import SimpleNamespace
+import fakeredis
+import redis
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+from app.controller import MovieRecController
+from app.models import Movie, Rating, User
+from app.recommender.publisher import publish_blocks
+
+
+class BatchRecommendationsTest(unittest.TestCase):
+
+    def setUp(self):
+        engine = create_engine('sqlite://')
+        for model in (User, Movie, Rating):
+            model.__table__.create(engine)
+
+        self.db = SimpleNamespace(engine=engine, session=sessionmaker(bind=engine)())
+        self.redis_pool = redis.ConnectionPool(connection_class=fakeredis.FakeConnection,
+                                               server=fakeredis.FakeServer())
+
+        self.db.session.add(User(user_id=1))
+        for movie_id in (1, 2, 3):
+            self.db.session.add(Movie(movie_id=movie_id, title=f'Movie {movie_id}'))
+        self.db.session.commit()
+
+        redis_client = redis.Redis(connection_pool=self.redis_pool)
+        redis_client.set('seen:ready', 1)
+
+        # the precomputed recommendations differ from the real-time ones
+        publish_blocks(redis_client, [[(1, [(3, 5.0)])]], chunk_size=10)
+
+        # the real-time predictions of the latest model
+        def predict_user_top_n(user_id, n, exclude_movie_ids=()):
+            predictions = [(2, 4.5), (1, 4.0)]
+            return [(movie_id, est) for (movie_id, est) in predictions if movie_id not in exclude_movie_ids][:n]
+
+        self.estimator = SimpleNamespace(predict_user_top_n=predict_user_top_n)
+
+    def tearDown(self):
+        self.db.session.close()
+
+    def controller(self, realtime):
+        return MovieRecController(self.db, self.redis_pool, default_rating=3.5, top_n=1, movie_stats=None,
+                                  estimator=self.estimator, realtime=realtime, movie_cache_check_interval=0)
+
+    @staticmethod
+    def movie_ids(recommendations):
+        return [json.loads(movie)['movie_id'] for movie in recommendations]
+
+    def test_batch_matches_single_user_recommendations(self):
+        for realtime, expected in ((False, [3]), (True, [2])):
+            controller = self.controller(realtime)
+
+            batch = dict(controller.get_batch_recommendations([1, 2], chunk_size=10))
+
+            self.assertEqual(self.movie_ids(controller.get_recommendations(1)), expected)
+            self.assertEqual(self.movie_ids(batch[1]), expected)
+            self.assertIsNone(batch[2])
+
+    def test_realtime_recommendations_exclude_seen_movies(self):
+        # e.g., a rating that is still in the write-behind queue, thus only in the seen set
+        redis.Redis(connection_pool=self.redis_pool).sadd('seen:1', 2)
+
+        self.assertEqual(self.movie_ids(self.controller(realtime=True).get_recommendations(1)), [1])
+
+
+class RatingsHistoryTest(unittest.TestCase):
+
+    def setUp(self):
+        engine = create_engine('sqlite://')
+        for model in (User, Movie, Rating):
+            model.__table__.create(engine)
+
+        self.db = SimpleNamespace(engine=engine, session=sessionmaker(bind=engine)())
+        redis_pool = redis.ConnectionPool(connection_class=fakeredis.FakeConnection, server=fakeredis.FakeServer())
+
+        now = datetime(2020, 1, 1, tzinfo=timezone.utc)
+        self.db.session.add(User(user_id=1))
+        # the watched movies 2 and 3 have no rating
+        for movie_id, rating in ((1, 4.0), (2, None), (3, None), (4, 3.0), (5, 4.0)):
+            self.db.session.add(Movie(movie_id=movie_id, title=f'Movie {movie_id}'))
+            self.db.session.add(Rating(user_id=1, movie_id=movie_id, rating=rating, is_implicit=rating is None,
+                                       ts=now + timedelta(minutes=movie_id)))
+        self.db.session.commit()
+
+        self.controller = MovieRecController(self.db, redis_pool, default_rating=3.5, top_n=1, movie_stats=None,
+                                             movie_cache_check_interval=0)
+
+    def tearDown(self):
+        self.db.session.close()
+
+    @staticmethod
+    def pages(get_page):
+        """
+        :return: the movie ids of each page, following the cursors up to the last page
+        """
+        result, after = [], None
+        while True:
+            ratings, after = get_page(after)
+            result.append([json.loads(r['movie'])['movie_id'] for r in ratings])
+            if after is None:
+                return result
+
+    def test_pages_of_latest_ratings(self):
+        self.assertEqual(self.pages(lambda after: self.controller.get_user_ratings(1, 2, after)),
+                         [[5, 4], [3, 2], [1]])
+
+    def test_pages_of_top_ratings_have_watched_movies_last(self):
+        self.assertEqual(self.pages(lambda after: self.controller.get_user_top_ratings(1, 2, after)),
+                         [[5, 1], [4, 3], [2]])
+
+
+if __name__ == '__main__':
+    unittest.main()
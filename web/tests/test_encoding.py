@@ -0,0 +1,83 @@
+# -*- coding: utf-8 -*-
+import unittest
+import numpy as np
+from app.recommender.encoding import encode_recommendations, decode_recommendations, encode_popularity, \
+    decode_popularity, HEADER, MAGIC, POPULARITY_MAGIC
+
+
+class RecommendationsEncodingTest(unittest.TestCase):
+
+    def test_round_trip(self):
+        for score_type, dtype in (('float16', np.float16), ('float32', np.float32)):
+            value = encode_recommendations([3, 1, 2], [4.5, 4.25, 3.1], score_type=score_type)
+            movie_ids, scores = decode_recommendations(value)
+
+            self.assertEqual(movie_ids.tolist(), [3, 1, 2])
+            self.assertEqual(scores.dtype, dtype)
+            np.testing.assert_array_equal(scores, np.array([4.5, 4.25, 3.1], dtype=dtype))
+
+    def test_round_trip_of_empty_list(self):
+        value = encode_recommendations([], [])
+        movie_ids, scores = decode_recommendations(value)
+
+        self.assertEqual(len(value), HEADER.size)
+        self.assertEqual(movie_ids.tolist(), [])
+        self.assertEqual(scores.tolist(), [])
+
+    def test_legacy_format(self):
+        for value in (b'3;1;2', '3;1;2'):
+            movie_ids, scores = decode_recommendations(value)
+
+            self.assertEqual(movie_ids.tolist(), [3, 1, 2])
+            self.assertTrue(np.isnan(scores).all())
+
+        for value in (b'', ''):
+            movie_ids, scores = decode_recommendations(value)
+
+            self.assertEqual(movie_ids.tolist(), [])
+            self.assertEqual(scores.tolist(), [])
+
+    def test_unsupported_version(self):
+        value = HEADER.pack(MAGIC, 99, 1, 0)
+
+        with self.assertRaises(ValueError):
+            decode_recommendations(value)
+
+
+class PopularityEncodingTest(unittest.TestCase):
+
+    def test_round_trip(self):
+        movie_ids, votes, avg_ratings = decode_popularity(encode_popularity([3, 1], [10, 7], [4.5, 3.75]))
+
+        self.assertEqual(movie_ids.tolist(), [3, 1])
+        self.assertEqual(votes.tolist(), [10, 7])
+        self.assertEqual(avg_ratings.tolist(), [4.5, 3.75])
+
+    def test_average_ratings_are_exact(self):
+        # e.g., the average of 4.0, 4.5 and 4.1 in the database, which is not rounded to float32
+        _, _, avg_ratings = decode_popularity(encode_popularity([1], [3], [4.2]))
+
+        self.assertEqual(avg_ratings.tolist(), [4.2])
+
+    def test_older_float32_format(self):
+        value = HEADER.pack(POPULARITY_MAGIC, 1, 2, 1) + np.array([3, 10], dtype='<i4').tobytes() \
+            + np.array([4.5], dtype='<f4').tobytes()
+
+        movie_ids, votes, avg_ratings = decode_popularity(value)
+
+        self.assertEqual((movie_ids.tolist(), votes.tolist(), avg_ratings.tolist()), ([3], [10], [4.5]))
+
+    def test_round_trip_of_empty_list(self):
+        movie_ids, votes, avg_ratings = decode_popularity(encode_popularity([], [], []))
+
+        self.assertEqual(movie_ids.tolist(), [])
+        self.assertEqual(votes.tolist(), [])
+        self.assertEqual(avg_ratings.tolist(), [])
+
+    def test_recommendations_are_not_popularity(self):
+        with self.assertRaises(ValueError):
+            decode_popularity(encode_recommendations([3, 1], [4.5, 3.75]))
+
+
+if __name__ == '__main__':
+    unittest.main()
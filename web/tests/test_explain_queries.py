@@ -0,0 +1,39 @@
+# -*- coding: utf-8 -*-
+import os
+import unittest
+from sqlalchemy import create_engine, text
+from sqlalchemy.orm import sessionmaker
+import explain_queries
+
+DDL_PATH = os.path.join(os.path.dirname(__file__), '..', '..', 'prototype', 'movierama_ddl.sql')
+
+
+@unittest.skipUnless(os.getenv('TEST_DATABASE_URL'), 'requires a PostgreSQL database (TEST_DATABASE_URL)')
+class IndexOnlyScansTest(unittest.TestCase):
+    """
+    The checks of explain_queries, on the schema of the DDL (in a disposable PostgreSQL database)
+    """
+
+    @classmethod
+    def setUpClass(cls):
+        engine = create_engine(os.getenv('TEST_DATABASE_URL'))
+        with open(DDL_PATH) as ddl, engine.begin() as connection:
+            connection.execute(text(ddl.read()))
+
+        cls.session = sessionmaker(bind=engine)()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.session.close()
+
+    def test_queries_use_index_only_scans(self):
+        for name, query, relation, index in explain_queries.checked_queries():
+            with self.subTest(query=name):
+                passed, scans, _ = explain_queries.index_only_scans(query, relation, index, planner_defaults=False,
+                                                                    session=self.session)
+
+                self.assertTrue(passed, f"{name} does not use an index-only scan of '{index}': {scans}")
+
+
+if __name__ == '__main__':
+    unittest.main()
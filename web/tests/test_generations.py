@@ -0,0 +1,96 @@
+# -*- coding: utf-8 -*-
+import unittest
+from unittest import mock
+import fakeredis
+import redis
+from app.leader import LeadershipLost
+from app.recommender.generations import Generations, RECOMMENDATIONS
+
+
+class GenerationsTest(unittest.TestCase):
+
+    def setUp(self):
+        self.redis_client = redis.Redis(connection_pool=redis.ConnectionPool(
+            connection_class=fakeredis.FakeConnection, server=fakeredis.FakeServer()))
+        self.generations = Generations(self.redis_client, RECOMMENDATIONS)
+
+        # reclaim synchronously, in order to check its outcome
+        patch = mock.patch.object(Generations, 'reclaim_in_background',
+                                  lambda generations, keep: generations.reclaim(keep))
+        patch.start()
+        self.addCleanup(patch.stop)
+
+    def publish(self, value, fence=None):
+        generation = self.generations.begin()
+        self.redis_client.set(self.generations.key(generation, 'u1'), value)
+        self.generations.activate(generation, fence=fence)
+
+        return generation
+
+    def get(self, key='u1'):
+        return self.generations.get(key)
+
+    def test_legacy_key_before_first_activation(self):
+        self.redis_client.set('u1', b'legacy')
+        self.assertEqual(self.get(), b'legacy')
+
+        # a pending generation is not visible
+        generation = self.generations.begin()
+        self.redis_client.set(self.generations.key(generation, 'u1'), b'pending')
+        self.assertEqual(self.get(), b'legacy')
+        self.assertEqual(self.generations.live(), [generation])
+
+        self.generations.activate(generation)
+        self.assertEqual(self.get(), b'pending')
+        self.assertEqual(self.generations.current(), generation)
+
+    def test_activate_keeps_previous_and_reclaims_older(self):
+        first = self.publish(b'first')
+        second = self.publish(b'second')
+        third = self.publish(b'third')
+
+        self.assertEqual(self.get(), b'third')
+        self.assertIsNone(self.redis_client.get(self.generations.key(first, 'u1')))
+        self.assertEqual(self.redis_client.get(self.generations.key(second, 'u1')), b'second')
+        self.assertEqual({int(g) for g in self.redis_client.smembers(self.generations.all_key)}, {second, third})
+
+    def test_abort(self):
+        self.publish(b'first')
+
+        generation = self.generations.begin()
+        self.redis_client.set(self.generations.key(generation, 'u1'), b'partial')
+        self.generations.abort(generation)
+
+        self.assertEqual(self.get(), b'first')
+        self.assertIsNone(self.redis_client.get(self.generations.pending_key))
+        self.assertIsNone(self.redis_client.get(self.generations.key(generation, 'u1')))
+
+    def test_rollback(self):
+        self.assertIsNone(self.generations.rollback())
+
+        first = self.publish(b'first')
+        second = self.publish(b'second')
+
+        self.assertEqual(self.generations.rollback(), first)
+        self.assertEqual(self.get(), b'first')
+
+        # rolling back again rolls forward
+        self.assertEqual(self.generations.rollback(), second)
+        self.assertEqual(self.get(), b'second')
+
+    def test_fenced_activate(self):
+        self.redis_client.set('leader:trainer', b'me')
+        first = self.publish(b'first', fence=('leader:trainer', 'me'))
+
+        generation = self.generations.begin()
+        self.redis_client.set(self.generations.key(generation, 'u1'), b'stale')
+        self.redis_client.set('leader:trainer', b'other')
+
+        self.assertRaises(LeadershipLost, self.generations.activate, generation, fence=('leader:trainer', 'me'))
+        self.assertEqual(self.generations.current(), first)
+        self.assertEqual(self.get(), b'first')
+        self.assertIsNone(self.redis_client.get(self.generations.key(generation, 'u1')))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,57 @@
+# -*- coding: utf-8 -*-
+import unittest
+import numpy as np
+from scipy import sparse
+from app.recommender.index import IVFIndex
+from app.recommender.scoring import FactorModel, top_n_block
+
+
+class IVFIndexTopNBlockTest(unittest.TestCase):
+
+    N = 10
+
+    def setUp(self):
+        rng = np.random.RandomState(0)
+        n_users, n_items, n_factors = 50, 400, 8
+
+        self.factors = FactorModel(3.5, rng.normal(0, 0.1, n_users), rng.normal(0, 0.1, n_items),
+                                   rng.normal(0, 0.3, (n_users, n_factors)), rng.normal(0, 0.3, (n_items, n_factors)),
+                                   np.arange(n_users), np.arange(n_items))
+        rated = rng.rand(n_users, n_items) < 0.1
+        # the last user has rated all items but 3, thus less than N items remain
+        rated[-1] = True
+        rated[-1, -3:] = False
+
+        self.rated = sparse.csr_matrix(rated)
+        self.rated.sort_indices()
+
+    def test_same_as_search_of_each_user(self):
+        index = IVFIndex.build(self.factors, n_clusters=20, n_probe=2, random_state=0)
+
+        top_items, top_scores = index.top_n_block(self.factors, self.rated, 5, 50, self.N)
+
+        for offset, inner_uid in enumerate(range(5, 50)):
+            exclude = self.rated.indices[self.rated.indptr[inner_uid]:self.rated.indptr[inner_uid + 1]]
+            items, scores = index.search(self.factors.pu[inner_uid], self.N, exclude)
+            scores = scores + self.factors.bu[inner_uid] + self.factors.global_mean
+
+            valid = np.isfinite(top_scores[offset])
+            self.assertEqual(top_items[offset][valid].tolist(), items.tolist())
+            np.testing.assert_allclose(top_scores[offset][valid], scores, rtol=1e-5)
+
+        self.assertEqual(np.isfinite(top_scores[-1]).sum(), 3)
+
+    def test_probing_all_clusters_is_exact(self):
+        index = IVFIndex.build(self.factors, n_clusters=20, n_probe=20, random_state=0)
+
+        top_items, top_scores = index.top_n_block(self.factors, self.rated, 0, 50, self.N)
+        exact_items, exact_scores = top_n_block(self.factors, self.rated, 0, 50, self.N)
+
+        valid = np.isfinite(exact_scores)
+        np.testing.assert_array_equal(np.isfinite(top_scores), valid)
+        np.testing.assert_array_equal(top_items[valid], exact_items[valid])
+        np.testing.assert_allclose(top_scores[valid], exact_scores[valid], rtol=1e-5)
+
+
+if __name__ == '__main__':
+    unittest.main()
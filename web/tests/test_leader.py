@@ -0,0 +1,56 @@
+# -*- coding: utf-8 -*-
+import unittest
+import fakeredis
+import redis
+from app.leader import LeaderElection, LeadershipLost
+from app.recommender.generations import Generations, RECOMMENDATIONS
+
+
+class LeaderElectionTest(unittest.TestCase):
+
+    def setUp(self):
+        self.redis_pool = redis.ConnectionPool(connection_class=fakeredis.FakeConnection,
+                                               server=fakeredis.FakeServer())
+        self.redis_client = redis.Redis(connection_pool=self.redis_pool)
+
+        self.leader = LeaderElection(self.redis_pool, 'trainer', ttl=30)
+        self.follower = LeaderElection(self.redis_pool, 'trainer', ttl=30)
+
+    def lose_leadership(self):
+        # e.g., the leader stalled for longer than the time-to-live and another instance took over
+        self.redis_client.delete(self.leader.key)
+        self.assertTrue(self.follower.campaign())
+
+    def test_check(self):
+        self.assertTrue(self.leader.campaign())
+        self.assertFalse(self.follower.campaign())
+
+        self.leader.check()
+        self.assertRaises(LeadershipLost, self.follower.check)
+
+        self.lose_leadership()
+
+        self.assertRaises(LeadershipLost, self.leader.check)
+        self.assertFalse(self.leader.is_leader)
+
+    def test_fenced_activation(self):
+        generations = Generations(self.redis_client, RECOMMENDATIONS)
+        self.assertTrue(self.leader.campaign())
+
+        generation = generations.begin()
+        generations.activate(generation, fence=self.leader.fence)
+        self.assertEqual(generations.current(), generation)
+
+        stale_generation = generations.begin()
+        self.lose_leadership()
+
+        self.assertRaises(LeadershipLost, generations.activate, stale_generation, fence=self.leader.fence)
+        self.assertEqual(generations.current(), generation)
+
+        new_generation = generations.begin()
+        generations.activate(new_generation, fence=self.follower.fence)
+        self.assertEqual(generations.current(), new_generation)
+
+
+if __name__ == '__main__':
+    unittest.main()
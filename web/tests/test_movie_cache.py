@@ -0,0 +1,48 @@
+# -*- coding: utf-8 -*-
+import json
+import unittest
+from types import SimpleNamespace
+import fakeredis
+import redis
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+from app.models import Movie
+from app.movie_cache import MovieCatalogCache
+
+
+class MovieCatalogCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        engine = create_engine('sqlite://')
+        Movie.__table__.create(engine)
+
+        self.db = SimpleNamespace(engine=engine, session=sessionmaker(bind=engine)())
+        self.redis_pool = redis.ConnectionPool(connection_class=fakeredis.FakeConnection,
+                                               server=fakeredis.FakeServer())
+        self.cache = MovieCatalogCache(self.db, self.redis_pool, max_size=10, version_check_interval=0)
+
+        self.db.session.add(Movie(movie_id=1, title='Toy Story', year=1995))
+        self.db.session.commit()
+
+    def tearDown(self):
+        self.db.session.close()
+
+    def title(self, movie_id):
+        return json.loads(self.cache.get([movie_id])[movie_id])['title']
+
+    def test_fragment_is_evicted_when_version_changes(self):
+        self.assertEqual(self.title(1), 'Toy Story')
+
+        self.db.session.query(Movie).filter(Movie.movie_id == 1).update({'title': 'Toy Story (1995)'})
+        self.db.session.commit()
+
+        # the catalog version has not changed, thus the cached fragment is served
+        self.assertEqual(self.title(1), 'Toy Story')
+
+        redis.Redis(connection_pool=self.redis_pool).incr(MovieCatalogCache.VERSION_KEY)
+
+        self.assertEqual(self.title(1), 'Toy Story (1995)')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,151 @@
+# -*- coding: utf-8 -*-
+import json
+import os
+import unittest
+from datetime import datetime, timedelta, timezone
+from types import SimpleNamespace
+from unittest import mock
+import fakeredis
+import redis
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+from app.models import Rating
+from app.rating_queue import RatingEventQueue
+from app.recommender.statistics import MovieStatistics
+
+NOW = datetime(2020, 1, 1, tzinfo=timezone.utc)
+
+
+class RatingEventQueueTest(unittest.TestCase):
+
+    def setUp(self):
+        self.redis_pool = redis.ConnectionPool(connection_class=fakeredis.FakeConnection,
+                                               server=fakeredis.FakeServer())
+        self.db = SimpleNamespace(session=mock.MagicMock())
+        self.movie_stats = MovieStatistics(self.db, redis_pool=self.redis_pool, users_lower_limit=0,
+                                           redis_chunk_size=2)
+        self.flushed = []
+        self.queue = RatingEventQueue(self.db, redis_pool=self.redis_pool, flush_size=10, flush_interval=1,
+                                      movie_stats=self.movie_stats, on_flush=self.flushed.append)
+
+    def queued_events(self):
+        # the queue has the newest events first
+        events = self.queue.redis_client.lrange(self.queue.QUEUE_KEY, 0, -1)
+        return [json.loads(event) for event in reversed(events)]
+
+    def test_push_coalescing(self):
+        self.queue.push(1, 10, rating=3.0, ts=NOW)
+        self.queue.push(1, 10, rating=4.0, ts=NOW + timedelta(seconds=1))
+        # an event that is pushed late, but is older than the latest one
+        self.queue.push(1, 10, rating=2.0, ts=NOW - timedelta(seconds=1))
+        self.queue.push(1, 11, delete=True, ts=NOW)
+        # of events with the same ts, the latest pushed one wins
+        self.queue.push(2, 10, rating=1.0, ts=NOW)
+        self.queue.push(2, 10, rating=5.0, ts=NOW)
+
+        latest = RatingEventQueue.coalesce(self.queued_events())
+
+        self.assertEqual({key: (e['r'], e['d']) for key, e in latest.items()},
+                         {(1, 10): (4.0, False), (1, 11): (None, True), (2, 10): (5.0, False)})
+
+    def test_changes_of_newer_events_only(self):
+        latest = {
+            (1, 10): {'m': 10, 'r': 4.0, 'i': False, 'd': False, 'ts': NOW.timestamp()},
+            (1, 11): {'m': 11, 'r': 4.0, 'i': False, 'd': False, 'ts': NOW.timestamp()},
+            (1, 12): {'m': 12, 'r': None, 'i': False, 'd': True, 'ts': NOW.timestamp()},
+            (1, 13): {'m': 13, 'r': 2.0, 'i': True, 'd': False, 'ts': NOW.timestamp()},
+            (1, 14): {'m': 14, 'r': None, 'i': False, 'd': True, 'ts': NOW.timestamp()}
+        }
+        previous = {
+            # older, newer, older (deleted) and without ts
+            (1, 10): (3.0, False, NOW - timedelta(seconds=1)),
+            (1, 11): (3.0, False, NOW + timedelta(seconds=1)),
+            (1, 12): (5.0, False, NOW - timedelta(seconds=1)),
+            (1, 13): (1.0, False, None)
+        }
+
+        self.assertEqual(sorted(RatingEventQueue.changes(latest, previous)), [
+            (10, (3.0, False), (4.0, False)),
+            (12, (5.0, False), None),
+            (13, (1.0, False), (2.0, True)),
+            (14, None, None)
+        ])
+
+    def test_flush_updates_statistics(self):
+        self.movie_stats.update(10, None, (3.0, False))
+        self.movie_stats.update(11, None, (5.0, False))
+
+        self.queue.push(1, 10, rating=4.0, ts=NOW + timedelta(seconds=1))
+        self.queue.push(1, 11, delete=True, ts=NOW + timedelta(seconds=1))
+        self.queue.push(2, 12, rating=2.0, ts=NOW)
+
+        previous = {(1, 10): (3.0, False, NOW), (1, 11): (5.0, False, NOW)}
+        with mock.patch.object(self.movie_stats, 'lock_previous_ratings', return_value=previous):
+            self.assertEqual(self.queue.flush(), 3)
+
+        self.assertEqual(self.movie_stats.get_avg_ratings([10, 11, 12]), {10: 4.0, 12: 2.0})
+        self.assertEqual(self.flushed, [{1, 2}])
+        self.db.session.commit.assert_called_once()
+
+        lag = self.queue.lag()
+        self.assertEqual((lag['queued_events'], lag['processing_events']), (0, 0))
+        self.assertEqual((lag['last_flush']['events'], lag['last_flush']['rows']), (3, 3))
+
+
+@unittest.skipUnless(os.getenv('TEST_DATABASE_URL'), 'requires a PostgreSQL database (TEST_DATABASE_URL)')
+class RatingEventQueueWriteTest(unittest.TestCase):
+    """
+    The upsert and the delete of a flush (on a disposable PostgreSQL database)
+    """
+
+    def setUp(self):
+        engine = create_engine(os.getenv('TEST_DATABASE_URL'))
+        Rating.__table__.create(engine, checkfirst=True)
+
+        self.db = SimpleNamespace(engine=engine, session=sessionmaker(bind=engine)())
+        self.addCleanup(self.db.session.close)
+        self.delete_ratings()
+        self.addCleanup(self.delete_ratings)
+
+        redis_pool = redis.ConnectionPool(connection_class=fakeredis.FakeConnection, server=fakeredis.FakeServer())
+        self.movie_stats = MovieStatistics(self.db, redis_pool=redis_pool, users_lower_limit=0, redis_chunk_size=2)
+        self.queue = RatingEventQueue(self.db, redis_pool=redis_pool, flush_size=10, flush_interval=1,
+                                      movie_stats=self.movie_stats)
+
+    def delete_ratings(self):
+        self.db.session.query(Rating).delete(synchronize_session=False)
+        self.db.session.commit()
+
+    def rate(self, movie_id, rating, ts):
+        # a core insert, since the orm would write the default ts instead of NULL
+        self.db.session.execute(Rating.__table__.insert().values(user_id=1, movie_id=movie_id, rating=rating,
+                                                                 is_implicit=False, ts=ts))
+        self.db.session.commit()
+        self.movie_stats.update(movie_id, None, (rating, False))
+
+    def ratings(self):
+        return {movie_id: rating for (movie_id, rating) in self.db.session.query(Rating.movie_id, Rating.rating)}
+
+    def test_only_newer_events_are_written(self):
+        self.rate(10, 3.0, NOW)
+        self.rate(11, 3.0, NOW)
+        self.rate(12, 3.0, NOW)
+        self.rate(13, 3.0, NOW)
+        self.rate(14, 3.0, None)
+        self.rate(15, 3.0, None)
+
+        self.queue.push(1, 10, rating=4.0, ts=NOW + timedelta(seconds=1))
+        self.queue.push(1, 11, rating=4.0, ts=NOW - timedelta(seconds=1))
+        self.queue.push(1, 12, delete=True, ts=NOW + timedelta(seconds=1))
+        self.queue.push(1, 13, delete=True, ts=NOW - timedelta(seconds=1))
+        # ratings without ts are older than any event
+        self.queue.push(1, 14, rating=4.0, ts=NOW)
+        self.queue.push(1, 15, delete=True, ts=NOW)
+        self.queue.flush()
+
+        self.assertEqual(self.ratings(), {10: 4.0, 11: 3.0, 13: 3.0, 14: 4.0})
+        self.assertEqual(self.movie_stats.get_avg_ratings(range(10, 16)), {10: 4.0, 11: 3.0, 13: 3.0, 14: 4.0})
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,98 @@
+# -*- coding: utf-8 -*-
+import tempfile
+import unittest
+from datetime import datetime, timedelta, timezone
+from types import SimpleNamespace
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+from app.models import Rating, RatingDeletion
+from app.recommender.ratings_cache import RatingsCache
+
+
+class RatingsCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        engine = create_engine('sqlite://')
+        Rating.__table__.create(engine)
+        RatingDeletion.__table__.create(engine)
+
+        self.db = SimpleNamespace(engine=engine, session=sessionmaker(bind=engine)())
+        self.path = tempfile.mkdtemp()
+        self.base = datetime.now(tz=timezone.utc).replace(microsecond=0) + timedelta(minutes=1)
+        self.deletion_id = 0
+
+    def tearDown(self):
+        self.db.session.close()
+
+    def rate(self, user_id, movie_id, rating, minutes, written_minutes=None):
+        written_minutes = minutes if written_minutes is None else written_minutes
+        self.db.session.merge(Rating(user_id=user_id, movie_id=movie_id, rating=rating, is_implicit=False,
+                                     ts=self.base + timedelta(minutes=minutes),
+                                     written_at=self.base + timedelta(minutes=written_minutes)))
+        self.db.session.commit()
+
+    def delete(self, user_id, movie_id, minutes):
+        self.deletion_id += 1
+        self.db.session.query(Rating) \
+            .filter(Rating.user_id == user_id, Rating.movie_id == movie_id) \
+            .delete(synchronize_session=False)
+        self.db.session.add(RatingDeletion(id=self.deletion_id, user_id=user_id, movie_id=movie_id,
+                                           deleted_at=self.base + timedelta(minutes=minutes)))
+        self.db.session.commit()
+
+    def test_rating_re_inserted_after_deletion_is_kept(self):
+        cache = RatingsCache(self.db, self.path, full_reload_every=100, overlap_seconds=1)
+
+        self.rate(1, 1, 4.0, 0)
+        self.rate(1, 2, 3.0, 0)
+        self.rate(2, 1, 5.0, 0)
+        self.assertEqual(len(cache.refresh().index), 3)
+
+        self.delete(1, 2, 1)
+        self.assertEqual(len(cache.refresh().index), 2)
+
+        self.rate(1, 2, 2.5, 2)
+        self.assertEqual(len(cache.refresh().index), 3)
+
+        # the ratings watermark moves past the re-inserted rating, while the deletion is still fetched
+        self.rate(2, 2, 1.0, 10)
+        self.assertEqual(len(cache.refresh().index), 4)
+        df = cache.refresh()
+
+        self.assertEqual(len(df.index), 4)
+        self.assertEqual(set(zip(df['user_id'], df['movie_id'])), {(1, 1), (1, 2), (2, 1), (2, 2)})
+        self.assertEqual(float(df[(df['user_id'] == 1) & (df['movie_id'] == 2)]['rating'].iloc[0]), 2.5)
+
+    def test_deleted_rating_is_removed(self):
+        cache = RatingsCache(self.db, self.path, full_reload_every=100, overlap_seconds=1)
+
+        self.rate(1, 1, 4.0, 0)
+        self.rate(1, 2, 3.0, 0)
+        self.assertEqual(len(cache.refresh().index), 2)
+
+        self.delete(1, 1, 1)
+        self.rate(2, 2, 1.0, 10)
+        df = cache.refresh()
+
+        self.assertEqual(set(zip(df['user_id'], df['movie_id'])), {(1, 2), (2, 2)})
+
+    def test_rating_written_long_after_its_event_is_fetched(self):
+        cache = RatingsCache(self.db, self.path, full_reload_every=100, overlap_seconds=1)
+
+        self.rate(1, 1, 4.0, 0)
+        self.rate(2, 2, 1.0, 10)
+        self.assertEqual(len(cache.refresh().index), 2)
+
+        # e.g., a queued rating event that is written to the database after the watermark has moved past its ts
+        self.rate(1, 2, 3.0, 5, written_minutes=20)
+        df = cache.refresh()
+
+        self.assertEqual(set(zip(df['user_id'], df['movie_id'])), {(1, 1), (1, 2), (2, 2)})
+
+        # its ts is kept, i.e., the time of the event
+        ts = int(df[(df['user_id'] == 1) & (df['movie_id'] == 2)]['ts'].iloc[0])
+        self.assertEqual(ts, int((self.base + timedelta(minutes=5)).timestamp() * 1e6))
+
+
+if __name__ == '__main__':
+    unittest.main()
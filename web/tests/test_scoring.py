@@ -0,0 +1,59 @@
+# -*- coding: utf-8 -*-
+import itertools
+import unittest
+import numpy as np
+import pandas as pd
+from surprise import SVD, Dataset, Reader
+from app.recommender.scoring import FactorModel, rated_matrix, iter_top_n_blocks
+
+
+class BlockedTopNParityTest(unittest.TestCase):
+    """
+    The blocked top-n must give the same ranking as predicting every unrated item of each user with the SVD
+    """
+
+    N = 5
+
+    def setUp(self):
+        rng = np.random.RandomState(0)
+        pairs = [(user_id, movie_id) for user_id in range(1, 13) for movie_id in range(100, 130)
+                 if rng.rand() < 0.4]
+        df = pd.DataFrame({
+            'user_id': [user_id for (user_id, _) in pairs],
+            'movie_id': [movie_id for (_, movie_id) in pairs],
+            'rating': rng.choice(np.arange(1.0, 5.5, 0.5), size=len(pairs))
+        })
+
+        trainset = Dataset.load_from_df(df, Reader(rating_scale=(0.5, 5.0))).build_full_trainset()
+        self.svd = SVD(n_factors=4, n_epochs=20, random_state=0)
+        self.svd.fit(trainset)
+
+    def predicted_top_n(self, raw_uid):
+        trainset = self.svd.trainset
+        inner_uid = trainset.to_inner_uid(raw_uid)
+        rated = {inner_iid for (inner_iid, _) in trainset.ur[inner_uid]}
+
+        predictions = [(trainset.to_raw_iid(inner_iid), self.svd.predict(raw_uid, trainset.to_raw_iid(inner_iid)).est)
+                       for inner_iid in trainset.all_items() if inner_iid not in rated]
+
+        return sorted(predictions, key=lambda p: -p[1])[:self.N]
+
+    def test_same_ids_and_scores(self):
+        factors = FactorModel.from_svd(self.svd)
+        rated = rated_matrix(self.svd.trainset)
+
+        # a block size that does not divide the number of users
+        blocks = list(iter_top_n_blocks(factors, rated, self.N, block_size=5))
+        recommendations = dict(itertools.chain.from_iterable(blocks))
+
+        self.assertEqual(len(recommendations), self.svd.trainset.n_users)
+
+        for raw_uid, top_n in recommendations.items():
+            expected = self.predicted_top_n(raw_uid)
+
+            self.assertEqual([raw_iid for (raw_iid, _) in top_n], [raw_iid for (raw_iid, _) in expected])
+            np.testing.assert_allclose([est for (_, est) in top_n], [est for (_, est) in expected], atol=1e-5)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,116 @@
+# -*- coding: utf-8 -*-
+import unittest
+from types import SimpleNamespace
+import fakeredis
+import redis
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+from app.models import Rating, User
+from app.recommender.seen import SeenMovies
+
+
+class SeenMoviesRebuildTest(unittest.TestCase):
+
+    def setUp(self):
+        engine = create_engine('sqlite://')
+        Rating.__table__.create(engine)
+        User.__table__.create(engine)
+
+        self.db = SimpleNamespace(engine=engine, session=sessionmaker(bind=engine)())
+        self.redis_pool = redis.ConnectionPool(connection_class=fakeredis.FakeConnection,
+                                               server=fakeredis.FakeServer())
+        self.seen = SeenMovies(self.db, redis_pool=self.redis_pool, redis_chunk_size=1)
+
+    def tearDown(self):
+        self.db.session.close()
+
+    def rate(self, user_id, movie_id):
+        self.db.session.merge(Rating(user_id=user_id, movie_id=movie_id, rating=4.0, is_implicit=False))
+        self.db.session.commit()
+
+    def test_rebuild(self):
+        for user_id in (1, 2):
+            self.db.session.add(User(user_id=user_id))
+        self.db.session.commit()
+
+        self.rate(1, 10)
+        self.rate(1, 11)
+        self.rate(2, 10)
+        # the ratings of a deleted user
+        self.rate(3, 12)
+
+        self.assertIsNone(self.seen.get(1))
+
+        # e.g., a rating which has been deleted while its removal from the set has been lost
+        self.seen.add(2, 13)
+
+        self.seen.rebuild()
+
+        self.assertEqual(self.seen.get(1), {10, 11})
+        self.assertEqual(self.seen.get(2), {10})
+        self.assertEqual(self.seen.get(3), set())
+        self.assertFalse(self.seen.redis_client.exists(self.seen.key(3)))
+        self.assertEqual(self.seen.redis_client.keys('seen:*:*'), [])
+
+    def test_set_of_user_without_ratings_is_removed(self):
+        self.db.session.add(User(user_id=1))
+        self.db.session.commit()
+        self.seen.add(1, 10)
+
+        self.seen.rebuild()
+
+        self.assertFalse(self.seen.redis_client.exists(self.seen.key(1)))
+
+    def test_actions_missed_by_snapshot_are_kept(self):
+        for user_id in (1, 2):
+            self.db.session.add(User(user_id=user_id))
+        self.db.session.commit()
+        self.rate(1, 10)
+        self.rate(2, 10)
+
+        def act_before_snapshot():
+            # e.g., actions whose ratings are not written yet (write-behind)
+            self.seen.add(1, 11)
+            self.seen.add(2, 12)
+
+        execute_rebuilt = self.seen._execute_rebuilt
+
+        def act_then_execute(pipe, user_ids):
+            # actions after the snapshot, which the rebuilt sets do not have
+            self.seen.add(1, 13)
+            self.seen.remove(1, 10)
+            self.seen.add(2, 14)
+            execute_rebuilt(pipe, user_ids)
+
+        self.seen._execute_rebuilt = act_then_execute
+        self.seen.rebuild(before_snapshot=act_before_snapshot)
+
+        self.assertEqual(self.seen.get(1), {11, 13})
+        self.assertEqual(self.seen.get(2), {10, 12, 14})
+        self.assertEqual(self.seen.redis_client.keys('seen:*:*'), [])
+
+        # the actions are not journaled after the rebuild
+        self.seen.add(1, 15)
+        self.assertEqual(self.seen.redis_client.keys('seen:*:*'), [])
+
+    def test_set_of_user_deleted_during_rebuild_is_removed(self):
+        self.db.session.add(User(user_id=1))
+        self.db.session.commit()
+        self.rate(1, 10)
+
+        execute_rebuilt = self.seen._execute_rebuilt
+
+        def delete_user_then_execute(pipe, user_ids):
+            self.db.session.query(User).filter(User.user_id == 1).delete(synchronize_session=False)
+            self.db.session.commit()
+            self.seen.delete(1)
+            execute_rebuilt(pipe, user_ids)
+
+        self.seen._execute_rebuilt = delete_user_then_execute
+        self.seen.rebuild()
+
+        self.assertFalse(self.seen.redis_client.exists(self.seen.key(1)))
+
+
+if __name__ == '__main__':
+    unittest.main()
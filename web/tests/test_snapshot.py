@@ -0,0 +1,44 @@
+# -*- coding: utf-8 -*-
+import os
+import tempfile
+import unittest
+from unittest import mock
+import numpy as np
+from app.recommender.scoring import FactorModel
+from app.recommender.snapshot import SnapshotStore
+
+
+class SnapshotStoreTest(unittest.TestCase):
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.store = SnapshotStore(self.path, keep=2)
+
+    @staticmethod
+    def factors(global_mean):
+        return FactorModel(global_mean, np.zeros(2), np.zeros(3), np.ones((2, 4)), np.ones((3, 4)),
+                           np.array([10, 11]), np.array([20, 21, 22]))
+
+    def test_saves_in_the_same_millisecond(self):
+        with mock.patch('time.time', return_value=1538312120.123):
+            first = self.store.save(self.factors(3.0))
+            second = self.store.save(self.factors(3.5))
+
+        self.assertNotEqual(first, second)
+        self.assertEqual(self.store.current_version(), second)
+        self.assertEqual(self.store.latest().global_mean, 3.5)
+        self.assertEqual(self.store.load(first).global_mean, 3.0)
+
+    def test_old_versions_are_removed(self):
+        versions = []
+        for i in range(4):
+            with mock.patch('time.time', return_value=1538312120.0 + i):
+                versions.append(self.store.save(self.factors(3.0)))
+
+        remaining = sorted(v for v in os.listdir(self.path) if v.startswith('v'))
+
+        self.assertEqual(remaining, sorted(versions[-2:]))
+
+
+if __name__ == '__main__':
+    unittest.main()
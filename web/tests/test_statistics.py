@@ -0,0 +1,68 @@
+# -*- coding: utf-8 -*-
+import unittest
+from types import SimpleNamespace
+import fakeredis
+import redis
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+from app.models import Rating
+from app.recommender.statistics import MovieStatistics
+
+
+class MovieStatisticsReconcileTest(unittest.TestCase):
+
+    def setUp(self):
+        engine = create_engine('sqlite://')
+        Rating.__table__.create(engine)
+
+        self.db = SimpleNamespace(engine=engine, session=sessionmaker(bind=engine)())
+        self.redis_pool = redis.ConnectionPool(connection_class=fakeredis.FakeConnection,
+                                               server=fakeredis.FakeServer())
+        self.stats = MovieStatistics(self.db, redis_pool=self.redis_pool, users_lower_limit=0, redis_chunk_size=2)
+
+    def tearDown(self):
+        self.db.session.close()
+
+    def rate(self, user_id, movie_id, rating, is_implicit=False):
+        self.db.session.merge(Rating(user_id=user_id, movie_id=movie_id, rating=rating, is_implicit=is_implicit))
+        self.db.session.commit()
+
+    def test_drift_is_corrected(self):
+        self.rate(1, 1, 4.0)
+        self.rate(2, 1, 3.0)
+        self.rate(1, 2, 5.0)
+        self.rate(2, 2, 1.0, is_implicit=True)
+        self.rate(1, 3, 2.0)
+
+        # movie 1 has drifted, movie 2 is correct, movie 3 is missing and movie 4 has no ratings any more
+        self.stats.update(1, None, (4.0, False))
+        self.stats.update(2, None, (5.0, False))
+        self.stats.update(4, None, (3.0, False))
+
+        self.stats.reconcile_rating_stats()
+
+        self.assertEqual(self.stats.get_avg_ratings([1, 2, 3, 4]), {1: 3.5, 2: 5.0, 3: 2.0})
+
+    def test_increments_during_reconciliation_are_kept(self):
+        self.rate(1, 1, 4.0)
+        self.rate(1, 2, 5.0)
+        self.rate(1, 3, 2.0)
+
+        stats = self.stats
+        reconcile_query = stats.reconcile_query
+
+        def rows_with_concurrent_rating(chunk_size):
+            # a rating that is written (and incremented) after the aggregation and the hashes have been read
+            for i, row in enumerate(reconcile_query().yield_per(chunk_size)):
+                yield row
+                if i == 0:
+                    stats.update(3, None, (5.0, False))
+
+        stats.reconcile_query = lambda: SimpleNamespace(yield_per=rows_with_concurrent_rating)
+        stats.reconcile_rating_stats()
+
+        self.assertEqual(stats.get_avg_ratings([1, 2, 3]), {1: 4.0, 2: 5.0, 3: 3.5})
+
+
+if __name__ == '__main__':
+    unittest.main()
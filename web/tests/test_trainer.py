@@ -0,0 +1,75 @@
+# -*- coding: utf-8 -*-
+import time
+import unittest
+from types import SimpleNamespace
+from unittest import mock
+import fakeredis
+import redis
+from app import app, trainer
+from app.recommender.changes import RatingChanges
+
+
+class StaleUsersRefreshTest(unittest.TestCase):
+
+    def setUp(self):
+        redis_pool = redis.ConnectionPool(connection_class=fakeredis.FakeConnection, server=fakeredis.FakeServer())
+        self.rating_changes = RatingChanges(redis_pool)
+
+        # the latest re-estimation has just completed
+        self.rating_changes.redis_client.set(RatingChanges.LAST_RECOMPUTE_KEY, time.time())
+
+        self.refreshed = []
+        self.estimator = SimpleNamespace(refresh_user_recommendations=self.refreshed.append,
+                                         recompute_recommendations=mock.Mock())
+        self.leadership = SimpleNamespace(check=lambda: None, fence=None)
+
+        patches = [
+            mock.patch.object(trainer, 'rating_changes', self.rating_changes),
+            mock.patch.object(trainer, 'estimator', self.estimator),
+            mock.patch.dict(app.config, {'RECOMPUTE_MIN_MINUTES': 5, 'RECOMPUTE_MAX_MINUTES': 60,
+                                         'RECOMPUTE_CHANGED_RATINGS': 1000, 'RECOMPUTE_CHANGED_USERS': 100,
+                                         'RECOMPUTE_STALE_USERS_LIMIT': 2})
+        ]
+        for patch in patches:
+            patch.start()
+            self.addCleanup(patch.stop)
+
+    def stale_users(self):
+        return {int(user_id) for user_id in self.rating_changes.redis_client.smembers(RatingChanges.USERS_KEY)}
+
+    def test_only_stale_users_are_refreshed(self):
+        self.rating_changes.record({1: 2, 2: 1})
+
+        trainer.trigger_check_rating_changes(self.leadership)
+
+        self.assertEqual(sorted(self.refreshed), [1, 2])
+        self.assertEqual(self.stale_users(), set())
+        self.estimator.recompute_recommendations.assert_not_called()
+
+        # the changed ratings still count towards the next re-estimation
+        n_ratings, _, n_stale_users, _ = self.rating_changes.pending()
+        self.assertEqual((n_ratings, n_stale_users), (3, 0))
+
+    def test_too_many_stale_users_are_not_refreshed(self):
+        self.rating_changes.record({1: 1, 2: 1, 3: 1})
+
+        trainer.trigger_check_rating_changes(self.leadership)
+
+        self.assertEqual(self.refreshed, [])
+        self.assertEqual(self.stale_users(), {1, 2, 3})
+        self.estimator.recompute_recommendations.assert_not_called()
+
+    def test_failed_refresh_restores_remaining_users(self):
+        self.rating_changes.record({1: 1, 2: 1})
+
+        def fail(user_id):
+            raise RuntimeError(f'Failed to refresh user {user_id}')
+
+        self.estimator.refresh_user_recommendations = fail
+
+        self.assertRaises(RuntimeError, trainer.trigger_check_rating_changes, self.leadership)
+        self.assertEqual(self.stale_users(), {1, 2})
+
+
+if __name__ == '__main__':
+    unittest.main()